@@ -185,10 +185,10 @@ Usage: filter_orthologs.py
     trimmed_files, misaligned_files = _trim_alignments(run_dir, aligned_files, retained_threshold, max_indel_length,
                                                        target_stats_path, target_scatterplot)
 
-    # Create archives of files on command line specified output paths
-    create_archive_of_files(aligned_zip, aligned_files)
-    create_archive_of_files(misaligned_zip, misaligned_files)
-    create_archive_of_files(trimmed_zip, trimmed_files)
+    # Create archives of files on command line specified output paths, uncompressed as these are intermediates
+    create_archive_of_files(aligned_zip, aligned_files, 'stored')
+    create_archive_of_files(misaligned_zip, misaligned_files, 'stored')
+    create_archive_of_files(trimmed_zip, trimmed_files, 'stored')
 
     # Remove unused files to free disk space
     shutil.rmtree(run_dir)
@@ -16,7 +16,7 @@ from Bio.Data import CodonTable
 from argparse import ArgumentParser, RawDescriptionHelpFormatter, ArgumentTypeError
 from collections import Counter, defaultdict
 from shared import CODON_TABLE_ID, find_cogs_in_sequence_records, get_most_recent_gene_name, \
-    extract_archive_of_files, create_directory
+    ArchiveReader
 from run_codeml import run_codeml, parse_codeml_output
 from run_phipack import run_phipack
 from select_taxa import select_genomes_by_ids
@@ -567,7 +567,7 @@ class clade_calcs(object):
         self.values[PRODUCT] = get_most_recent_gene_name(genomes, self.alignment)
 
 
-def _table_calculations(genome_ids_a, genome_ids_b, sico_files, phipack_values):
+def _table_calculations(genome_ids_a, genome_ids_b, sico_files, phipack_values, open_file=open):
     '''Perform calculations for comparsion of genome_ids_a with genome_ids_b.'''
     # retrieve genomes once for both
     genomes_a = select_genomes_by_ids(genome_ids_a).values()
@@ -577,7 +577,8 @@ def _table_calculations(genome_ids_a, genome_ids_b, sico_files, phipack_values):
     # loop over orthologs
     for sico_file in sico_files:
         # parse alignment
-        alignment = AlignIO.read(sico_file, 'fasta')
+        with open_file(sico_file) as read_handle:
+            alignment = AlignIO.read(read_handle, 'fasta')
 
         # split alignments
         alignment_a = MultipleSeqAlignment(seqr for seqr in alignment if seqr.id.split('|')[0] in genome_ids_a)
@@ -628,8 +629,9 @@ def run_calculations(genomes_a_file,
                      genomes_b_file,
                      sico_files,
                      table_a_dest,
-                     table_b_dest):
-    '''Perform all calculations as requested through command line arguments'''
+                     table_b_dest,
+                     open_file=open):
+    '''Perform all calculations as requested through command line arguments, reading sico files through open_file'''
     # parse genomes in genomes_x_files
     genome_ids_a, common_prefix_a = _extract_genome_ids_and_common_prefix(genomes_a_file)
     genome_ids_b, common_prefix_b = _extract_genome_ids_and_common_prefix(genomes_b_file)
@@ -643,13 +645,13 @@ def run_calculations(genomes_a_file,
     else:
         phipack_dir = tempfile.mkdtemp(prefix='phipack_')
         phipack_values = {sico_file:
-                          run_phipack(phipack_dir, sico_file)
+                          run_phipack(phipack_dir, sico_file, open_file)
                           for sico_file in sico_files}
         shutil.rmtree(phipack_dir)
 
     # per table calculations
     if 1 < len(genome_ids_a):
-        calculations_ab = _table_calculations(genome_ids_a, genome_ids_b, sico_files, phipack_values)
+        calculations_ab = _table_calculations(genome_ids_a, genome_ids_b, sico_files, phipack_values, open_file)
         _write_to_file(table_a_dest,
                        genome_ids_a, genome_ids_b,
                        common_prefix_a, common_prefix_b,
@@ -659,7 +661,7 @@ def run_calculations(genomes_a_file,
             write_handle.write('#At least two genomes are needed to calculate diversity, not ' + str(len(genome_ids_a)))
 
     if 1 < len(genome_ids_b):
-        calculations_ba = _table_calculations(genome_ids_b, genome_ids_a, sico_files, phipack_values)
+        calculations_ba = _table_calculations(genome_ids_b, genome_ids_a, sico_files, phipack_values, open_file)
         _write_to_file(table_b_dest,
                        genome_ids_b, genome_ids_a,
                        common_prefix_b, common_prefix_a,
@@ -689,20 +691,21 @@ def _every_other_codon_alignments(alignment):
     return ali_odd, ali_even
 
 
-def _split_by_odd_even_codons(sico_files):
+def _split_by_odd_even_codons(sico_files, target_dir, open_file=open):
     '''Split each sequence in each sico file by odd and even codons and write them out to separate files.'''
     odd_sico_files = []
     even_sico_files = []
 
     for sico_file in sico_files:
         # split alignments and store them in separate files
-        alignment = AlignIO.read(sico_file, 'fasta')
+        with open_file(sico_file) as read_handle:
+            alignment = AlignIO.read(read_handle, 'fasta')
         odd_alignment, even_alignment = _every_other_codon_alignments(alignment)
 
         # compose new unique filenames
-        dirname, basename = os.path.split(sico_file)
-        odd_file = os.path.join(dirname, 'odd_' + basename)
-        even_file = os.path.join(dirname, 'even_' + basename)
+        basename = os.path.split(sico_file)[1]
+        odd_file = os.path.join(target_dir, 'odd_' + basename)
+        even_file = os.path.join(target_dir, 'even_' + basename)
 
         # store the split alignments in separate files
         AlignIO.write(odd_alignment, odd_file, 'fasta')
@@ -721,27 +724,26 @@ def _prepare_calculations(genomes_a_file,
                           table_a_dest,
                           table_b_dest,
                           append_odd_even=False):
-    '''Unzip sico_files, and if needed create temporary files for the odd/even only codons.'''
+    '''Read sico_files from archive, and if needed create temporary files for the odd/even only codons.'''
     if append_odd_even:
         # prepend file makeup when odd/even table are also added
         _write_intro_to_file(table_a_dest)
         _write_intro_to_file(table_b_dest)
 
-    # extract ortholog files from sicozip
-    rundir = tempfile.mkdtemp(prefix='calculations_')
-    sico_files = extract_archive_of_files(sicozip_file, create_directory('sicos', inside_dir=rundir))
+    # read ortholog files straight from sicozip
+    with ArchiveReader(sicozip_file) as archive:
+        # perform normal calculation
+        run_calculations(genomes_a_file, genomes_b_file, archive.names, table_a_dest, table_b_dest, archive.open)
 
-    # perform normal calculation
-    run_calculations(genomes_a_file, genomes_b_file, sico_files, table_a_dest, table_b_dest)
+        # separate calculations for odd and even tables
+        if append_odd_even:
+            rundir = tempfile.mkdtemp(prefix='calculations_')
+            odd_sico_files, even_sico_files = _split_by_odd_even_codons(archive.names, rundir, archive.open)
+            run_calculations(genomes_a_file, genomes_b_file, odd_sico_files, table_a_dest, table_b_dest)
+            run_calculations(genomes_a_file, genomes_b_file, even_sico_files, table_a_dest, table_b_dest)
 
-    # separate calculations for odd and even tables
-    if append_odd_even:
-        odd_sico_files, even_sico_files = _split_by_odd_even_codons(sico_files)
-        run_calculations(genomes_a_file, genomes_b_file, odd_sico_files, table_a_dest, table_b_dest)
-        run_calculations(genomes_a_file, genomes_b_file, even_sico_files, table_a_dest, table_b_dest)
-
-    # clean up
-    shutil.rmtree(rundir)
+            # clean up
+            shutil.rmtree(rundir)
 
 
 def main(argv=None):  # IGNORE:C0111
@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+"""Module to checkpoint the outputs of pipeline steps within a persistent run directory, so failed runs can be resumed
+from the last completed step."""
+
+from contextlib import contextmanager
+from shared import create_directory
+import fcntl
+import hashlib
+import json
+import logging as log
+import os
+import shutil
+import tempfile
+import time
+
+
+__author__ = "Tim te Beek"
+__copyright__ = "Copyright 2011, Netherlands Bioinformatics Centre"
+__license__ = "MIT"
+
+# Incomplete runs not touched for this many seconds are removed, along with anything they left behind
+RUN_MAX_AGE = 7 * 24 * 60 * 60
+
+_CHECKPOINTS_FILE = 'checkpoints.json'
+_LOCK_FILE = '.lock'
+
+
+def _get_runs_dir():
+    """Return the directory holding runs, which can be shared between nodes through the orthomcl_runs environment
+    variable, and otherwise defaults to a directory within the local cache."""
+    if 'orthomcl_runs' in os.environ:
+        return create_directory('', inside_dir=os.environ['orthomcl_runs'])
+    return create_directory('orthomcl-runs')
+
+
+def create_run(prefix='run_', runs_dir=None):
+    """Create a new run directory, whose base name serves as run ID to resume the run with, and return its path."""
+    return tempfile.mkdtemp(prefix=prefix, dir=runs_dir or _get_runs_dir())
+
+
+def resume_run(run_id, runs_dir=None):
+    """Return the path of the existing run directory for run_id."""
+    run_dir = os.path.join(runs_dir or _get_runs_dir(), os.path.basename(run_id))
+    assert os.path.isdir(run_dir), 'No run to resume for run ID {0}: {1} does not exist'.format(run_id, run_dir)
+    return run_dir
+
+
+@contextmanager
+def locked_run(run_dir):
+    """Hold an exclusive lock on run_dir, so the same run can not be resumed twice at once, nor be removed while used."""
+    with open(os.path.join(run_dir, _LOCK_FILE), mode='a') as lock_handle:
+        try:
+            fcntl.flock(lock_handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            raise AssertionError('Run {0} is already in progress'.format(os.path.basename(run_dir)))
+        # Touch the run, which postpones its removal as stale run
+        os.utime(run_dir, None)
+        yield run_dir
+
+
+def remove_stale_runs(runs_dir=None, max_age=RUN_MAX_AGE, on_remove=None):
+    """Remove runs not modified within max_age seconds that are not in progress. Call on_remove with the checkpoints
+    of each run before removing it, to allow cleaning up resources held outside of the run directory."""
+    runs_dir = runs_dir or _get_runs_dir()
+    for name in os.listdir(runs_dir):
+        run_dir = os.path.join(runs_dir, name)
+        if not os.path.isdir(run_dir) or time.time() - _last_modified(run_dir) < max_age:
+            continue
+        with open(os.path.join(run_dir, _LOCK_FILE), mode='a') as lock_handle:
+            try:
+                fcntl.flock(lock_handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                continue
+            log.info('Removing stale run %s', name)
+            if on_remove:
+                on_remove(Checkpoints(run_dir))
+            shutil.rmtree(run_dir, ignore_errors=True)
+
+
+def _last_modified(run_dir):
+    """Return the most recent modification time of run_dir or its checkpoints file."""
+    checkpoints_file = os.path.join(run_dir, _CHECKPOINTS_FILE)
+    if os.path.isfile(checkpoints_file):
+        return max(os.path.getmtime(run_dir), os.path.getmtime(checkpoints_file))
+    return os.path.getmtime(run_dir)
+
+
+def digest_files(paths):
+    """Return a hexadecimal digest over the contents of all files in paths, in order."""
+    sha1 = hashlib.sha1()
+    for path in paths:
+        with open(path, mode='rb') as read_handle:
+            for chunk in iter(lambda: read_handle.read(1 << 20), ''):
+                sha1.update(chunk)
+        sha1.update('\0')
+    return sha1.hexdigest()
+
+
+def digest_step(step, *inputs):
+    """Return a hexadecimal digest over a step name and its inputs, which are digests of preceding steps & parameters.
+    Chaining step digests this way invalidates all later steps once any earlier step or parameter changes."""
+    return hashlib.sha1(json.dumps([step] + list(inputs))).hexdigest()
+
+
+class Checkpoints(object):
+    """Record the outputs of completed steps in a run directory, along with the digest of their inputs.
+
+    Outputs are stored as JSON, so tuples are returned as lists. Outputs referring to paths within the run directory are
+    only reused while those paths still exist."""
+
+    def __init__(self, run_dir):
+        self.run_dir = run_dir
+        self._checkpoints_file = os.path.join(run_dir, _CHECKPOINTS_FILE)
+        self._records = {}
+        if os.path.isfile(self._checkpoints_file):
+            with open(self._checkpoints_file) as read_handle:
+                self._records = json.load(read_handle)
+
+    def get(self, step, digest):
+        """Return the recorded outputs of step if completed for the same input digest, or None otherwise."""
+        record = self._records.get(step)
+        if record is None or record['digest'] != digest or not self._outputs_exist(record['outputs']):
+            return None
+        log.info('Resuming after completed step %s', step)
+        return record['outputs']
+
+    def record(self, step, digest, outputs):
+        """Record outputs of step for input digest, replacing the checkpoints file atomically."""
+        self._records[step] = {'digest': digest, 'outputs': outputs, 'completed': time.time()}
+        staging_file = tempfile.mkstemp(prefix='.checkpoints', dir=self.run_dir)[1]
+        with open(staging_file, mode='w') as write_handle:
+            json.dump(self._records, write_handle, indent=1, sort_keys=True)
+        os.rename(staging_file, self._checkpoints_file)
+
+    def run(self, step, digest, function, *args, **kwargs):
+        """Return the recorded outputs of step for digest, or call function with args to produce & record them."""
+        outputs = self.get(step, digest)
+        if outputs is not None:
+            return outputs
+        outputs = function(*args, **kwargs)
+        self.record(step, digest, outputs)
+        return outputs
+
+    def record_iterable(self, step, digest, iterable):
+        """Yield the items of iterable, and record them as outputs of step once iterable is exhausted."""
+        items = []
+        for item in iterable:
+            items.append(item)
+            yield item
+        self.record(step, digest, items)
+
+    def recorded(self, step):
+        """Return the outputs last recorded for step regardless of digest, or None if step never completed."""
+        record = self._records.get(step)
+        return record and record['outputs']
+
+    def _outputs_exist(self, outputs):
+        """Return True when all paths within the run directory referred to in outputs still exist."""
+        if isinstance(outputs, basestring):
+            return not outputs.startswith(self.run_dir + os.sep) or os.path.exists(outputs)
+        if isinstance(outputs, (list, tuple)):
+            return all(self._outputs_exist(output) for output in outputs)
+        if isinstance(outputs, dict):
+            return all(self._outputs_exist(output) for output in outputs.itervalues())
+        return True
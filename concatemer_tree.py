@@ -2,7 +2,7 @@
 """Module to create concatemer per genome of orthologs, create a phylogenetic tree and deduce taxa from that tree."""
 
 from Bio import AlignIO, Phylo, SeqIO
-from shared import create_directory, parse_options, extract_archive_of_files, create_archive_of_files
+from shared import create_directory, parse_options, extract_archive_of_files, create_archive_of_files, FastaWriter
 from select_taxa import select_genomes_by_ids
 from versions import DNADIST, NEIGHBOR
 from subprocess import Popen, PIPE, STDOUT
@@ -23,9 +23,10 @@ def coding_regions_per_genome(run_dir, trimmed_sicos):
     concatemer_dir = create_directory('coding_regions_per_genome', inside_dir=run_dir)
     log.info('Creating concatemers from {0} SICOs'.format(len(trimmed_sicos)))
 
-    # Collections both for output files and their write handles, which will be reused for each SICO
+    # Collections for output files, their write handles and fasta writers, which will be reused for each SICO
     coding_region_files = []
     write_handles = {}
+    fasta_writers = {}
 
     # Loop over trimmed sico files to append each sequence to the right concatemer
     for trimmed_sico in trimmed_sicos:
@@ -33,11 +34,11 @@ def coding_regions_per_genome(run_dir, trimmed_sicos):
             # Sample header line: >58191|NC_010067.1|YP_001569097.1|COG4948MR|core
             project_id = seqr.id.split('|')[0]
 
-            # Try to retrieve write handle from dictionary of cached write handles per genome
-            write_handle = write_handles.get(project_id)
+            # Try to retrieve fasta writer from dictionary of cached fasta writers per genome
+            fasta_writer = fasta_writers.get(project_id)
 
-            # If not found, create & store write handle on demand
-            if not write_handle:
+            # If not found, create & store write handle and fasta writer on demand
+            if not fasta_writer:
                 # Build up output file path for trimmed SICO genes per genome
                 coding_region_file = os.path.join(concatemer_dir, project_id + '.coding-regions.ffn')
                 coding_region_files.append(coding_region_file)
@@ -45,12 +46,15 @@ def coding_regions_per_genome(run_dir, trimmed_sicos):
                 # Open write handle
                 write_handle = open(coding_region_file, mode='w')
                 write_handles[project_id] = write_handle
+                fasta_writer = FastaWriter(write_handle)
+                fasta_writers[project_id] = fasta_writer
 
             # Write sequence record to coding-regions file
-            SeqIO.write(seqr, write_handle, 'fasta')
+            fasta_writer.write_record(seqr)
 
-    # Close genomes trimmed concatemer write handles
-    for write_handle in write_handles.values():
+    # Flush and close genomes trimmed concatemer write handles
+    for project_id, write_handle in write_handles.iteritems():
+        fasta_writers[project_id].flush()
         write_handle.close()
 
     log.info('Created %i genome coding regions files', len(coding_region_files))
@@ -91,10 +95,10 @@ def concatemer_per_genome(run_dir, genome_coding_regions_files):
 
 def create_super_concatemer(concatemer_files, destination_path):
     """Concatenate individual genome concatemers into a single super-concatemer for easy import into MEGA viewer."""
-    with open(destination_path, mode='w') as write_handle:
+    with open(destination_path, mode='w') as write_handle, FastaWriter(write_handle) as fasta_writer:
         for concatemer in concatemer_files:
             seqr = SeqIO.read(concatemer, 'fasta')
-            SeqIO.write(seqr, write_handle, 'fasta')
+            fasta_writer.write_record(seqr)
 
 
 def _run_dna_dist(run_dir, aligned_file):
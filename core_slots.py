@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+"""Module to share the cores of a host between concurrent runs, by handing out core budgets to the stages of each run.
+
+Each core of the host is represented by a slot file, which a stage holds an exclusive lock on while using that core.
+Locks are released when a stage completes, as well as when its process dies, so no cores are lost to failed runs. Stages
+that can not get their minimum number of cores queue up until other runs release enough cores. Unless asked for a number
+of cores explicitly, stages take a fair share of the cores, so concurrent runs are not serialised behind one another."""
+
+from contextlib import contextmanager
+from shared import create_directory
+import fcntl
+import logging as log
+import multiprocessing
+import os
+import tempfile
+import time
+
+
+__author__ = "Tim te Beek"
+__copyright__ = "Copyright 2011, Netherlands Bioinformatics Centre"
+__license__ = "MIT"
+
+# Seconds between attempts to reserve cores while the host is full
+POLL_INTERVAL = 5
+
+_QUEUE_FILE = 'queue.lock'
+
+# Stages holding or waiting for cores each hold a lock on a stage file, so stages can count each other
+_STAGE_PREFIX = 'stage_'
+
+
+def _get_slots_dir():
+    """Return the directory holding the core slots of this host, which can be configured through the core_slots
+    environment variable, and otherwise defaults to a directory within the local cache. The directory should not be
+    shared between hosts."""
+    if 'core_slots' in os.environ:
+        return create_directory('', inside_dir=os.environ['core_slots'])
+    return create_directory('core-slots')
+
+
+@contextmanager
+def reserve_cores(wanted=None, minimum=1, slots_dir=None, cores=None):
+    """Reserve up to wanted cores of the host, and yield the number of cores reserved as the budget for the stage run
+    within this context. Without wanted, reserve a fair share of the cores, split evenly between this stage and the
+    stages of other runs holding or waiting for cores. Wait while fewer than minimum cores are free, queued behind
+    stages of other runs that started waiting earlier."""
+    cores = cores or multiprocessing.cpu_count()
+    minimum = min(minimum, wanted or cores, cores)
+    slots_dir = slots_dir or _get_slots_dir()
+
+    handles = []
+    stage_handle = tempfile.NamedTemporaryFile(prefix=_STAGE_PREFIX, suffix='.lock', dir=slots_dir)
+    try:
+        fcntl.flock(stage_handle, fcntl.LOCK_EX)
+
+        # Only the first stage in the queue attempts to reserve cores, so stages waiting for many cores are not starved
+        with open(os.path.join(slots_dir, _QUEUE_FILE), mode='a') as queue_handle:
+            fcntl.flock(queue_handle, fcntl.LOCK_EX)
+            waiting_since = None
+            while True:
+                # Determine the fair share anew on each attempt, as other runs might have completed in the meantime
+                share = wanted or max(cores // (_count_other_stages(slots_dir, stage_handle.name) + 1), minimum)
+                handles.extend(_lock_free_slots(slots_dir, cores, max(min(share, cores) - len(handles), 0)))
+                if minimum <= len(handles):
+                    break
+                if waiting_since is None:
+                    log.info('Waiting for %i cores, while other runs use %i out of %i cores', minimum - len(handles),
+                             cores - len(handles), cores)
+                    waiting_since = time.time()
+                time.sleep(POLL_INTERVAL)
+            if waiting_since is not None:
+                log.info('Waited %.0f seconds for cores', time.time() - waiting_since)
+
+        log.info('Reserved %i out of %i cores', len(handles), cores)
+        yield len(handles)
+    finally:
+        for handle in handles:
+            handle.close()
+        stage_handle.close()
+
+
+def _count_other_stages(slots_dir, stage_file):
+    """Return the number of stages other than the one holding stage_file, that hold or wait for cores in slots_dir."""
+    count = 0
+    for name in os.listdir(slots_dir):
+        path = os.path.join(slots_dir, name)
+        if not name.startswith(_STAGE_PREFIX) or path == stage_file:
+            continue
+        try:
+            handle = open(path)
+        except IOError:
+            # Stage completed just now
+            continue
+        with handle:
+            try:
+                fcntl.flock(handle, fcntl.LOCK_SH | fcntl.LOCK_NB)
+            except IOError:
+                count += 1
+    return count
+
+
+def _lock_free_slots(slots_dir, cores, count):
+    """Lock up to count free slots of the cores slots in slots_dir, and return the open files holding those locks."""
+    handles = []
+    for index in range(cores):
+        if len(handles) == count:
+            break
+        handle = open(os.path.join(slots_dir, 'core_{0}.lock'.format(index)), mode='a')
+        try:
+            fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            handles.append(handle)
+        except IOError:
+            # Slot is in use by another stage, or by this stage already
+            handle.close()
+    return handles
@@ -11,9 +11,10 @@ import sys
 import tempfile
 
 import logging as log
+from orthomcl_groups import read_groups
 from select_taxa import select_genomes_by_ids
 from shared import create_directory, extract_archive_of_files, create_archive_of_files, parse_options, \
-    get_most_recent_gene_name, find_cogs_in_sequence_records
+    get_most_recent_gene_name, find_cogs_in_sequence_records, FastaWriter
 
 
 __author__ = "Tim te Beek"
@@ -80,10 +81,11 @@ def _append_orfans_to_heatmap(orfans_file, genomes, heatmap_file):
             append_handle.write('\n')
 
 
-def extract_orthologs(run_dir, genomes, dna_files, groups_file, require_limiter=False):
+def extract_orthologs(run_dir, genomes, dna_files, groups_file, require_limiter=False, groups_index=None):
     """Extract DNA sequences for SICO, MUCO & partially shared orthologs to a single file per ortholog."""
     # Subdivide orthologs into groups
-    shared_single_copy, shared_multi_copy, accessory = _extract_shared_orthologs(genomes, groups_file, require_limiter)
+    shared_single_copy, shared_multi_copy, accessory = _extract_shared_orthologs(genomes, groups_file, require_limiter,
+                                                                                 groups_index)
 
     # Extract fasta files per orthologs
     sico_files, muco_files, accessory_files, nr_of_seqs, orfans_file = \
@@ -106,29 +108,22 @@ def extract_orthologs(run_dir, genomes, dna_files, groups_file, require_limiter=
     return sico_files, muco_files, accessory_files, stats_file, heatmap_file, orfans_file
 
 
-def _create_ortholog_dictionaries(groups_file):
+def _create_ortholog_dictionaries(groups_file, groups_index=None):
     """Convert groups file into a list of ortholog dictionaries, which map project_id to their associated proteins."""
-    # Sample line: 58017|YP_219088.1 58191|YP_001572431.1 59431|YP_002149136.1
     ortholog_proteins_per_genome = []
-    with open(groups_file) as read_handle:
-        for line in read_handle:
-            remainder = line.split()
-            proteins_per_genome = {}
-            for ortholog in remainder:
-                # Sample: 58017|YP_219088.1
-                project_id, protein_id = ortholog.split('|')
-                # Use dict().get(key, fallback_value) here to retrieve and assign valid array values for missing keys
-                proteins_per_genome[project_id] = proteins_per_genome.get(project_id, [])
-                proteins_per_genome[project_id].append(protein_id)
-            # Assign proteins per genome dictionary to orthologs per group as
-            ortholog_proteins_per_genome.append(proteins_per_genome)
+    for group in read_groups(groups_file, groups_index):
+        proteins_per_genome = {}
+        for project_id, protein_id in group:
+            proteins_per_genome.setdefault(project_id, []).append(protein_id)
+        # Assign proteins per genome dictionary to orthologs per group as
+        ortholog_proteins_per_genome.append(proteins_per_genome)
     return ortholog_proteins_per_genome
 
 
-def _extract_shared_orthologs(selected_genome_ids, groups_file, require_limiter_presence=False):
+def _extract_shared_orthologs(selected_genome_ids, groups_file, require_limiter_presence=False, groups_index=None):
     """Filter orthologs to retain shared single and multiple copy orthologs from the collection of genomes."""
     log.info('Extracting shared orthologs for %d genomes from %s', len(selected_genome_ids), groups_file)
-    ortholog_proteins_per_genome = _create_ortholog_dictionaries(groups_file)
+    ortholog_proteins_per_genome = _create_ortholog_dictionaries(groups_file, groups_index)
 
     # Group orthologs into the following categories
     shared_single_copy = []
@@ -182,29 +177,40 @@ def _dna_file_per_sico(run_dir, dna_files, shared_single_copy, shared_multi_copy
     subset_files = set()
     number_of_sequences = 0
 
-    for dna_file in dna_files:
-        log.info('Extracting orthologous genes from %s', dna_file)
-        for record in SeqIO.parse(dna_file, 'fasta'):
-            number_of_sequences += 1
-
-            # Find record in each list of dictionaries, to append it to the corresponding ortholog files
-            aff_sico_files = _write_record_to_ortholog_file(sico_dir, shared_single_copy, record)
-            sico_files.update(aff_sico_files)
-            aff_muco_files = _write_record_to_ortholog_file(muco_dir, shared_multi_copy, record)
-            muco_files.update(aff_muco_files)
-            aff_nonsha_files = _write_record_to_ortholog_file(subset_dir, non_shared, record)
-            subset_files.update(aff_nonsha_files)
-
-            # ORFans do not fall into any of the above three categories: Add them to a separate file
-            if not aff_sico_files and not aff_muco_files and not aff_nonsha_files:
-                with open(orfans_file, mode='a') as write_handle:
-                    SeqIO.write(record, write_handle, 'fasta')
+    # ORFans are all written to the same file, so we can keep a single buffered writer open for all of them
+    with open(orfans_file, mode='a') as orfans_handle, FastaWriter(orfans_handle) as orfans_writer:
+        for dna_file in dna_files:
+            log.info('Extracting orthologous genes from %s', dna_file)
+            # Group the records of this genome per ortholog file, so each file is opened and written to only once
+            records_per_file = {}
+            for record in SeqIO.parse(dna_file, 'fasta'):
+                number_of_sequences += 1
+
+                # Find record in each list of dictionaries, to append it to the corresponding ortholog files
+                aff_sico_files = _find_ortholog_files(sico_dir, shared_single_copy, record)
+                sico_files.update(aff_sico_files)
+                aff_muco_files = _find_ortholog_files(muco_dir, shared_multi_copy, record)
+                muco_files.update(aff_muco_files)
+                aff_nonsha_files = _find_ortholog_files(subset_dir, non_shared, record)
+                subset_files.update(aff_nonsha_files)
+                for ortholog_file in chain(aff_sico_files, aff_muco_files, aff_nonsha_files):
+                    records_per_file.setdefault(ortholog_file, []).append(record)
+
+                # ORFans do not fall into any of the above three categories: Add them to a separate file
+                if not aff_sico_files and not aff_muco_files and not aff_nonsha_files:
+                    orfans_writer.write_record(record)
+
+            # Append to the ortholog files here to group the orthologs from various genomes in the same file
+            for ortholog_file, records in records_per_file.iteritems():
+                with open(ortholog_file, mode='a') as write_handle, FastaWriter(write_handle) as writer:
+                    for record in records:
+                        writer.write_record(record)
 
     return sorted(sico_files), sorted(muco_files), sorted(subset_files), number_of_sequences, orfans_file
 
 
-def _write_record_to_ortholog_file(directory, ortholog_dictionaries, record):
-    """Find sequence record in list of ortholog dictionaries, to write the record to corresponding ortholog file."""
+def _find_ortholog_files(directory, ortholog_dictionaries, record):
+    """Find sequence record in list of ortholog dictionaries, and return the corresponding ortholog files."""
     # Sample header line:    >58191|NC_010067.1|YP_001569097.1|COG4948MR|core
     # Corresponding ortholog: {'58191': ['YP_001569097.1'], ...}
     split_header = record.id.split('|')
@@ -218,16 +224,12 @@ def _write_record_to_ortholog_file(directory, ortholog_dictionaries, record):
         if project_id not in ortholog:
             continue
 
-        # Write header & sequence to ortholog file if protein ID is included in protein IDs mapped to by project_id
+        # Add ortholog file if protein ID is included in protein IDs mapped to by project_id
         if protein_id in ortholog[project_id]:
             # Create filename for the current ortholog, to which previous or further sequence records might also be added
             sico_file = os.path.join(directory, 'ortholog_{0:06}.ffn'.format(number))
             affected_ortholog_files.add(sico_file)
 
-            # Append to the MUCO files here to group the orthologs from various genomes in the same file
-            with open(sico_file, mode='a') as write_handle:
-                SeqIO.write(record, write_handle, 'fasta')
-
             # Can't rule out that a single protein is part of multiple orthologs, without intricate knowledge of OrthoMCL
             # Therefore continue looking for further occurrences of this protein in other orthologs
             continue
@@ -275,6 +277,7 @@ Usage: extract_orthologs.py
 --genomes=FILE       file with GenBank Project IDs from complete genomes table on each line
 --dna-zip=FILE       zip archive of extracted DNA files
 --groups=FILE        file listing groups of orthologous proteins
+--groups-index=FILE  index of the groups file written by run_orthomcl.py, to read groups from instead [OPTIONAL]
 --require-limiter    flag whether extracted core set of genomes should contain the limiter added in OrthoMCL [OPTIONAL]
 
 --sico-zip=FILE      destination file path for archive of shared single copy orthologous (SICO) genes
@@ -284,9 +287,9 @@ Usage: extract_orthologs.py
 --heatmap=FILE       destination file path heatmap of orthologs and occurrences of ortholog per genome
 --orfans=FILE        destination file path ORFans
 """
-    options = ['genomes', 'dna-zip', 'groups', 'require-limiter?',
+    options = ['genomes', 'dna-zip', 'groups', 'groups-index=?', 'require-limiter?',
                'sico-zip', 'muco-zip=?', 'subset-zip=?', 'stats', 'heatmap', 'orfans']
-    genome_ids_file, dna_zip, groups_file, require_limiter, \
+    genome_ids_file, dna_zip, groups_file, groups_index, require_limiter, \
         target_sico, target_muco, target_subset, target_stats_path, target_heat, target_orfans = \
         parse_options(usage, options, args)
 
@@ -303,17 +306,17 @@ Usage: extract_orthologs.py
 
     # Actually run ortholog extraction
     sico_files, muco_files, subset_files, stats_file, heatmap_file, orfans_file = \
-        extract_orthologs(run_dir, genomes, dna_files, groups_file, require_limiter)
+        extract_orthologs(run_dir, genomes, dna_files, groups_file, require_limiter, groups_index)
 
     # Append the orfans to the heatmap file
     _append_orfans_to_heatmap(orfans_file, genomes, heatmap_file)
 
-    # Move produced files to command line specified output paths
-    create_archive_of_files(target_sico, sico_files)
+    # Move produced files to command line specified output paths, uncompressed as these are intermediates
+    create_archive_of_files(target_sico, sico_files, 'stored')
     if target_muco:
-        create_archive_of_files(target_muco, muco_files)
+        create_archive_of_files(target_muco, muco_files, 'stored')
     if target_subset:
-        create_archive_of_files(target_subset, subset_files)
+        create_archive_of_files(target_subset, subset_files, 'stored')
     shutil.move(stats_file, target_stats_path)
     shutil.move(heatmap_file, target_heat)
     shutil.move(orfans_file, target_orfans)
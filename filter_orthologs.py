@@ -5,7 +5,7 @@ from __future__ import division
 from Bio import SeqIO
 from Bio.SeqRecord import SeqRecord
 from shared import create_directory, extract_archive_of_files, create_archive_of_files, parse_options, \
-    find_cogs_in_sequence_records
+    find_cogs_in_sequence_records, FastaWriter
 from compare_taxa import main as ctaxa_main
 from concatemer_tree import _run_dna_dist, _run_neighbor, _read_taxa_from_tree, main as ctree_main
 from crosstable_gene_ids import create_crosstable
@@ -69,7 +69,7 @@ def _assign_cog_to_sequences(fasta_file, cog, transfered_cogs):
     # Read all sequence records from file
     seqrecords = SeqIO.to_dict(SeqIO.parse(fasta_file, 'fasta')).values()
     # Write all sequence records back to the same(!) file
-    with open(fasta_file, mode='w') as write_handle:
+    with open(fasta_file, mode='w') as write_handle, FastaWriter(write_handle) as fasta_writer:
         with open(transfered_cogs, mode='a') as append_handle:
             for seqr in seqrecords:
                 # Sample header line: >58191|NC_010067.1|YP_001569097.1|COG4948MR|core
@@ -82,7 +82,7 @@ def _assign_cog_to_sequences(fasta_file, cog, transfered_cogs):
                     seqr = SeqRecord(seqr.seq, id='|'.join(split), description='')
                     # Append this COG transfer to append_handle
                     append_handle.write('\t'.join(split) + '\n')
-                SeqIO.write(seqr, write_handle, 'fasta')
+                fasta_writer.write_record(seqr)
 
 
 def _log_cog_statistics(cog_conflicts, cog_transferable, cog_missing):
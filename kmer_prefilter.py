@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+"""Module to prefilter the all-vs-all BLAST search space, by finding candidate pairs of protein sequences that share
+enough spaced seeds to be worth aligning."""
+
+from orthomcl_blast_parser import orthomcl_blast_parser
+from reciprocal_blast_local import iter_reciprocal_blast
+from shared import create_directory, parse_options, chain_files
+import logging as log
+import numpy
+import os
+import shutil
+import sys
+import tempfile
+
+
+__author__ = "Tim te Beek"
+__copyright__ = "Copyright 2011, Netherlands Bioinformatics Centre"
+__license__ = "MIT"
+
+# Spaced seed matched on the positions marked 1, allowing for substitutions on the positions marked 0
+DEFAULT_SEED = '1101011'
+
+_AMINO_ACIDS = 'ACDEFGHIKLMNPQRSTVWY'
+_UNKNOWN = len(_AMINO_ACIDS)
+_RESIDUE_CODES = numpy.empty(256, dtype=numpy.int64)
+_RESIDUE_CODES.fill(_UNKNOWN)
+for _index, _residue in enumerate(_AMINO_ACIDS):
+    _RESIDUE_CODES[ord(_residue)] = _RESIDUE_CODES[ord(_residue.lower())] = _index
+
+
+def find_candidate_pairs(fasta_files, seed=DEFAULT_SEED, min_shared=1, max_occurrences=200):
+    """Return a dictionary of each sequence id in fasta_files to the set of sequence ids it shares at least min_shared
+    distinct spaced seeds with, including itself.
+
+    Seeds are read at every position using the seed pattern, skipping seeds with unknown residues. Seeds occurring in
+    more than max_occurrences sequences are ignored, as such low complexity or highly repeated seeds would otherwise
+    make every pair of sequences a candidate."""
+    ids, sequences = _read_sequences(fasta_files)
+
+    # Inverted index of distinct seeds to the sequences they occur in, as sorted arrays of seed codes & sequence indices
+    codes, indices = _index_spaced_seeds(sequences, seed)
+    order = numpy.lexsort((indices, codes))
+    codes, indices = codes[order], indices[order]
+    distinct = numpy.ones(len(codes), dtype=bool)
+    distinct[1:] = (codes[1:] != codes[:-1]) | (indices[1:] != indices[:-1])
+    codes, indices = codes[distinct], indices[distinct]
+
+    # Drop seeds shared by too many sequences, as well as seeds found in one sequence only
+    boundaries = numpy.flatnonzero(numpy.concatenate(([True], codes[1:] != codes[:-1], [True])))
+    occurrences = numpy.diff(boundaries)
+    keep = (2 <= occurrences) & (occurrences <= max_occurrences)
+
+    # Order seeds by decreasing number of occurrences, keeping the entries of each seed together
+    group_order = numpy.argsort(-occurrences[keep], kind='mergesort')
+    sizes = occurrences[keep][group_order]
+    starts = boundaries[:-1][keep][group_order]
+    within = numpy.arange(sizes.sum()) - numpy.repeat(numpy.cumsum(sizes) - sizes, sizes)
+    entries = numpy.repeat(starts, sizes) + within
+    codes, indices = codes[entries], indices[entries]
+    ends = numpy.cumsum(sizes)
+
+    # Count shared seeds per pair, by comparing each entry with the entries following it within the same seed. Only
+    # seeds with more occurrences than offset can contribute, which form a shrinking prefix of the ordered entries
+    pair_keys = []
+    for offset in range(1, sizes[0] if len(sizes) else 0):
+        limit = ends[numpy.searchsorted(-sizes, -offset) - 1]
+        same = numpy.flatnonzero(codes[offset:limit] == codes[:limit - offset])
+        pair_keys.append(indices[same] * len(ids) + indices[same + offset])
+    candidates = dict((seq_id, set([seq_id])) for seq_id in ids)
+    if pair_keys:
+        keys, shared = numpy.unique(numpy.concatenate(pair_keys), return_counts=True)
+        for key in keys[min_shared <= shared]:
+            seq_a, seq_b = ids[key // len(ids)], ids[key % len(ids)]
+            candidates[seq_a].add(seq_b)
+            candidates[seq_b].add(seq_a)
+
+    pairs = sum(len(subjects) for subjects in candidates.itervalues())
+    log.info('Prefilter kept %i out of %i pairs of %i sequences', pairs, len(ids) ** 2, len(ids))
+    return candidates
+
+
+def _read_sequences(fasta_files):
+    """Return lists of the sequence ids & sequences in fasta_files, reading ids as the first word of headers."""
+    ids = []
+    sequences = []
+    with chain_files(fasta_files) as read_handle:
+        lines = []
+        for line in read_handle:
+            if line.startswith('>'):
+                if ids:
+                    sequences.append(''.join(lines))
+                    lines = []
+                ids.append(line[1:].split()[0])
+            else:
+                lines.append(line.strip())
+        if ids:
+            sequences.append(''.join(lines))
+    return ids, sequences
+
+
+def _index_spaced_seeds(sequences, seed):
+    """Return arrays of the codes of all spaced seeds in sequences, and the indices of the sequences they occur in."""
+    offsets = [offset for offset, value in enumerate(seed) if value == '1']
+    span = len(seed)
+
+    # Encode all sequences as one array, separated by unknown residues so no seed spans two sequences
+    residues = _RESIDUE_CODES[numpy.frombuffer(chr(0).join(sequences) + chr(0) * span, dtype=numpy.uint8)]
+    lengths = numpy.array([len(sequence) + 1 for sequence in sequences], dtype=numpy.int64)
+    sequence_indices = numpy.repeat(numpy.arange(len(sequences), dtype=numpy.int64), lengths)
+
+    # Combine residues at seed offsets into a single code per position, tracking seeds that include unknown residues
+    positions = len(sequence_indices)
+    codes = numpy.zeros(positions, dtype=numpy.int64)
+    unknown = numpy.zeros(positions, dtype=bool)
+    for offset in offsets:
+        window = residues[offset:offset + positions]
+        codes = codes * _UNKNOWN + window
+        unknown |= window == _UNKNOWN
+    return codes[~unknown], sequence_indices[~unknown]
+
+
+def prefilter_recall(candidates, similar_seqs_file, evalue_exponent=-5, percent_match=50):
+    """Return the fraction of inter sequence BLAST hits in similar_seqs_file that pass the OrthoMCL evalue exponent &
+    percent match cutoffs, and that are also candidate pairs, along with the number of such hits."""
+    found = 0
+    total = 0
+    with open(similar_seqs_file) as read_handle:
+        for line in read_handle:
+            values = line.split('\t')
+            if values[0] == values[1] or evalue_exponent < int(values[5]) or float(values[7]) < percent_match:
+                continue
+            total += 1
+            if values[1] in candidates.get(values[0], ()):
+                found += 1
+    return (float(found) / total if total else 1.), total
+
+
+def evalue_drift(full_hits_files, prefiltered_hits_files):
+    """Return the median and maximum ratio of evalues found by a prefiltered BLAST to those found by a full BLAST, over
+    the best hits of pairs of sequences found by both with non-zero evalues, along with the number of such pairs. The
+    ratios differ from one because blast derives the effective search space from the number of database sequences."""
+    full = _read_best_evalues(full_hits_files)
+    ratios = []
+    for pair, evalue in _read_best_evalues(prefiltered_hits_files).iteritems():
+        if evalue and full.get(pair):
+            ratios.append(evalue / full[pair])
+    if not ratios:
+        return 1., 1., 0
+    return float(numpy.median(ratios)), max(ratios), len(ratios)
+
+
+def _read_best_evalues(hits_files):
+    """Return a dictionary of pairs of query and subject ids to the lowest evalue of their hits in hits_files."""
+    best = {}
+    with chain_files(hits_files) as read_handle:
+        for line in read_handle:
+            values = line.split('\t')
+            pair = values[0], values[1]
+            evalue = float(values[10])
+            if pair not in best or evalue < best[pair]:
+                best[pair] = evalue
+    return best
+
+
+def main(args):
+    """Main function called when run from command line or as part of pipeline."""
+    usage = """
+Usage: kmer_prefilter.py
+--fasta-dir=DIR      directory of OrthoMCL compliant taxon.fasta files
+--hits=FILE,...      comma separated BLAST hits files in tabular format from a full all-vs-all BLAST of the fasta files
+--report=FILE        destination file for a recall report of the prefilter for various minimum numbers of shared seeds
+--seed=PATTERN       optional spaced seed pattern of ones and zeros [default: 1101011]
+--good-proteins=FILE optional good proteins the full BLAST searched, to also BLAST only the candidate pairs and report
+                     how far their evalues drift from those of the full BLAST [OPTIONAL]
+"""
+    options = ['fasta-dir', 'hits', 'report', 'seed=?', 'good-proteins=?']
+    fasta_dir, hits_files, target_report, seed, good_proteins = parse_options(usage, options, args)
+    fasta_files = [os.path.join(fasta_dir, name) for name in sorted(os.listdir(fasta_dir)) if not name.startswith('.')]
+
+    # Parse the full BLAST hits once, to then compare candidates against
+    run_dir = tempfile.mkdtemp(prefix='kmer_prefilter_')
+    try:
+        similar_sequences = os.path.join(run_dir, 'similar_sequences.tsv')
+        orthomcl_blast_parser(hits_files.split(','), fasta_dir, similar_sequences)
+
+        with open(target_report, mode='w') as write_handle:
+            write_handle.write('min_shared\tcandidate_pairs\tall_pairs\tsearch_space\trecall\tpassing_hits'
+                               '\tevalue_ratio_median\tevalue_ratio_max\n')
+            for min_shared in (1, 2, 3, 4, 6, 8):
+                candidates = find_candidate_pairs(fasta_files, seed or DEFAULT_SEED, min_shared)
+                pairs = sum(len(subjects) for subjects in candidates.itervalues())
+                recall, passing = prefilter_recall(candidates, similar_sequences)
+                write_handle.write('{0}\t{1}\t{2}\t{3:.4f}\t{4:.4f}\t{5}'.format(
+                    min_shared, pairs, len(candidates) ** 2, float(pairs) / len(candidates) ** 2, recall, passing))
+
+                # Compare evalues of only blasting candidate pairs against those of the full BLAST
+                if good_proteins:
+                    hits_dir = create_directory('hits_{0}'.format(min_shared), inside_dir=run_dir)
+                    prefiltered = list(iter_reciprocal_blast(good_proteins, fasta_files, hits_dir,
+                                                             candidates=candidates))
+                    median, maximum, compared = evalue_drift(hits_files.split(','), prefiltered)
+                    log.info('Compared evalues of %i pairs found with at least %i shared seeds', compared, min_shared)
+                    write_handle.write('\t{0:.4f}\t{1:.4f}\n'.format(median, maximum))
+                else:
+                    write_handle.write('\t-\t-\n')
+    finally:
+        shutil.rmtree(run_dir)
+
+    # Exit after a comforting log message
+    log.info("Produced: \n%s", target_report)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
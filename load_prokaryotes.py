@@ -2,15 +2,18 @@
 """Module for the select taxa step."""
 
 import argparse
-from collections import defaultdict
 from csv import DictReader
 from datetime import datetime, timedelta
-from ftplib import FTP
+from ftplib import FTP, error_perm
+import hashlib
+import json
 import logging
+import marshal
 from operator import itemgetter
 import os
 import re
 import sys
+import tempfile
 import time
 
 from shared import create_directory
@@ -22,27 +25,134 @@ __license__ = "MIT"
 
 
 def _download_genomes_table():
-    '''Dowload the prokaryotes.txt genome table file from the NCBI FTP site, save a local copy and return contents.'''
+    '''Dowload the prokaryotes.txt genome table file from the NCBI FTP site, save a local copy and return contents.
+
+    When the local copy is over a day old, the remote size and modification time are checked first, and the table is
+    only downloaded again when either changed. Genomes added, modified or removed by a new table are logged, such that
+    caches derived from those genomes can invalidate just the affected entries through get_genome_changes.'''
     cache_dir = create_directory('')
     prokaryotes = 'prokaryotes.txt'
     output_file = os.path.join(cache_dir, prokaryotes)
 
-    # Only download when existing file is older than a day
+    # Only check for updates when existing file is older than a day
     time_between_downloads = 24 * 60 * 60
     if not os.path.isfile(output_file) or os.path.getmtime(output_file) < time.time() - time_between_downloads:
         # Login to FTP site
         ftp = FTP('ftp.ncbi.nlm.nih.gov')
         ftp.login(passwd='timtebeek+odose@gmail.com')
 
-        # Download ftp://ftp.ncbi.nlm.nih.gov/genomes/GENOME_REPORTS/prokaryotes.txt
-        from download_taxa_ncbi import _download_genome_file
-        _download_genome_file(ftp, '/genomes/GENOME_REPORTS', prokaryotes, cache_dir, datetime.now())
+        # Compare size and modification time of ftp://ftp.ncbi.nlm.nih.gov/genomes/GENOME_REPORTS/prokaryotes.txt
+        remote_dir = '/genomes/GENOME_REPORTS'
+        remote_stat = _get_remote_stat(ftp, remote_dir + '/' + prokaryotes)
+        stat_file = output_file + '.remote'
+        if os.path.isfile(output_file) and remote_stat is not None and remote_stat == _read_json(stat_file):
+            # Remote table is unchanged: Mark local copy as up to date so we do not check again for another day
+            logging.info('Remote %s unchanged since %s', prokaryotes, remote_stat['modified'])
+            os.utime(output_file, None)
+        else:
+            # Index local copy before it's replaced, so we can determine which genomes changed
+            old_index = _load_genomes_index(output_file)
+
+            # Download table
+            from download_taxa_ncbi import _download_genome_file
+            _download_genome_file(ftp, remote_dir, prokaryotes, cache_dir, datetime.now())
+
+            # Record changes and store index & remote size and modification time for the next comparison
+            new_index = _index_genomes_table(output_file)
+            if old_index is not None:
+                _log_genome_changes(old_index, new_index, os.path.join(cache_dir, 'prokaryotes.changes.txt'))
+            with open(output_file + '.index', mode='wb') as write_handle:
+                marshal.dump(new_index, write_handle)
+            if remote_stat is not None:
+                with open(stat_file, mode='w') as write_handle:
+                    json.dump(remote_stat, write_handle)
 
     # Read file and return content
     with open(output_file) as read_handle:
         return read_handle.read()
 
 
+def _get_remote_stat(ftp, remote_path):
+    '''Return dictionary with size and modification time of remote_path, or None when the server does not report both.'''
+    try:
+        size = ftp.size(remote_path)
+        # Response format: 213 20140608101530
+        modified = ftp.sendcmd('MDTM ' + remote_path).split()[1]
+    except (error_perm, IndexError) as err:
+        logging.warn('Could not determine size and modification time of %s: %s', remote_path, err)
+        return None
+    return {'size': size, 'modified': modified}
+
+
+def _read_json(json_file):
+    '''Return the contents of json_file, or None when it does not exist.'''
+    if not os.path.isfile(json_file):
+        return None
+    with open(json_file) as read_handle:
+        return json.load(read_handle)
+
+
+def _load_genomes_index(table_file):
+    '''Return the index for table_file stored by a previous download, or build it when missing. None if no table.'''
+    if not os.path.isfile(table_file):
+        return None
+    index_file = table_file + '.index'
+    if os.path.isfile(index_file) and os.path.getmtime(table_file) <= os.path.getmtime(index_file):
+        with open(index_file, mode='rb') as read_handle:
+            return marshal.load(read_handle)
+    return _index_genomes_table(table_file)
+
+
+def _index_genomes_table(table_file):
+    '''Map the trimmed Assembly Accession of each genome in table_file to a digest of its complete line.'''
+    index = {}
+    with open(table_file) as read_handle:
+        columns = read_handle.readline().lstrip('#').rstrip('\n').split('\t')
+        accession_column = columns.index('Assembly Accession')
+        for line in read_handle:
+            values = line.split('\t')
+            if len(values) <= accession_column:
+                continue
+            accession = re.sub('^GCA_0*', '', values[accession_column].strip())
+            index[accession] = hashlib.sha1(line).hexdigest()
+    return index
+
+
+def _log_genome_changes(old_index, new_index, changes_file):
+    '''Append genomes added, modified or removed between old_index and new_index to changes_file, one per line.'''
+    timestamp = datetime.now().strftime('%Y-%m-%dT%H:%M:%S')
+    changes = [(accession, 'removed') for accession in old_index if accession not in new_index]
+    for accession, digest in new_index.iteritems():
+        if accession not in old_index:
+            changes.append((accession, 'added'))
+        elif old_index[accession] != digest:
+            changes.append((accession, 'modified'))
+    changes.sort()
+
+    with open(changes_file, mode='a') as append_handle:
+        for accession, change in changes:
+            append_handle.write('{0}\t{1}\t{2}\n'.format(timestamp, change, accession))
+    logging.info('Genomes table changes: %d added, %d modified, %d removed',
+                 *[sum(1 for change in changes if change[1] == kind) for kind in ('added', 'modified', 'removed')])
+
+
+def get_genome_changes(since=None, changes_file=None):
+    '''Return dictionary mapping Assembly Accession to the last change (added, modified or removed) recorded for it
+    in updates to the genomes table, optionally limited to changes recorded after datetime since.'''
+    changes_file = changes_file or os.path.join(create_directory(''), 'prokaryotes.changes.txt')
+    changes = {}
+    if not os.path.isfile(changes_file):
+        return changes
+    # Timestamps are in ISO format, such that they can be compared as strings
+    since = since and since.strftime('%Y-%m-%dT%H:%M:%S')
+    with open(changes_file) as read_handle:
+        for line in read_handle:
+            timestamp, change, accession = line.rstrip('\n').split('\t')
+            if since is None or since < timestamp:
+                changes[accession] = change
+    return changes
+
+
 def _parse_genomes_table(require_refseq=False):
     """Parse table of genomes and return list of dictionaries with values per genome."""
     # Empty lists to hold column names and genome dictionaries
@@ -55,7 +165,7 @@ def _parse_genomes_table(require_refseq=False):
     # Reference    FTP Path    Pubmed ID
 
     # Split file into individual lines
-    contents = _parse_genomes_table.complete_genome_table
+    contents = _get_genomes_table()
     assert contents.startswith('#Organism/Name\t'), 'Unexpected file format:\n' + contents.split('\n')[0]
 
     # Some columns contain lists of values separated by a delimiter themselves: We'll split their values accordingly
@@ -125,57 +235,102 @@ def _parse_genomes_table(require_refseq=False):
     # Return the genome dictionaries
     return tuple(genomes)
 
-# Assign content returned from _download_genomes_table as default value for complete_genome_table, such that we can
-# override this value in tests
-_parse_genomes_table.complete_genome_table = _download_genomes_table()
-
-
-def _bin_using_keyfunctions(genomes, attributes=('Group', 'SubGroup', 'Organism/Name')):
-    """Bin genomes recursively according to attributes, returning nested dictionaries mapping keys to collections."""
-
-    # Get first keyfunction, and bin genomes by that keyfunction
-    bins = defaultdict(list)
-    # Loop over genomes to map each to the right group
-    for genome in genomes:
-        # Determine key from keyfunction
-        key = itemgetter(attributes[0])(genome)
-        # Add this genome to this colllection
-        bins[key].append(genome)
+# Content returned from _download_genomes_table is assigned to complete_genome_table on first use, such that importing
+# this module does not require network access, and we can override this value in tests
+_parse_genomes_table.complete_genome_table = None
 
-    # If there are further keyfunctions available, recursively bin groups identified by current bin function
-    if 1 < len(attributes):
-        for key, subset in bins.iteritems():
-            bins[key] = _bin_using_keyfunctions(subset, attributes[1:])
 
-    return [genome for key in sorted(bins.keys()) for genome in bins[key]]
+def _get_genomes_table():
+    """Return the contents of the genomes table, which is downloaded when first needed by this process."""
+    if _parse_genomes_table.complete_genome_table is None:
+        _parse_genomes_table.complete_genome_table = _download_genomes_table()
+    return _parse_genomes_table.complete_genome_table
 
 
-def get_complete_genomes(genomes=_parse_genomes_table()):
-    """Get tuples of Organism Name, GenBank Project ID & False, for input into Galaxy clade selection."""
-    # Bin genomes using the following key functions iteratively
-    sorted_genomes = _bin_using_keyfunctions(genomes)
+def _bin_using_keyfunctions(genomes, attributes=('Group', 'SubGroup', 'Organism/Name')):
+    """Order genomes by each of attributes in turn, retaining original order for genomes with equal attribute values.
+
+    A single stable sort on all attributes yields the same order as recursively binning the genomes per attribute."""
+    return sorted(genomes, key=itemgetter(*attributes))
+
+
+def get_complete_genomes(genomes=None, cache_dir=None):
+    """Get tuples of Organism Name, GenBank Project ID & False, for input into Galaxy clade selection. Without genomes
+    the tuples are served from the cached catalogue of all genomes in cache_dir."""
+    if genomes is None:
+        for entry in get_genome_catalogue(cache_dir=cache_dir):
+            yield entry
+        return
+    for entry in _build_catalogue(genomes):
+        yield entry[0], entry[1]
+
+
+def get_genome_catalogue(prefix=None, group=None, cache_dir=None):
+    """Return sorted tuples of Galaxy clade selection name and Assembly Accession, optionally limited to genomes whose
+    name or accession start with prefix, or whose Group or SubGroup equal group.
+
+    The catalogue is cached in cache_dir, which defaults to the directory of the genomes table, and rebuilt only when
+    the table or the current date change."""
+    contents = _get_genomes_table()
+    catalogue_key = '{0}\t{1}'.format(hashlib.sha1(contents).hexdigest(), datetime.today().date())
+
+    catalogue = get_genome_catalogue.cache.get(catalogue_key)
+    if catalogue is None:
+        catalogue_file = os.path.join(cache_dir or create_directory(''), 'prokaryotes.txt.catalogue')
+        if os.path.isfile(catalogue_file):
+            with open(catalogue_file, mode='rb') as read_handle:
+                stored_key, catalogue = marshal.load(read_handle)
+            if stored_key != catalogue_key:
+                catalogue = None
+        if catalogue is None:
+            catalogue = _build_catalogue(_parse_genomes_table())
+            # Write to a temporary file first, so concurrent page views never read a partially written catalogue
+            fd, catalogue_tmp = tempfile.mkstemp(dir=os.path.dirname(catalogue_file))
+            with os.fdopen(fd, 'wb') as write_handle:
+                marshal.dump((catalogue_key, catalogue), write_handle)
+            os.chmod(catalogue_tmp, 0o644)
+            os.rename(catalogue_tmp, catalogue_file)
+        get_genome_catalogue.cache = {catalogue_key: catalogue}
+
+    if prefix:
+        prefix = prefix.lower()
+        catalogue = [entry for entry in catalogue if entry[1].startswith(prefix) or entry[4].lower().startswith(prefix)]
+    if group:
+        catalogue = [entry for entry in catalogue if group in (entry[2], entry[3])]
+    return [(entry[0], entry[1]) for entry in catalogue]
+
+# Catalogue most recently loaded by this process, keyed by table digest and date
+get_genome_catalogue.cache = {}
+
+
+def _build_catalogue(genomes):
+    """Return sorted tuples of clade selection name, Assembly Accession, Group, SubGroup & Organism Name for genomes."""
+    # Determine the date limit for New! & Updated! labels once, rather than once per genome
+    day_limit = datetime.today() - timedelta(days=30)
 
-    for genome in sorted_genomes:
+    catalogue = []
+    for genome in _bin_using_keyfunctions(genomes):
         name = '{project} - {group} > {subgroup} > {firstname} > {fullname}'.format(
             project=genome['Assembly Accession'],
             group=genome['Group'],
             subgroup=genome['SubGroup'],
             firstname=genome['Organism/Name'].split()[0],
             fullname=genome['Organism/Name'])
-        labels = _get_labels(genome)
+        labels = _get_labels(genome, day_limit)
         if labels:
             name += ' - ' + labels
-
-        # Yield the composed name and the project ID
-        yield name, genome['Assembly Accession']
+        catalogue.append((name, genome['Assembly Accession'], genome['Group'], genome['SubGroup'],
+                          genome['Organism/Name']))
+    return catalogue
 
 
-def _get_labels(genome):
+def _get_labels(genome, day_limit=None):
     """Optionally return colored labels for genome based on a release date, modified date and genome size."""
     labels = ''
 
     # Add New! & Updated! labels by looking at release and updated dates in the genome dictionary
-    day_limit = datetime.today() - timedelta(days=30)
+    if day_limit is None:
+        day_limit = datetime.today() - timedelta(days=30)
 
     # Released date 01/27/2009
     released_date = genome['Release Date']
@@ -207,6 +362,10 @@ def _parse_args():
                         type=argparse.FileType('w'),
                         default=sys.stdout,
                         nargs='?')
+    parser.add_argument('--prefix',
+                        help='Only include genomes whose organism name or accession start with prefix')
+    parser.add_argument('--group',
+                        help='Only include genomes whose Group or SubGroup equal group')
     return parser.parse_args()
 
 
@@ -218,7 +377,7 @@ def main():
     args = _parse_args()
 
     # Write genomes to tabular file
-    genomes = get_complete_genomes()
+    genomes = get_genome_catalogue(args.prefix, args.group)
     for key, value in genomes:
         args.target.write('{}\t{}\n'.format(value, key))
     args.target.close()
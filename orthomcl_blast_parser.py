@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+"""Module to convert tabular BLAST hits into OrthoMCL similar sequences, as a streaming replacement for the Perl
+orthomclBlastParser."""
+
+from itertools import groupby
+from operator import itemgetter
+import logging as log
+import os
+import re
+
+from shared import chain_files
+
+
+__author__ = "Tim te Beek"
+__copyright__ = "Copyright 2011, Netherlands Bioinformatics Centre"
+__license__ = "MIT"
+
+
+def orthomcl_blast_parser(blast_files, fasta_files_dir, similar_seqs_file):
+    """Convert BLAST hits in m8 / outfmt 6 format from blast_files into similar_seqs_file, using the compliant fasta
+    files in fasta_files_dir for taxa and sequence lengths. Return the number of query-subject pairs written.
+
+    Hits are streamed from blast_files in turn, as if they were concatenated, with only the HSPs of the current query
+    and subject pair held in memory. As with orthomclBlastParser, all HSPs of a pair are expected to be consecutive."""
+    genes = _index_fasta_lengths(fasta_files_dir)
+    log.info('Indexed lengths of %i compliant sequences', len(genes))
+
+    pairs = 0
+    with chain_files(blast_files) as read_handle:
+        with open(similar_seqs_file, mode='w') as write_handle:
+            hits = (line.split() for line in read_handle if line.strip())
+            for (query_id, subject_id), hsps in groupby(hits, key=itemgetter(0, 1)):
+                write_handle.write(_similar_sequence(genes, query_id, subject_id, list(hsps)))
+                pairs += 1
+    log.info('Wrote %i similar sequences to %s', pairs, similar_seqs_file)
+    return pairs
+
+
+def _index_fasta_lengths(fasta_files_dir):
+    """Return a dictionary of sequence ids to taxon & sequence length for all taxon.fasta files in fasta_files_dir."""
+    genes = {}
+    for fasta_file in sorted(os.listdir(fasta_files_dir)):
+        if fasta_file.startswith('.'):
+            continue
+        match = re.match(r'^(\w+).fasta', fasta_file)
+        assert match, '{0} is not in taxon.fasta format'.format(fasta_file)
+        taxon = match.group(1)
+        with open(os.path.join(fasta_files_dir, fasta_file)) as read_handle:
+            gene, length = None, 0
+            for line in read_handle:
+                line = line.strip()
+                if not line:
+                    continue
+                if line.startswith('>'):
+                    if gene:
+                        genes[gene] = (taxon, length)
+                    gene, length = line[1:].split()[0], 0
+                else:
+                    length += len(line)
+            if gene:
+                genes[gene] = (taxon, length)
+    return genes
+
+
+def _similar_sequence(genes, query_id, subject_id, hsps):
+    """Return the similar sequences line for all HSPs of query_id against subject_id."""
+    query_taxon, query_length = genes[query_id]
+    subject_taxon, subject_length = genes[subject_id]
+    query_shorter = query_length < subject_length
+
+    # Evalue is taken from the first HSP, whereas identities and matched lengths are summed over all HSPs
+    evalue_mant, evalue_exp = _format_evalue(hsps[0][10])
+    total_identities = 0.
+    total_length = 0
+    spans = []
+    for hsp in hsps:
+        length = int(hsp[3])
+        total_identities += float(hsp[2]) * length
+        total_length += length
+        # Spans are on the shorter of the two sequences
+        spans.append((int(hsp[6]), int(hsp[7])) if query_shorter else (int(hsp[8]), int(hsp[9])))
+
+    percent_ident = int(total_identities / total_length * 10 + .5) / 10.
+    shorter_length = query_length if query_shorter else subject_length
+    percent_match = int(_non_overlapping_match_length(spans) / float(shorter_length) * 1000 + .5) / 10.
+    return '\t'.join((query_id, subject_id, query_taxon, subject_taxon, evalue_mant, evalue_exp,
+                      _format_number(percent_ident), _format_number(percent_match))) + '\n'
+
+
+def _format_evalue(evalue):
+    """Split evalue into the mantissa & exponent strings as formatted by orthomclBlastParser."""
+    if evalue.startswith('e'):
+        evalue = '1' + evalue
+    evalue_mant, evalue_exp = ('%.3e' % float(evalue)).split('e')
+    evalue_mant = re.sub(r'\.0+$', '', '%.2f' % float(evalue_mant))
+    evalue_exp = evalue_exp.replace('+', '', 1)
+    if evalue_exp == '00':
+        evalue_exp = '0'
+    return evalue_mant, evalue_exp
+
+
+def _non_overlapping_match_length(spans):
+    """Return the number of positions covered by any of the (possibly reversed) start & end spans."""
+    spans = sorted((start, end) if start < end else (end, start) for start, end in spans)
+    if not spans:
+        return 0
+    length = 0
+    start, end = spans[0]
+    for span_start, span_end in spans[1:]:
+        if span_end <= end:
+            # Contained within current span
+            continue
+        if span_start <= end:
+            # Overlaps with and extends current span
+            end = span_end
+        else:
+            # Gap between current span and this span
+            length += end - start + 1
+            start, end = span_start, span_end
+    return length + end - start + 1
+
+
+def _format_number(value):
+    """Format value the way Perl prints numbers, without trailing zeros."""
+    return '%.15g' % value
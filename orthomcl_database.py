@@ -1,15 +1,27 @@
 #!/usr/bin/env python
-"""Module to create, configure and dispose separate database instances for individual OrthoMCL runs."""
+"""Module to create, configure and dispose separate database instances for individual OrthoMCL runs.
+
+Runs lease an empty database from a pool of databases with the OrthoMCL schema already installed, and truncate it
+again when released, so individual runs neither interfere with each other nor need to create their own database. The
+pool is tracked in a table of leases on the MySQL server itself, so it is shared between processes and hosts. Leases
+expire when not renewed for as long as a failed run may still be resumed, so databases left leased by runs that died
+are reclaimed."""
 
 from ConfigParser import SafeConfigParser
 import MySQLdb
 import collections
 from datetime import datetime
 import os
+from itertools import islice
 import shutil
+from subprocess import check_call
+import tempfile
+import time
 
 import logging as log
+from checkpoints import RUN_MAX_AGE
 from shared import resource_filename
+from versions import ORTHOMCL_INSTALL_SCHEMA
 
 
 __author__ = "Tim te Beek"
@@ -19,9 +31,31 @@ __license__ = "MIT"
 
 Credentials = collections.namedtuple('Credentials', ['host', 'port', 'user', 'passwd'])
 
+# Released databases are kept for future runs, up to this many free databases
+DATABASE_POOL_SIZE = 4
+
+# Leases not renewed within this many seconds are reclaimed, as runs are only resumed for as long as they are kept
+LEASE_MAX_AGE = RUN_MAX_AGE
+
+# Databases still not ready this many seconds after being added to the pool were abandoned while being created
+LEASE_CREATE_TIMEOUT = 60 * 60
+
+# Database holding the table of leases of pooled databases
+_POOL_DATABASE = 'orthomcl_pool'
+
+# Number of similar sequences inserted per statement when loading, which keeps statements well within max_allowed_packet
+LOAD_BATCH_SIZE = 10000
+
+# Tables created by orthomclInstallSchema, which are truncated when a database is released; other tables are dropped
+_SCHEMA_TABLES = frozenset(['SimilarSequences', 'InParalog', 'Ortholog', 'CoOrtholog'])
+
 
 def _get_root_credentials():
-    """Retrieve MySQL credentials from orthomcl.config to an account that is allowed to create new databases."""
+    """Retrieve MySQL credentials from orthomcl.config to an account that is allowed to create new databases. The
+    credentials are parsed once per process."""
+    if hasattr(_get_root_credentials, 'credentials'):
+        return _get_root_credentials.credentials
+
     orthomcl_credentials_file = resource_filename(__name__, 'credentials/orthomcl.cfg')
 
     # Copy template config file to actual search path when file can not be found
@@ -41,23 +75,263 @@ def _get_root_credentials():
     if passwd == 'pass' and 'mysql_password' in os.environ:
         passwd = os.environ['mysql_password']
 
-    return Credentials(host, port, user, passwd)
+    _get_root_credentials.credentials = Credentials(host, port, user, passwd)
+    return _get_root_credentials.credentials
+
+
+def _get_admin_connection():
+    """Return the connection with root credentials of the current process, connecting or reconnecting as needed. The
+    connection is not shared with child processes, which get a connection of their own."""
+    connection = getattr(_get_admin_connection, 'connection', None)
+    if connection is not None and _get_admin_connection.pid == os.getpid():
+        try:
+            connection.ping()
+            return connection
+        except MySQLdb.OperationalError:
+            log.info('Reconnecting lost database connection')
+    host, port, user, passwd = _get_root_credentials()
+    connection = MySQLdb.connect(host=host, port=port, user=user, passwd=passwd)
+    connection.autocommit(True)
+    _get_admin_connection.connection = connection
+    _get_admin_connection.pid = os.getpid()
+    return connection
+
+
+def _execute(statement, parameters=None):
+    """Execute statement on the admin connection, and return the number of affected rows along with all result rows."""
+    cursor = _get_admin_connection().cursor()
+    try:
+        rowcount = cursor.execute(statement, parameters)
+        return rowcount, cursor.fetchall()
+    finally:
+        cursor.close()
+
+
+def _create_pool_table():
+    """Create the table of leases of pooled databases, unless it already exists."""
+    if getattr(_create_pool_table, 'created', False):
+        return
+    _execute('CREATE DATABASE IF NOT EXISTS ' + _POOL_DATABASE)
+    _execute('''CREATE TABLE IF NOT EXISTS {0}.leases (
+        id INT AUTO_INCREMENT PRIMARY KEY,
+        ready BOOL NOT NULL DEFAULT FALSE,
+        run_id VARCHAR(255) NULL,
+        leased_at DATETIME NULL) ENGINE=InnoDB'''.format(_POOL_DATABASE))
+    _create_pool_table.created = True
+
+
+def lease_database(run_id):
+    """Lease an empty database with the OrthoMCL schema installed from the pool for run_id, and return its name. A new
+    database is created when none are free."""
+    _create_pool_table()
+    _reap_expired_leases()
+
+    # Claim a free database atomically, as other processes might attempt to claim the same database
+    claimed = _execute('UPDATE {0}.leases SET run_id = %s, leased_at = NOW() WHERE ready AND run_id IS NULL LIMIT 1'
+                       .format(_POOL_DATABASE), (run_id,))[0]
+    if claimed:
+        rows = _execute('SELECT id FROM {0}.leases WHERE run_id = %s ORDER BY leased_at DESC LIMIT 1'
+                        .format(_POOL_DATABASE), (run_id,))[1]
+        dbname = _pooled_database_name(rows[0][0])
+        # Databases are truncated when released, but a process might have died before doing so
+        _truncate_database(dbname)
+        log.info('Leased pooled database %s for run %s', dbname, run_id)
+        return dbname
+
+    # Grow the pool with a new database, already leased to run_id
+    cursor = _get_admin_connection().cursor()
+    try:
+        cursor.execute('INSERT INTO {0}.leases (run_id, leased_at) VALUES (%s, NOW())'.format(_POOL_DATABASE),
+                       (run_id,))
+        lease_id = cursor.lastrowid
+    finally:
+        cursor.close()
+    dbname = _pooled_database_name(lease_id)
+    try:
+        _create_database(dbname)
+        _install_schema(dbname)
+    except Exception:
+        _drop_database(dbname)
+        _execute('DELETE FROM {0}.leases WHERE id = %s'.format(_POOL_DATABASE), (lease_id,))
+        raise
+    if not _execute('UPDATE {0}.leases SET ready = TRUE WHERE id = %s'.format(_POOL_DATABASE), (lease_id,))[0]:
+        raise AssertionError('Creating database {0} took so long it was reclaimed from the pool'.format(dbname))
+    log.info('Leased new pooled database %s for run %s', dbname, run_id)
+    return dbname
+
+
+def renew_lease(dbname, run_id):
+    """Renew the lease on pooled database dbname for run_id, and return whether dbname is still leased to run_id. Runs
+    renew their lease when resumed, as the lease might otherwise have expired and the database leased to another run."""
+    if not dbname.startswith(_pooled_database_name('')):
+        return True
+    _create_pool_table()
+    lease_id = _pooled_lease_id(dbname)
+    _execute('UPDATE {0}.leases SET leased_at = NOW() WHERE id = %s AND run_id = %s'.format(_POOL_DATABASE),
+             (lease_id, run_id))
+    # Check ownership separately, as MySQL does not count rows whose leased_at was already current as affected
+    return bool(_execute('SELECT id FROM {0}.leases WHERE id = %s AND run_id = %s'.format(_POOL_DATABASE),
+                         (lease_id, run_id))[1])
+
+
+def _reap_expired_leases():
+    """Return databases whose lease expired to the pool, and drop databases abandoned while being created, as left
+    behind by runs that died before recording or releasing their database."""
+    reaped = _execute('UPDATE {0}.leases SET run_id = NULL, leased_at = NULL WHERE ready AND run_id IS NOT NULL AND '
+                      'leased_at < NOW() - INTERVAL %s SECOND'.format(_POOL_DATABASE), (LEASE_MAX_AGE,))[0]
+    if reaped:
+        log.info('Reclaimed %i pooled databases with expired leases', reaped)
+
+    rows = _execute('SELECT id FROM {0}.leases WHERE NOT ready AND leased_at < NOW() - INTERVAL %s SECOND'
+                    .format(_POOL_DATABASE), (LEASE_CREATE_TIMEOUT,))[1]
+    for (lease_id,) in rows:
+        # Only the process that deletes the lease drops its database, as others might be reaping the same lease
+        if _execute('DELETE FROM {0}.leases WHERE id = %s AND NOT ready'.format(_POOL_DATABASE), (lease_id,))[0]:
+            log.info('Reclaiming pooled database %s abandoned while being created', _pooled_database_name(lease_id))
+            _drop_database(_pooled_database_name(lease_id))
+
+
+def release_database(dbname, run_id=None):
+    """Truncate a leased database and return it to the pool, or drop it when enough free databases are pooled. When
+    given run_id, dbname is only released while still leased to run_id, as an expired lease is reclaimed and might
+    since have been leased to another run."""
+    # Databases created outside of the pool are dropped
+    if not dbname.startswith(_pooled_database_name('')):
+        _drop_database(dbname)
+        return
+
+    _create_pool_table()
+    lease_id = _pooled_lease_id(dbname)
+    if run_id is not None and not _execute('SELECT id FROM {0}.leases WHERE id = %s AND run_id = %s'
+                                           .format(_POOL_DATABASE), (lease_id, run_id))[1]:
+        log.info('Not releasing database %s, as its lease for run %s expired', dbname, run_id)
+        return
+    free = _execute('SELECT COUNT(*) FROM {0}.leases WHERE ready AND run_id IS NULL'.format(_POOL_DATABASE))[1][0][0]
+    if DATABASE_POOL_SIZE <= free:
+        _drop_database(dbname)
+        _execute('DELETE FROM {0}.leases WHERE id = %s'.format(_POOL_DATABASE), (lease_id,))
+        return
+    _truncate_database(dbname)
+    _execute('UPDATE {0}.leases SET run_id = NULL, leased_at = NULL WHERE id = %s'.format(_POOL_DATABASE), (lease_id,))
+    log.info('Released database %s to the pool', dbname)
+
+
+def load_similar_sequences(dbname, similar_seqs_file, batch_size=LOAD_BATCH_SIZE):
+    """Load similar_seqs_file into the SimilarSequences table of dbname, as orthomclLoadBlast would, and return the
+    number of rows loaded.
+
+    Rows are streamed from similar_seqs_file and inserted in batches of batch_size rows through the admin connection.
+    Secondary indexes are dropped for the duration of the load and added again once all rows are in, as the tables
+    created by orthomclInstallSchema default to InnoDB, on which ALTER TABLE ... DISABLE KEYS has no effect."""
+    table = '{0}.SimilarSequences'.format(dbname)
+    insert = 'INSERT INTO {0} VALUES (%s, %s, %s, %s, %s, %s, %s, %s)'.format(table)
+    indexes = _get_secondary_indexes(dbname, 'SimilarSequences')
+    connection = _get_admin_connection()
+    cursor = connection.cursor()
+    rows = 0
+    started = time.time()
+    try:
+        cursor.execute('SET SESSION unique_checks = 0')
+        if indexes:
+            cursor.execute('ALTER TABLE {0} {1}'.format(table, ', '.join('DROP INDEX `{0}`'.format(name)
+                                                                            for name in indexes)))
+        with open(similar_seqs_file) as read_handle:
+            values = (line.rstrip('\n').split('\t') for line in read_handle if line.strip())
+            for batch in iter(lambda: list(islice(values, batch_size)), []):
+                cursor.executemany(insert, batch)
+                rows += len(batch)
+                log.debug('Loaded %i similar sequences at %.0f rows per second', rows,
+                          rows / max(time.time() - started, 1e-6))
+    finally:
+        # Add the indexes again even when loading fails, as the database is returned to the pool with its schema
+        if indexes:
+            log.info('Adding SimilarSequences indexes %s in %s', ', '.join(indexes), dbname)
+            cursor.execute('ALTER TABLE {0} {1}'.format(table, ', '.join(indexes.itervalues())))
+        cursor.execute('SET SESSION unique_checks = 1')
+        cursor.close()
+
+    elapsed = max(time.time() - started, 1e-6)
+    log.info('Loaded %i similar sequences into %s in %.1f seconds, at %.0f rows per second', rows, dbname, elapsed,
+             rows / elapsed)
+    return rows
+
+
+def _get_secondary_indexes(dbname, table):
+    """Return an ordered dictionary of the names of the secondary indexes of table in dbname to the ALTER TABLE clauses
+    that add them."""
+    rows = _execute('SELECT index_name, non_unique, column_name, sub_part FROM information_schema.statistics WHERE '
+                    'table_schema = %s AND table_name = %s AND index_name != \'PRIMARY\' ORDER BY index_name, '
+                    'seq_in_index', (dbname, table))[1]
+    columns = collections.OrderedDict()
+    unique = {}
+    for index_name, non_unique, column_name, sub_part in rows:
+        columns.setdefault(index_name, []).append('`{0}`'.format(column_name) +
+                                                  ('({0})'.format(sub_part) if sub_part else ''))
+        unique[index_name] = not int(non_unique)
+    return collections.OrderedDict(
+        (name, 'ADD {0}INDEX `{1}` ({2})'.format('UNIQUE ' if unique[name] else '', name, ', '.join(parts)))
+        for name, parts in columns.iteritems())
+
+
+def _pooled_database_name(lease_id):
+    """Return the name of the pooled database for lease_id."""
+    return 'orthomcl_pool_{0}'.format(lease_id)
+
+
+def _pooled_lease_id(dbname):
+    """Return the lease id of pooled database dbname."""
+    return int(dbname[len(_pooled_database_name('')):])
+
+
+def _truncate_database(dbname):
+    """Truncate the OrthoMCL schema tables in dbname, and drop any other tables left behind by orthomclPairs."""
+    rows = _execute('SELECT table_name FROM information_schema.tables WHERE table_schema = %s AND '
+                    'table_type = \'BASE TABLE\'', (dbname,))[1]
+    for (table,) in rows:
+        if table in _SCHEMA_TABLES:
+            _execute('TRUNCATE TABLE {0}.{1}'.format(dbname, table))
+        else:
+            _execute('DROP TABLE {0}.{1}'.format(dbname, table))
+
+
+def _install_schema(dbname):
+    """Create OrthoMCL schema in a Mysql database, using a temporary configuration file.
+
+    usage: orthomclInstallSchema config_file sql_log_file
+
+    NOTE: the database login in the config file must have update/insert/truncate privileges on the tables specified in
+    the config file."""
+    config_dir = tempfile.mkdtemp(prefix='orthomclInstallSchema_')
+    try:
+        config_file = get_configuration_file(config_dir, dbname, -5)
+        command = [ORTHOMCL_INSTALL_SCHEMA, config_file, os.path.join(config_dir, 'install_schema.log')]
+        log.info('Executing: %s', ' '.join(command))
+        check_call(command)
+    finally:
+        shutil.rmtree(config_dir)
+
+
+def _create_database(dbname):
+    """Create database dbname, and grant rights to the orthomcl user."""
+    dbhost, user = _get_root_credentials().host, _get_root_credentials().user
+    clhost = 'odose.nl' if dbhost not in ['127.0.0.1', 'localhost'] else dbhost
+    _execute('CREATE DATABASE ' + dbname)
+    _execute('GRANT ALL on {0}.* TO orthomcl@\'{1}\' IDENTIFIED BY \'pass\';'.format(dbname, clhost))
+    log.info('Created database %s as %s on %s', dbname, user, dbhost)
+
+
+def _drop_database(dbname):
+    """Drop database dbname if it exists."""
+    host, user = _get_root_credentials().host, _get_root_credentials().user
+    _execute('DROP DATABASE IF EXISTS ' + dbname)
+    log.info('Deleted database %s as %s from %s', dbname, user, host)
 
 
 def create_database():
     """Create database orthomcl_{random suffix}, grant rights to orthomcl user and return """
     # Build a unique URL using todays date
     dbname = 'orthomcl_{t.year}_{t.month}_{t.day}_at_{t.hour}_{t.minute}_{t.second}'.format(t=datetime.today())
-    dbhost, port, user, passwd = _get_root_credentials()
-    clhost = 'odose.nl' if dbhost not in ['127.0.0.1', 'localhost'] else dbhost
-    db_connection = MySQLdb.connect(host=dbhost, port=port, user=user, passwd=passwd)
-    cursor = db_connection.cursor()
-    cursor.execute('CREATE DATABASE ' + dbname)
-    cursor.execute('GRANT ALL on {0}.* TO orthomcl@\'{1}\' IDENTIFIED BY \'pass\';'.format(dbname, clhost))
-    db_connection.commit()
-    cursor.close()
-    db_connection.close()
-    log.info('Created database %s as %s on %s', dbname, user, dbhost)
+    _create_database(dbname)
     return dbname
 
 
@@ -89,11 +363,4 @@ oracleIndexTblSpc=NONE""".format(dbname=dbname, host=host, port=port, evalue_exp
 
 def delete_database(dbname):
     """Delete database after running OrthoMCL analysis."""
-    host, port, user, passwd = _get_root_credentials()
-    db_connection = MySQLdb.connect(host=host, port=port, user=user, passwd=passwd)
-    cursor = db_connection.cursor()
-    cursor.execute('DROP DATABASE ' + dbname)
-    db_connection.commit()
-    cursor.close()
-    db_connection.close()
-    log.info('Deleted database %s as %s from %s', dbname, user, host)
+    _drop_database(dbname)
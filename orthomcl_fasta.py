@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+"""Module to create OrthoMCL compliant fasta files and filter out poor proteins in a single pass per proteome, as a
+replacement for the Perl orthomclAdjustFasta and orthomclFilterFasta."""
+
+from multiprocessing import Pool
+import logging as log
+import os
+import re
+import shutil
+
+
+__author__ = "Tim te Beek"
+__copyright__ = "Copyright 2011, Netherlands Bioinformatics Centre"
+__license__ = "MIT"
+
+# Proteomes with a larger fraction of poor proteins are reported as suspicious, as by orthomclFilterFasta
+SUSPICIOUS_FRACTION = 0.1
+
+
+def orthomcl_adjust_filter_fasta(proteome_files, compliant_fasta_dir, good_file, poor_file, report_file, id_field=3,
+                                 min_length=10, max_percent_stop=20, workers=None):
+    """Write an OrthoMCL compliant taxon.fasta file for each of proteome_files into compliant_fasta_dir, and write their
+    proteins to either good_file or poor_file. Proteins are poor when shorter than min_length, or when more than
+    max_percent_stop percent of their residues are stop codons or other non letter characters. Proteomes with more than
+    10% poor proteins are listed in report_file, in the format of orthomclFilterFasta.
+
+    Proteomes are processed concurrently by a pool of workers, each reading its proteome only once. All files are
+    written at the given paths, without relying on the current working directory. Return the compliant fasta files in
+    the order of proteome_files, the (id, sequence) tuples of all poor proteins and the suspicious proteomes."""
+    # Write the good & poor proteins of each proteome to partial files, next to the files they are concatenated into
+    partials_dir = os.path.dirname(good_file)
+    tasks = [(proteome_file, compliant_fasta_dir, partials_dir, id_field, min_length, max_percent_stop)
+             for proteome_file in proteome_files]
+    pool = Pool(processes=workers)
+    try:
+        results = pool.map(_adjust_filter_proteome, tasks, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+    fasta_files = [result[0] for result in results]
+    duplicates = set(fasta_file for fasta_file in fasta_files if 1 < fasta_files.count(fasta_file))
+    assert not duplicates, 'Proteomes should have unique taxon codes, but found duplicates: {0}'.format(duplicates)
+
+    # Concatenate partial files in the order of proteome_files, so the output does not depend on which worker was first
+    for target, index in ((good_file, 1), (poor_file, 2)):
+        with open(target, mode='w') as write_handle:
+            for result in results:
+                with open(result[index]) as read_handle:
+                    shutil.copyfileobj(read_handle, write_handle)
+                os.remove(result[index])
+
+    # Report proteomes with too many poor proteins, with the highest fraction first
+    poor_proteins = [protein for result in results for protein in result[3]]
+    suspicious = sorted(((os.path.basename(result[0]), len(result[3]) / float(result[4])) for result in results
+                         if SUSPICIOUS_FRACTION < len(result[3]) / float(result[4])), key=lambda x: -x[1])
+    with open(report_file, mode='w') as write_handle:
+        if suspicious:
+            write_handle.write('\nProteomes with > 10% poor proteins:\n')
+            for fasta_file, fraction in suspicious:
+                write_handle.write('  {0}\t{1}%\n'.format(fasta_file, int(fraction * 100)))
+
+    log.info('Filtered %i poor out of %i proteins from %i proteomes', len(poor_proteins),
+             sum(result[4] for result in results), len(results))
+    return fasta_files, poor_proteins, suspicious
+
+
+def _adjust_filter_proteome(task):
+    """Adjust and filter a single proteome, returning the paths of its compliant, good & poor fasta files, along with
+    the (id, sequence) tuples of its poor proteins and its total number of proteins."""
+    proteome_file, compliant_fasta_dir, partials_dir, id_field, min_length, max_percent_stop = task
+
+    # Use first part of header of first entry as taxon code
+    with open(proteome_file) as read_handle:
+        first_header = next((line for line in read_handle if line.startswith('>')), None)
+    # If we failed to extract a taxon_code, proteome file must have been empty
+    assert first_header, 'Proteome file appears empty: ' + proteome_file
+    taxon_code = first_header[1:].split()[0].split('|')[0].replace('.', '_')
+
+    compliant_file = os.path.join(compliant_fasta_dir, taxon_code + '.fasta')
+    good_file = os.path.join(partials_dir, '.good_' + taxon_code + '.fasta')
+    poor_file = os.path.join(partials_dir, '.poor_' + taxon_code + '.fasta')
+    poor_proteins = []
+    proteins = 0
+    seen_ids = set()
+    with open(proteome_file) as read_handle, open(compliant_file, mode='w') as compliant_handle, \
+            open(good_file, mode='w') as good_handle, open(poor_file, mode='w') as poor_handle:
+
+        def _write_protein(header, lines):
+            """Write a protein to either the good or poor file, based on its length & percentage of stop codons."""
+            sequence = ''.join(line.rstrip('\n') for line in lines)
+            assert sequence, 'Zero length sequence in {0}: {1}'.format(proteome_file, header)
+            stops = len(sequence) - sum(1 for residue in sequence if residue.isalpha())
+            if len(sequence) < min_length or max_percent_stop < 100. * stops / len(sequence):
+                poor_handle.write(header)
+                poor_handle.writelines(lines)
+                poor_proteins.append((header[1:].strip(), sequence))
+            else:
+                good_handle.write(header)
+                good_handle.writelines(lines)
+
+        header, lines = None, []
+        for line in read_handle:
+            if line.startswith('>'):
+                if header:
+                    _write_protein(header, lines)
+                    proteins += 1
+                header, lines = _adjust_header(taxon_code, line, id_field, seen_ids, proteome_file), []
+                compliant_handle.write(header)
+            elif header:
+                lines.append(line if line.endswith('\n') else line + '\n')
+                compliant_handle.write(lines[-1])
+        if header:
+            _write_protein(header, lines)
+            proteins += 1
+
+    return compliant_file, good_file, poor_file, poor_proteins, proteins
+
+
+def _adjust_header(taxon_code, line, id_field, seen_ids, proteome_file):
+    """Return a compliant >taxon_code|id header for the definition line, with id taken from the 1-based id_field of
+    fields separated by spaces or pipes, as by orthomclAdjustFasta."""
+    definition = re.sub(r'\s*\|\s*', '|', re.sub(r'\s+', ' ', line[1:].lstrip()))
+    fields = re.split(r'[\s|]', definition)
+    assert id_field <= len(fields), 'No field {0} in definition line of {1}: {2}'.format(id_field, proteome_file, line)
+    seq_id = fields[id_field - 1]
+    assert seq_id not in seen_ids, 'Fasta file {0} contains a duplicate id: {1}'.format(proteome_file, seq_id)
+    seen_ids.add(seq_id)
+    return '>{0}|{1}\n'.format(taxon_code, seq_id)
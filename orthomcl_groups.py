@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+"""Module to write OrthoMCL groups files from MCL output, optionally along with a compact binary index of their groups,
+and to read those groups back in."""
+
+import hashlib
+import logging as log
+import marshal
+import os
+import tempfile
+
+
+__author__ = "Tim te Beek"
+__copyright__ = "Copyright 2011, Netherlands Bioinformatics Centre"
+__license__ = "MIT"
+
+
+def write_groups(mcl_output, groups_file, index_file=None):
+    """Rewrite mcl_output into groups_file in a single pass, re-replacing underscores with dots in the taxon codes that
+    were made compliant for OrthoMCL. When given an index_file, also write an index of the groups there, as a sequence
+    of marshalled tuples of (taxon, protein id) tuples per group followed by the SHA-1 digest of groups_file.
+
+    Files are written to staging files first, which are renamed once complete. Return the number of groups."""
+    targets = [groups_file] + ([index_file] if index_file else [])
+    staging_files = []
+    try:
+        for target in targets:
+            staging_fd, staging_file = tempfile.mkstemp(prefix='.groups', dir=os.path.dirname(os.path.abspath(target)))
+            os.close(staging_fd)
+            staging_files.append(staging_file)
+
+        # Taxon codes recur throughout, so translate each only once
+        taxa = {}
+        groups = 0
+        sha1 = hashlib.sha1()
+        with open(mcl_output) as read_handle, open(staging_files[0], mode='w') as write_handle, \
+                open(staging_files[-1] if index_file else os.devnull, mode='wb') as index_handle:
+            for line in read_handle:
+                members = []
+                for seqid in line.rstrip('\n').split('\t'):
+                    taxon, _, protein_id = seqid.partition('|')
+                    if taxon not in taxa:
+                        taxa[taxon] = taxon.replace('_', '.')
+                    members.append((taxa[taxon], protein_id))
+                line = '\t'.join('{0}|{1}'.format(*member) for member in members) + '\n'
+                write_handle.write(line)
+                sha1.update(line)
+                marshal.dump(tuple(members), index_handle)
+                groups += 1
+            # Close the index with the digest of the groups file, so an index that no longer matches is detected
+            # when read
+            marshal.dump(sha1.hexdigest(), index_handle)
+
+        # Rename the groups file last, so it is never newer than a complete index
+        for staging_file, target in reversed(zip(staging_files, targets)):
+            os.chmod(staging_file, 0644)
+            os.rename(staging_file, target)
+    except:
+        # Leave no staging files behind when reading, writing or renaming fails
+        for staging_file in staging_files:
+            if os.path.exists(staging_file):
+                os.remove(staging_file)
+        raise
+    log.info('Wrote %i groups to %s', groups, groups_file)
+    return groups
+
+
+def read_groups(groups_file, index_file=None):
+    """Return a list of groups in groups_file, each a list of (taxon, protein id) tuples. Groups are loaded from the
+    index_file written alongside groups_file when given and matching groups_file, and parsed from groups_file
+    otherwise."""
+    groups = _read_groups_index(groups_file, index_file) if index_file else None
+    if groups is not None:
+        return groups
+
+    # Sample line: 58017|YP_219088.1 58191|YP_001572431.1 59431|YP_002149136.1
+    with open(groups_file) as read_handle:
+        return [[tuple(seqid.split('|')) for seqid in line.split()] for line in read_handle]
+
+
+def _read_groups_index(groups_file, index_file):
+    """Return the groups in index_file, or None when there is no such index or it does not match groups_file."""
+    if not os.path.isfile(index_file):
+        return None
+    records = []
+    with open(index_file, mode='rb') as read_handle:
+        try:
+            while True:
+                records.append(marshal.load(read_handle))
+        except (EOFError, ValueError, TypeError):
+            pass
+    if not records or records[-1] != _digest_file(groups_file):
+        log.warn('Ignoring groups index %s, as it does not match %s', index_file, groups_file)
+        return None
+    return [list(group) for group in records[:-1]]
+
+
+def _digest_file(path):
+    """Return the hexadecimal SHA-1 digest of the contents of path."""
+    sha1 = hashlib.sha1()
+    with open(path, mode='rb') as read_handle:
+        for chunk in iter(lambda: read_handle.read(1 << 20), ''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
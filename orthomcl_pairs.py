@@ -0,0 +1,355 @@
+#!/usr/bin/env python
+"""Module to find OrthoMCL ortholog, in-paralog and co-ortholog pairs in an embedded SQLite database, as an in-process
+replacement for loading similar sequences into MySQL and running orthomclPairs & orthomclDumpPairsFiles."""
+
+import logging as log
+import math
+import os
+import sqlite3
+import struct
+
+from shared import create_directory
+
+
+__author__ = "Tim te Beek"
+__copyright__ = "Copyright 2011, Netherlands Bioinformatics Centre"
+__license__ = "MIT"
+
+# MySQL stores the evalue mantissa and percentages as single precision FLOAT columns in the OrthoMCL schema
+_FLOAT = struct.Struct('f')
+
+
+def _to_float32(value):
+    """Round value to single precision, as MySQL would when storing it in a FLOAT column."""
+    return _FLOAT.unpack(_FLOAT.pack(float(value)))[0]
+
+
+def _log10(value):
+    """Base 10 logarithm as used in orthomclPairs scores; the queries avoid calling this for zero mantissas."""
+    return math.log10(value)
+
+
+def orthomcl_pairs(run_dir, similar_seqs_file, evalue_exponent, percent_match_cutoff=50, database=':memory:'):
+    """Find pairs for OrthoMCL from similar_seqs_file, following the steps of orthomclPairs, and write the files that
+    orthomclDumpPairsFiles would write. Return mclInput, orthologs, inparalogs and coorthologs files.
+
+    BLAST similarities with an evalue exponent above evalue_exponent, or a percent match below percent_match_cutoff,
+    are ignored, as they would be through the evalueExponentCutoff and percentMatchCutoff configuration options."""
+    connection = sqlite3.connect(database)
+    try:
+        connection.create_function('log10', 1, _log10)
+        _load_similar_sequences(connection, similar_seqs_file)
+        cutoffs = {'evalue_exponent': int(evalue_exponent), 'percent_match': float(percent_match_cutoff)}
+        _find_orthologs(connection, cutoffs)
+        _find_inparalogs(connection, cutoffs)
+        _find_coorthologs(connection, cutoffs)
+        return _dump_pairs_files(connection, run_dir)
+    finally:
+        connection.close()
+
+
+def _load_similar_sequences(connection, similar_seqs_file):
+    """Load the tab separated output of orthomclBlastParser into an indexed SimilarSequences table."""
+    connection.execute('''
+create table SimilarSequences (
+ query_id text,
+ subject_id text,
+ query_taxon_id text,
+ subject_taxon_id text,
+ evalue_mant real,
+ evalue_exp integer,
+ percent_identity real,
+ percent_match real)''')
+
+    def _rows():
+        """Yield typed rows from similar_seqs_file."""
+        with open(similar_seqs_file) as read_handle:
+            for line in read_handle:
+                values = line.rstrip('\n').split('\t')
+                assert len(values) == 8, 'Expected eight columns in similar sequences line: ' + line
+                yield (values[0], values[1], values[2], values[3],
+                       _to_float32(values[4]), int(values[5]), _to_float32(values[6]), _to_float32(values[7]))
+
+    connection.executemany('insert into SimilarSequences values (?, ?, ?, ?, ?, ?, ?, ?)', _rows())
+    connection.execute('create index ss_qtaxexp_ix on SimilarSequences(query_id, subject_taxon_id, evalue_exp,'
+                       ' evalue_mant, query_taxon_id, subject_id)')
+    connection.execute('create index ss_seqs_ix on SimilarSequences(query_id, subject_id, evalue_exp, evalue_mant,'
+                       ' percent_match)')
+    count = connection.execute('select count(*) from SimilarSequences').fetchone()[0]
+    log.info('Loaded %i similar sequences', count)
+
+
+# Scores are the average of -log10(evalue) in both directions. As log10(0) is undefined, zero mantissas instead use
+# the exponents, which orthomclBlastParser sets to zero for zero evalues. Note the division by a real -2.0, as SQLite
+# would otherwise apply integer division where MySQL does not
+_SCORE = '''
+case
+  when {0}.evalue_mant < {2} or {1}.evalue_mant < {2}
+  then ({0}.evalue_exp + {1}.evalue_exp) / -2.0
+  else (log10({0}.evalue_mant * {1}.evalue_mant) + {0}.evalue_exp + {1}.evalue_exp) / -2.0
+end'''
+
+
+def _find_orthologs(connection, cutoffs):
+    """Find reciprocal best hits between taxa, and normalize their scores by the average score per pair of taxa."""
+    # Best evalue per query and subject taxon, over all inter taxon matches regardless of cutoffs
+    connection.executescript('''
+create table BestQueryTaxonScore as
+select im.query_id, im.subject_taxon_id, low_exp.evalue_exp, min(im.evalue_mant) as evalue_mant
+from SimilarSequences im,
+     (select query_id, subject_taxon_id, min(evalue_exp) as evalue_exp
+      from SimilarSequences
+      where query_taxon_id != subject_taxon_id
+      group by query_id, subject_taxon_id) low_exp
+where im.query_id = low_exp.query_id
+  and im.subject_taxon_id = low_exp.subject_taxon_id
+  and im.evalue_exp = low_exp.evalue_exp
+  and im.query_taxon_id != im.subject_taxon_id
+group by im.query_id, im.subject_taxon_id, low_exp.evalue_exp;
+create unique index qtscore_ix on BestQueryTaxonScore(query_id, subject_taxon_id, evalue_exp, evalue_mant);
+''')
+
+    # Best hits per query and subject taxon that pass the cutoffs
+    connection.execute('''
+create table BestHit as
+select s.query_id, s.subject_id, s.query_taxon_id, s.subject_taxon_id, s.evalue_exp, s.evalue_mant
+from SimilarSequences s, BestQueryTaxonScore cutoff
+where s.query_id = cutoff.query_id
+  and s.subject_taxon_id = cutoff.subject_taxon_id
+  and s.query_taxon_id != s.subject_taxon_id
+  and s.evalue_exp <= {evalue_exponent}
+  and s.percent_match >= {percent_match}
+  and (s.evalue_mant < 0.01
+       or s.evalue_exp = cutoff.evalue_exp and s.evalue_mant = cutoff.evalue_mant)'''.format(**cutoffs))
+    connection.execute('create index best_hit_ix on BestHit(subject_id, query_id)')
+
+    # Reciprocal best hits form ortholog pairs
+    connection.execute('''
+create table OrthologTemp as
+select bh1.query_id as sequence_id_a, bh1.subject_id as sequence_id_b,
+       bh1.query_taxon_id as taxon_id_a, bh1.subject_taxon_id as taxon_id_b,
+       {0} as unnormalized_score
+from BestHit bh1, BestHit bh2
+where bh1.query_id < bh1.subject_id
+  and bh1.query_id = bh2.subject_id
+  and bh1.subject_id = bh2.query_id'''.format(_SCORE.format('bh1', 'bh2', 0.01)))
+
+    # Normalize by the average score of all orthologs between the same unordered pair of taxa
+    connection.executescript('''
+create table OrthologAvgScore as
+select min(taxon_id_a, taxon_id_b) as smaller_tax_id, max(taxon_id_a, taxon_id_b) as bigger_tax_id,
+       avg(unnormalized_score) as avg_score
+from OrthologTemp
+group by smaller_tax_id, bigger_tax_id;
+
+create table Ortholog as
+select ot.sequence_id_a, ot.sequence_id_b, ot.taxon_id_a, ot.taxon_id_b, ot.unnormalized_score,
+       ot.unnormalized_score / a.avg_score as normalized_score
+from OrthologTemp ot, OrthologAvgScore a
+where min(ot.taxon_id_a, ot.taxon_id_b) = a.smaller_tax_id
+  and max(ot.taxon_id_a, ot.taxon_id_b) = a.bigger_tax_id;
+create index ortholog_seq_a_ix on Ortholog(sequence_id_a, sequence_id_b);
+create index ortholog_seq_b_ix on Ortholog(sequence_id_b, sequence_id_a);
+''')
+    log.info('Found %i orthologs', connection.execute('select count(*) from Ortholog').fetchone()[0])
+
+
+def _find_inparalogs(connection, cutoffs):
+    """Find reciprocal better hits within taxa, than any hit to other taxa, and normalize their scores by the average
+    score of in-paralogs involving orthologs per taxon, or the average score of all in-paralogs for that taxon."""
+    # Best evalue per query to any other taxon
+    connection.executescript('''
+create table BestInterTaxonScore as
+select im.query_id, low_exp.evalue_exp, min(im.evalue_mant) as evalue_mant
+from BestQueryTaxonScore im,
+     (select query_id, min(evalue_exp) as evalue_exp
+      from BestQueryTaxonScore
+      group by query_id) low_exp
+where im.query_id = low_exp.query_id
+  and im.evalue_exp = low_exp.evalue_exp
+group by im.query_id, low_exp.evalue_exp;
+create unique index best_inter_taxon_ix on BestInterTaxonScore(query_id);
+''')
+
+    # Hits within the same taxon that are better than the best hit to other taxa, or any hit within the same taxon for
+    # queries without hits to other taxa
+    connection.execute('''
+create table BetterHit as
+select s.query_id, s.subject_id, s.query_taxon_id as taxon_id, s.evalue_exp, s.evalue_mant
+from SimilarSequences s, BestInterTaxonScore bis
+where s.query_id != s.subject_id
+  and s.query_taxon_id = s.subject_taxon_id
+  and s.query_id = bis.query_id
+  and s.evalue_exp <= {evalue_exponent}
+  and s.percent_match >= {percent_match}
+  and (s.evalue_mant < 0.001
+       or s.evalue_exp < bis.evalue_exp
+       or (s.evalue_exp = bis.evalue_exp and s.evalue_mant <= bis.evalue_mant))
+union
+select s.query_id, s.subject_id, s.query_taxon_id as taxon_id, s.evalue_exp, s.evalue_mant
+from SimilarSequences s
+where s.query_taxon_id = s.subject_taxon_id
+  and s.query_id != s.subject_id
+  and s.evalue_exp <= {evalue_exponent}
+  and s.percent_match >= {percent_match}
+  and s.query_id not in (select query_id from BestInterTaxonScore)'''.format(**cutoffs))
+    connection.execute('create index better_hit_ix on BetterHit(subject_id, query_id)')
+
+    # Reciprocal better hits form in-paralog pairs
+    connection.execute('''
+create table InParalogTemp as
+select bh1.query_id as sequence_id_a, bh1.subject_id as sequence_id_b, bh1.taxon_id,
+       {0} as unnormalized_score
+from BetterHit bh1, BetterHit bh2
+where bh1.query_id < bh1.subject_id
+  and bh1.query_id = bh2.subject_id
+  and bh1.subject_id = bh2.query_id'''.format(_SCORE.format('bh1', 'bh2', 0.01)))
+
+    # Normalize by the average score of in-paralogs where either sequence is an ortholog, falling back to the average
+    # score of all in-paralogs within the taxon when none of its in-paralogs are orthologs
+    connection.executescript('''
+create table OrthologUniqueId as
+select sequence_id_a as sequence_id from Ortholog
+union
+select sequence_id_b as sequence_id from Ortholog;
+create unique index ortholog_unique_id_ix on OrthologUniqueId(sequence_id);
+
+create table InParalogTaxonAvg as
+select taxon_id, avg(unnormalized_score) as average
+from InParalogTemp
+group by taxon_id;
+
+create table InParalogOrthologTaxonAvg as
+select taxon_id, avg(unnormalized_score) as average
+from InParalogTemp
+where sequence_id_a in (select sequence_id from OrthologUniqueId)
+   or sequence_id_b in (select sequence_id from OrthologUniqueId)
+group by taxon_id;
+
+create table InParalogAvgScore as
+select all_i.taxon_id, coalesce(orth_i.average, all_i.average) as avg_score
+from InParalogTaxonAvg all_i left outer join InParalogOrthologTaxonAvg orth_i on all_i.taxon_id = orth_i.taxon_id;
+
+create table InParalog as
+select it.sequence_id_a, it.sequence_id_b, it.taxon_id, it.unnormalized_score,
+       it.unnormalized_score / a.avg_score as normalized_score
+from InParalogTemp it, InParalogAvgScore a
+where it.taxon_id = a.taxon_id;
+''')
+    log.info('Found %i in-paralogs', connection.execute('select count(*) from InParalog').fetchone()[0])
+
+
+def _find_coorthologs(connection, cutoffs):
+    """Find pairs between taxa connected through in-paralogs and orthologs, which also hit one another in both
+    directions, and normalize their scores by the average ortholog & co-ortholog score per pair of taxa."""
+    # Candidates are in-paralogs of orthologs, and in-paralogs of in-paralogs of orthologs, that are not orthologs
+    connection.executescript('''
+create table InParalog2Way as
+select sequence_id_a, sequence_id_b from InParalog
+union
+select sequence_id_b as sequence_id_a, sequence_id_a as sequence_id_b from InParalog;
+create index inparalog2way_ix on InParalog2Way(sequence_id_b, sequence_id_a);
+create index inparalog2way_a_ix on InParalog2Way(sequence_id_a, sequence_id_b);
+
+create table Ortholog2Way as
+select sequence_id_a, sequence_id_b from Ortholog
+union
+select sequence_id_b as sequence_id_a, sequence_id_a as sequence_id_b from Ortholog;
+create index ortholog2way_ix on Ortholog2Way(sequence_id_a, sequence_id_b);
+
+create table CoOrthologCandidate as
+select distinct min(sequence_id_a, sequence_id_b) as sequence_id_a, max(sequence_id_a, sequence_id_b) as sequence_id_b
+from (select ip.sequence_id_a, o.sequence_id_b
+      from InParalog2Way ip, Ortholog2Way o
+      where ip.sequence_id_b = o.sequence_id_a
+      union
+      select ip1.sequence_id_a, ip2.sequence_id_b
+      from InParalog2Way ip1, Ortholog2Way o, InParalog2Way ip2
+      where ip1.sequence_id_b = o.sequence_id_a
+        and o.sequence_id_b = ip2.sequence_id_a);
+
+create table CoOrthNotOrtholog as
+select cc.sequence_id_a, cc.sequence_id_b
+from CoOrthologCandidate cc left outer join Ortholog o
+  on cc.sequence_id_a = o.sequence_id_a and cc.sequence_id_b = o.sequence_id_b
+where o.sequence_id_a is null;
+''')
+
+    # Candidates are co-orthologs when they hit one another in both directions within the cutoffs
+    connection.execute('''
+create table CoOrthologTemp as
+select candidate.sequence_id_a, candidate.sequence_id_b,
+       ab.query_taxon_id as taxon_id_a, ab.subject_taxon_id as taxon_id_b,
+       {0} as unnormalized_score
+from SimilarSequences ab, SimilarSequences ba, CoOrthNotOrtholog candidate
+where ab.query_id = candidate.sequence_id_a
+  and ab.subject_id = candidate.sequence_id_b
+  and ab.evalue_exp <= {1[evalue_exponent]}
+  and ab.percent_match >= {1[percent_match]}
+  and ba.query_id = candidate.sequence_id_b
+  and ba.subject_id = candidate.sequence_id_a
+  and ba.evalue_exp <= {1[evalue_exponent]}
+  and ba.percent_match >= {1[percent_match]}'''.format(_SCORE.format('ab', 'ba', 0.00001), cutoffs))
+
+    # Normalize by the average of the distinct co-ortholog and ortholog scores per unordered pair of taxa
+    connection.executescript('''
+create table CoOrthologAvgScore as
+select min(taxon_id_a, taxon_id_b) as smaller_tax_id, max(taxon_id_a, taxon_id_b) as bigger_tax_id,
+       avg(unnormalized_score) as avg_score
+from (select taxon_id_a, taxon_id_b, unnormalized_score from CoOrthologTemp
+      union
+      select taxon_id_a, taxon_id_b, unnormalized_score from Ortholog)
+group by smaller_tax_id, bigger_tax_id;
+
+create table CoOrtholog as
+select ct.sequence_id_a, ct.sequence_id_b, ct.taxon_id_a, ct.taxon_id_b, ct.unnormalized_score,
+       ct.unnormalized_score / a.avg_score as normalized_score
+from CoOrthologTemp ct, CoOrthologAvgScore a
+where min(ct.taxon_id_a, ct.taxon_id_b) = a.smaller_tax_id
+  and max(ct.taxon_id_a, ct.taxon_id_b) = a.bigger_tax_id;
+''')
+    log.info('Found %i co-orthologs', connection.execute('select count(*) from CoOrtholog').fetchone()[0])
+
+
+def _format_score(score):
+    """Round score to three decimals and format it the way Perl prints numbers in orthomclDumpPairsFiles."""
+    rounded = int(score * 1000 + .5) / 1000.
+    return ('%.3f' % rounded).rstrip('0').rstrip('.')
+
+
+def _dump_pairs_files(connection, run_dir):
+    """Write mclInput and the ortholog, in-paralog and co-ortholog pairs files, like orthomclDumpPairsFiles."""
+    mcl_dir = create_directory('mcl', inside_dir=run_dir)
+    out_dir = create_directory('orthologs', inside_dir=run_dir)
+    mclinput = os.path.join(mcl_dir, 'mclInput.tsv')
+    orthologs = os.path.join(out_dir, 'potentialOrthologs.tsv')
+    inparalogs = os.path.join(out_dir, 'potentialInparalogs.tsv')
+    coorthologs = os.path.join(out_dir, 'potentialCoorthologs.tsv')
+
+    # Pairs files hold the pairs per relationship type ordered by taxa
+    for table, pairs_file in (('Ortholog', orthologs), ('CoOrtholog', coorthologs)):
+        with open(pairs_file, mode='w') as write_handle:
+            for seq_a, seq_b, score in connection.execute('''
+select sequence_id_a, sequence_id_b, normalized_score from {0}
+order by taxon_id_a, taxon_id_b, normalized_score desc'''.format(table)):
+                write_handle.write('{0}\t{1}\t{2}\n'.format(seq_a, seq_b, _format_score(score)))
+    with open(inparalogs, mode='w') as write_handle:
+        for seq_a, seq_b, score in connection.execute('''
+select sequence_id_a, sequence_id_b, normalized_score from InParalog
+order by taxon_id, sequence_id_a, sequence_id_b'''):
+            write_handle.write('{0}\t{1}\t{2}\n'.format(seq_a, seq_b, _format_score(score)))
+
+    # The mcl input holds all pairs
+    with open(mclinput, mode='w') as write_handle:
+        for seq_a, seq_b, score in connection.execute('''
+select sequence_id_a, sequence_id_b, normalized_score from InParalog
+union
+select sequence_id_a, sequence_id_b, normalized_score from Ortholog
+union
+select sequence_id_a, sequence_id_b, normalized_score from CoOrtholog'''):
+            write_handle.write('{0}\t{1}\t{2}\n'.format(seq_a, seq_b, _format_score(score)))
+
+    # Assert mcl input file exists and has some content
+    assert os.path.isfile(mclinput) and 0 < os.path.getsize(mclinput), mclinput + ' should exist and have some content'
+
+    return mclinput, orthologs, inparalogs, coorthologs
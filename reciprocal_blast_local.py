@@ -1,12 +1,20 @@
 #!/usr/bin/env python
 """Module for the reciprocal blast step."""
 
+from functools import partial
+from itertools import groupby
+from multiprocessing.pool import ThreadPool
 from shared import create_directory, concatenate
 from versions import MAKEBLASTDB, BLASTN, BLASTP
-from subprocess import check_call, STDOUT
+from subprocess import CalledProcessError, check_call, Popen, PIPE, STDOUT
+import collections
+import fcntl
+import hashlib
+import heapq
 import logging as log
 import os
 import tempfile
+import threading
 import shutil
 
 __author__ = "Tim te Beek"
@@ -14,26 +22,109 @@ __copyright__ = "Copyright 2011, Netherlands Bioinformatics Centre"
 __license__ = "MIT"
 
 
-def reciprocal_blast(good_proteins_fasta, fasta_files):
-    """Create blast database for good_proteins_fasta, blast all fasta_files against this database & return hits."""
-    run_dir = tempfile.mkdtemp(prefix='reciprocal_blast_')
-
-    # Create blast database, retrieve path & name
-    db_dir, db_name = _create_blast_database(run_dir, good_proteins_fasta)
+def reciprocal_blast(good_proteins_fasta, fasta_files, hits_dir=None, workers=1, threads=1):
+    """Create blast database for good_proteins_fasta, blast all fasta_files against this database & return hits.
 
-    # Blast individual fasta files against the made blast databank, instead of the much larger good_proteins_fasta
-    x_vs_all_hits = [_blast_file_against_database(db_dir, db_name, fasta) for fasta in fasta_files]
+    Hits are concatenated into a single all-vs-all file, unless hits_dir is given: then the hits are written to separate
+    files in hits_dir, and the list of those files is returned instead. See iter_reciprocal_blast for workers & threads.
+    """
+    if hits_dir:
+        return list(iter_reciprocal_blast(good_proteins_fasta, fasta_files, hits_dir, workers, threads))
 
     # Concatenate the individual blast result files into one
+    hits_dir = tempfile.mkdtemp(prefix='reciprocal_blast_hits_')
     allvsall = tempfile.mkstemp(suffix='.tsv', prefix='all-vs-all_')[1]
-    concatenate(allvsall, x_vs_all_hits)
+    concatenate(allvsall, iter_reciprocal_blast(good_proteins_fasta, fasta_files, hits_dir, workers, threads))
 
     # Clean up
-    shutil.rmtree(run_dir)
+    shutil.rmtree(hits_dir)
 
     return allvsall
 
 
+def iter_reciprocal_blast(good_proteins_fasta, fasta_files, hits_dir, workers=1, threads=1, shards=None,
+                          candidates=None):
+    """Create blast database for good_proteins_fasta, blast all fasta_files against this database & yield hits files.
+
+    The sequences in fasta_files are split into shards of about equal size, two per worker by default. Shards are
+    blasted concurrently by workers blast processes, each using threads threads, largest shard first to minimise the
+    time spent waiting on the last shard. Hits files are yielded as soon as their shard finishes, so they can be
+    processed while other shards are still running. All hits of a query sequence end up in the same hits file.
+
+    When given a dictionary of candidates from query sequence ids to subject sequence ids, each shard is only blasted
+    against the candidate subjects of its query sequences, with -dbsize set to the number of residues in
+    good_proteins_fasta. Evalues do not exactly match those of a full run, as blast still derives the length adjustment
+    and effective search space from the far smaller number of sequences in the candidate database; see
+    cached_reciprocal_blast for the size of this effect, and the kmer_prefilter recall report to measure it."""
+    run_dir = tempfile.mkdtemp(prefix='reciprocal_blast_')
+    pool = None
+    lock_handle = None
+    processes = _BlastProcesses()
+    try:
+        if candidates is None:
+            # Retrieve path & name of blast database from the registry, which creates the database when not yet present
+            db_dir, db_name, lock_handle = _acquire_blast_database(good_proteins_fasta)
+            blast_shard = partial(_blast_file_against_database, db_dir, db_name, hits_dir=hits_dir, threads=threads,
+                                  processes=processes)
+        else:
+            offsets, dbsize = _index_fasta_offsets(good_proteins_fasta)
+            blast_shard = partial(_blast_shard_against_candidates, run_dir, good_proteins_fasta, offsets, dbsize,
+                                  candidates, hits_dir, threads, processes)
+
+        # Split query sequences into shards, instead of blasting the much larger good_proteins_fasta in one go
+        shard_dir = create_directory('shards', inside_dir=run_dir)
+        shard_files = _split_into_shards(fasta_files, shard_dir, shards or 2 * workers)
+
+        # Blast individual shards against the made blast databank
+        pool = ThreadPool(processes=workers)
+        for hits_file in pool.imap_unordered(blast_shard, shard_files):
+            yield hits_file
+    finally:
+        # Clean up, killing running blast processes and skipping any shards not yet started when the consumer of hits
+        # files stopped early or failed; terminate waits for the worker threads, so kill their processes first
+        processes.kill()
+        if pool is not None:
+            pool.terminate()
+        if lock_handle is not None:
+            lock_handle.close()
+        shutil.rmtree(run_dir)
+
+
+def _split_into_shards(fasta_files, shard_dir, shards):
+    """Split the sequence records in fasta_files over shards files in shard_dir, keeping the shards about equal in size
+    by appending each record to the smallest shard so far. Return the non-empty shard files, largest first."""
+    heap = [(0, index) for index in range(shards)]
+    shard_files = [os.path.join(shard_dir, 'shard{0}.fasta'.format(index)) for index in range(shards)]
+    write_handles = [open(shard_file, mode='w') for shard_file in shard_files]
+    try:
+        for fasta_file in fasta_files:
+            with open(fasta_file) as read_handle:
+                record = []
+                for line in read_handle:
+                    if line.startswith('>') and record:
+                        _write_to_smallest_shard(heap, write_handles, record)
+                        record = []
+                    record.append(line)
+                if record:
+                    _write_to_smallest_shard(heap, write_handles, record)
+    finally:
+        for write_handle in write_handles:
+            write_handle.close()
+
+    # Schedule largest shards first
+    sizes = sorted(((size, index) for size, index in heap if size), reverse=True)
+    log.info('Split %i sequence files into %i shards of %s bytes', len(fasta_files), len(sizes),
+             ', '.join(str(size) for size, _ in sizes))
+    return [shard_files[index] for _, index in sizes]
+
+
+def _write_to_smallest_shard(heap, write_handles, record):
+    """Write the lines of record to the smallest shard, and update its size on the heap of shard sizes and indices."""
+    size, index = heap[0]
+    write_handles[index].writelines(record)
+    heapq.heapreplace(heap, (size + sum(len(line) for line in record), index))
+
+
 def _create_blast_database(run_dir, fasta_file, nucleotide=False):
     """Create blast database"""
     assert os.path.exists(MAKEBLASTDB) and os.access(MAKEBLASTDB, os.X_OK), 'Could not find or run ' + MAKEBLASTDB
@@ -52,24 +143,476 @@ def _create_blast_database(run_dir, fasta_file, nucleotide=False):
     return db_dir, db_name
 
 
-def _blast_file_against_database(db_dir, blast_db, fasta_file, nucleotide=False):
-    """Blast all genes from genomes one and two against all genomes"""
+def _index_fasta_offsets(fasta_file):
+    """Return a dictionary of sequence ids in fasta_file to the offset & length of their record, along with the total
+    number of residues, which is the blast database size."""
+    offsets = {}
+    residues = 0
+    with open(fasta_file, mode='rb') as read_handle:
+        seq_id, start, offset = None, 0, 0
+        for line in read_handle:
+            if line.startswith('>'):
+                if seq_id:
+                    offsets[seq_id] = start, offset - start
+                seq_id, start = line[1:].split()[0], offset
+            else:
+                residues += len(line.strip())
+            offset += len(line)
+        if seq_id:
+            offsets[seq_id] = start, offset - start
+    return offsets, residues
+
+
+def _blast_shard_against_candidates(run_dir, fasta_file, offsets, dbsize, candidates, hits_dir, threads, processes,
+                                    shard_file):
+    """Blast shard_file against a database of the candidate subjects of its query sequences, taken from fasta_file.
+    Candidate databases are built within run_dir rather than the blast database registry, as they are specific to the
+    shard and would only push reusable databases out of the registry."""
+    subjects = set()
+    with open(shard_file) as read_handle:
+        for line in read_handle:
+            if line.startswith('>'):
+                subjects.update(candidates.get(line[1:].split()[0], ()))
+
+    # Create a database of only the candidate subjects, reading their records from the good proteins
+    shard_run_dir = tempfile.mkdtemp(prefix='candidates_', dir=run_dir)
+    subjects_file = os.path.join(shard_run_dir, 'candidates.fasta')
+    with open(fasta_file, mode='rb') as read_handle:
+        with open(subjects_file, mode='wb') as write_handle:
+            for start, length in sorted(offsets[subject] for subject in subjects if subject in offsets):
+                read_handle.seek(start)
+                write_handle.write(read_handle.read(length))
+    db_dir, db_name = _create_blast_database(shard_run_dir, subjects_file)
+    hits_file = _blast_file_against_database(db_dir, db_name, shard_file, hits_dir=hits_dir, threads=threads,
+                                             dbsize=dbsize, processes=processes)
+
+    # Drop hits between query and subject sequences that are candidates for other query sequences in the shard only,
+    # so the hits found do not depend on how query sequences were distributed over shards
+    filtered_file = os.path.join(shard_run_dir, 'hits.tsv')
+    with open(hits_file) as read_handle:
+        with open(filtered_file, mode='w') as write_handle:
+            for line in read_handle:
+                query_id, subject_id = line.split('\t', 2)[:2]
+                if subject_id in candidates.get(query_id, ()):
+                    write_handle.write(line)
+    shutil.move(filtered_file, hits_file)
+    return hits_file
+
+
+# Total size in bytes of blast databases kept in the registry, beyond which least recently used databases are evicted
+BLAST_DATABASE_REGISTRY_SIZE = 20 << 30
+
+
+def _get_blast_database_registry_dir():
+    """Return the blast database registry directory, which can be shared between nodes through the blast_databases
+    environment variable, and otherwise defaults to a directory within the local cache."""
+    if 'blast_databases' in os.environ:
+        return create_directory('', inside_dir=os.environ['blast_databases'])
+    return create_directory('blast-databases')
+
+
+def _acquire_blast_database(fasta_file, nucleotide=False, registry_dir=None):
+    """Return the directory & name of a blast database for fasta_file, along with an open lock file handle that holds a
+    shared lock on the database until closed. Databases are built once per distinct fasta_file and kept in the
+    registry, so repeat runs on the same proteins skip makeblastdb. Concurrent runs share databases through read locks,
+    while building and evicting a database take an exclusive lock."""
+    registry_dir = registry_dir or _get_blast_database_registry_dir()
+    digest = '{0}-{1}'.format(_hash_file(fasta_file), 'nucl' if nucleotide else 'prot')
+    entry_dir = os.path.join(registry_dir, digest)
+    lock_handle = _lock_registry_entry(entry_dir, fcntl.LOCK_SH)
+    try:
+        while not os.path.isdir(entry_dir):
+            # Upgrade to an exclusive lock to build the database, which another process might have done in between
+            fcntl.flock(lock_handle, fcntl.LOCK_EX)
+            if not _holds_registry_lock(lock_handle, entry_dir):
+                # The entry was evicted while upgrading, along with its lock file, so lock the entry anew
+                lock_handle.close()
+                lock_handle = _lock_registry_entry(entry_dir, fcntl.LOCK_SH)
+                continue
+            if not os.path.isdir(entry_dir):
+                staging_dir = tempfile.mkdtemp(prefix='.' + digest + '.', dir=registry_dir)
+                try:
+                    _create_blast_database(staging_dir, fasta_file, nucleotide)
+                    os.rename(staging_dir, entry_dir)
+                finally:
+                    if os.path.isdir(staging_dir):
+                        shutil.rmtree(staging_dir)
+            fcntl.flock(lock_handle, fcntl.LOCK_SH)
+            _evict_blast_databases(registry_dir, keep=digest)
+            break
+        # Mark the database as most recently used
+        os.utime(entry_dir, None)
+    except:
+        lock_handle.close()
+        raise
+    dbtype = 'nucl' if nucleotide else 'prot'
+    return os.path.join(entry_dir, 'blast'), 'my_{0}_blast_db'.format(dbtype), lock_handle
+
+
+def _lock_registry_entry(entry_dir, operation):
+    """Return an open handle of the lock file of registry entry_dir, locked with operation. Eviction removes the lock
+    file of an entry, so lock anew when the file was removed before the lock was granted."""
+    while True:
+        lock_handle = open(entry_dir + '.lock', mode='a')
+        try:
+            fcntl.flock(lock_handle, operation)
+        except:
+            lock_handle.close()
+            raise
+        if _holds_registry_lock(lock_handle, entry_dir):
+            return lock_handle
+        lock_handle.close()
+
+
+def _holds_registry_lock(lock_handle, entry_dir):
+    """Return whether lock_handle is still the lock file of registry entry_dir, rather than a file since removed."""
+    try:
+        return os.path.samestat(os.fstat(lock_handle.fileno()), os.stat(entry_dir + '.lock'))
+    except OSError:
+        return False
+
+
+def _evict_blast_databases(registry_dir, keep=None, max_size=None):
+    """Remove least recently used blast databases from registry_dir until their total size is within max_size, skipping
+    keep and any databases currently in use by other runs. Evicted databases are removed along with their lock file,
+    as are lock files left behind by databases that failed to build."""
+    max_size = BLAST_DATABASE_REGISTRY_SIZE if max_size is None else max_size
+    entries = []
+    for name in os.listdir(registry_dir):
+        entry_dir = os.path.join(registry_dir, name)
+        if name.endswith('.lock') and not os.path.isdir(entry_dir[:-len('.lock')]):
+            _remove_unused_lock(entry_dir[:-len('.lock')])
+            continue
+        if name.startswith('.') or not os.path.isdir(entry_dir):
+            continue
+        size = sum(os.path.getsize(os.path.join(root, filename))
+                   for root, _, filenames in os.walk(entry_dir) for filename in filenames)
+        entries.append((os.path.getmtime(entry_dir), name, size))
+    total = sum(size for _, _, size in entries)
+
+    # Evict least recently used first
+    for _, name, size in sorted(entries):
+        if total <= max_size:
+            break
+        if name == keep:
+            continue
+        entry_dir = os.path.join(registry_dir, name)
+        if _remove_unused_lock(entry_dir, size):
+            total -= size
+
+
+def _remove_unused_lock(entry_dir, size=0):
+    """Remove registry entry_dir if present along with its lock file, while holding an exclusive lock, and return True.
+    Return False when the entry is in use by another run. The lock file is removed while still locked, so processes
+    waiting on it lock the entry anew."""
+    try:
+        lock_handle = _lock_registry_entry(entry_dir, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError:
+        # Database is in use by another run
+        return False
+    with lock_handle:
+        if os.path.isdir(entry_dir):
+            log.info('Evicting blast database %s of %i bytes', os.path.basename(entry_dir), size)
+            shutil.rmtree(entry_dir)
+        os.remove(entry_dir + '.lock')
+    return True
+
+
+def _blast_file_against_database(db_dir, blast_db, fasta_file, nucleotide=False, hits_dir=None, threads=1,
+                                 dbsize=None, processes=None):
+    """Blast all genes from genomes one and two against all genomes, writing hits to db_dir unless hits_dir is given.
+    The blast process is tracked in processes when given, so it can be killed by the caller."""
     blast_program = BLASTN if nucleotide else BLASTP
     assert os.path.exists(blast_program) and os.access(blast_program, os.X_OK), 'Could not find or run ' + blast_program
 
     # Determine output file name
     basename = os.path.splitext(os.path.split(fasta_file)[1])[0]
-    hits_file = os.path.join(db_dir, basename + '-vs-all.tsv')
+    hits_file = os.path.join(hits_dir or db_dir, basename + '-vs-all.tsv')
 
     # Actually run the blast program
     command = [blast_program,
                '-db', blast_db,
                '-query', fasta_file,
                '-outfmt', str(6),
+               '-num_threads', str(threads),
                '-out', hits_file]
+    if dbsize:
+        command.extend(['-dbsize', str(dbsize)])
     log.info('Executing: %s', ' '.join(command))
-    check_call(command, cwd=db_dir, stdout=open('/dev/null', mode='w'), stderr=STDOUT)
+    (processes or _BlastProcesses()).check_call(command, cwd=db_dir)
 
     # Sanity check
     assert os.path.isfile(hits_file) and 0 < os.path.getsize(hits_file), hits_file + ' should exist with some content'
     return hits_file
+
+
+class _BlastProcesses(object):
+    """Track the blast processes started from the worker threads of a pool, so they can all be killed when the consumer
+    of their hits stops early or fails. Terminating a pool of threads does not stop the processes those threads run."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._processes = set()
+        self._killed = False
+
+    def check_call(self, command, cwd):
+        """Run command in cwd and wait for it to complete, raising CalledProcessError on a non-zero exit status, or
+        without running command after kill was called."""
+        with open(os.devnull, mode='w') as devnull:
+            with self._lock:
+                if self._killed:
+                    raise CalledProcessError(-9, command)
+                process = Popen(command, cwd=cwd, stdout=devnull, stderr=STDOUT)
+                self._processes.add(process)
+            try:
+                retcode = process.wait()
+            finally:
+                with self._lock:
+                    self._processes.discard(process)
+        if retcode:
+            raise CalledProcessError(retcode, command)
+
+    def kill(self):
+        """Kill all running processes, and prevent any further processes from being started."""
+        with self._lock:
+            self._killed = True
+            for process in self._processes:
+                try:
+                    process.kill()
+                except OSError:
+                    # Process exited already
+                    pass
+
+
+# Bump when cached hits would differ for the same inputs and blast version, for instance after changing their layout
+BLAST_CACHE_VERSION = 3
+
+# Maximum number of subject sequences with hits per query sequence, which is the blast default for tabular output
+BLAST_MAX_TARGET_SEQS = 500
+
+
+def cached_reciprocal_blast(good_proteins_fasta, fasta_files, hits_dir, workers=1, threads=1, evalue=10,
+                            cache_dir=None):
+    """Blast all fasta_files against good_proteins_fasta one subject taxon at a time, reusing hits for pairs of query
+    fasta file and subject taxon from a persistent cache, and return a hits file per fasta file in hits_dir.
+
+    Pairs missing from the cache are blasted against the database of just the subject taxon, through an alias database
+    whose STATS_NSEQ and STATS_TOTLEN set the number of sequences and residues to those of good_proteins_fasta. Blast
+    derives the length adjustment, effective search space and cutoff scores from these statistics, so the hits found
+    and their evalues are those of a full run against good_proteins_fasta. As hits therefore depend on these totals,
+    cached hits are only reused by runs against good proteins with the same numbers of sequences and residues.
+
+    As the number of subject sequences per query is limited per blast run, the limit of BLAST_MAX_TARGET_SEQS is applied
+    again across all subject taxa when assembling the hits of each query, keeping the subjects with the lowest evalue
+    and highest bit score, with ties in the order of good_proteins_fasta as blast would."""
+    cache_dir = cache_dir or _get_blast_cache_dir()
+    run_dir = tempfile.mkdtemp(prefix='cached_reciprocal_blast_')
+    lock_handles = []
+    processes = _BlastProcesses()
+    try:
+        # Split good proteins per taxon, so each subject taxon can be cached apart from the others
+        subject_files, nseqs, dbsize = _split_by_taxon(good_proteins_fasta,
+                                                       create_directory('subjects', inside_dir=run_dir))
+        query_digests = dict((fasta_file, _hash_file(fasta_file)) for fasta_file in fasta_files)
+        subject_digests = dict((taxon, _hash_file(subject_file)) for taxon, subject_file in subject_files.iteritems())
+
+        # Look up the hits for each pair of query fasta file and subject taxon in the cache
+        cached = {}
+        missing = []
+        for fasta_file in fasta_files:
+            for taxon in subject_files:
+                key = _hash_blast_pair(query_digests[fasta_file], subject_digests[taxon],
+                                       _blast_pair_options(evalue, dbsize), nseqs)
+                cached_file = _get_cached_hits(cache_dir, key)
+                if cached_file:
+                    cached[fasta_file, taxon] = cached_file
+                else:
+                    missing.append((fasta_file, taxon, key))
+        log.info('Reusing cached hits for %i out of %i pairs of query and subject proteomes',
+                 len(cached), len(cached) + len(missing))
+
+        # Blast missing pairs, largest first, storing their hits in the cache
+        if missing:
+            alias_dir = create_directory('aliases', inside_dir=run_dir)
+            db_aliases = {}
+            for taxon in set(taxon for _, taxon, _ in missing):
+                db_dir, db_name, lock_handle = _acquire_blast_database(subject_files[taxon])
+                lock_handles.append(lock_handle)
+                db_aliases[taxon] = _create_statistics_alias(alias_dir, taxon, os.path.join(db_dir, db_name), nseqs,
+                                                             dbsize)
+            missing.sort(key=lambda pair: os.path.getsize(pair[0]) * os.path.getsize(subject_files[pair[1]]),
+                         reverse=True)
+            pool = ThreadPool(processes=workers)
+            try:
+                for (fasta_file, taxon, _), cached_file in zip(missing, pool.imap(
+                        partial(_blast_missing_pair, cache_dir, db_aliases, dbsize, evalue, threads, processes),
+                        missing)):
+                    cached[fasta_file, taxon] = cached_file
+            finally:
+                # Kill blast processes still running after a pair failed, as terminate waits for the worker threads
+                processes.kill()
+                pool.terminate()
+
+        # Assemble the hits of each query fasta file against all subject taxa, in the order of good_proteins_fasta
+        hits_files = []
+        for fasta_file in fasta_files:
+            basename = os.path.splitext(os.path.split(fasta_file)[1])[0]
+            hits_file = os.path.join(hits_dir, basename + '-vs-all.tsv')
+            hits_per_taxon = [_read_query_hits(cached[fasta_file, taxon]) for taxon in subject_files]
+            with open(hits_file, mode='w') as write_handle:
+                _merge_query_hits(fasta_file, hits_per_taxon, write_handle)
+            hits_files.append(hits_file)
+        return hits_files
+    finally:
+        for lock_handle in lock_handles:
+            lock_handle.close()
+        shutil.rmtree(run_dir)
+
+
+def _get_blast_cache_dir():
+    """Return the blast cache directory, which can be shared between nodes through the blast_cache environment
+    variable, and otherwise defaults to a directory within the local cache."""
+    if 'blast_cache' in os.environ:
+        return create_directory('', inside_dir=os.environ['blast_cache'])
+    return create_directory('blast-cache')
+
+
+def _hash_file(path):
+    """Return a hexadecimal digest over the contents of path."""
+    sha1 = hashlib.sha1()
+    with open(path, mode='rb') as read_handle:
+        for chunk in iter(lambda: read_handle.read(1 << 20), ''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def _get_blastp_version():
+    """Return the version reported by blastp, which is determined once per process."""
+    if not hasattr(_get_blastp_version, 'version'):
+        process = Popen([BLASTP, '-version'], stdout=PIPE, stderr=STDOUT)
+        _get_blastp_version.version = process.communicate()[0].strip()
+        assert process.returncode == 0, 'Could not determine version of {0}: {1}'.format(BLASTP,
+                                                                                        _get_blastp_version.version)
+    return _get_blastp_version.version
+
+
+def _blast_pair_options(evalue, dbsize):
+    """Return the blastp options that determine the hits found for a pair of query file and subject taxon. Options that
+    do not affect the hits, such as the number of threads and the output file, are left out."""
+    return ['-outfmt', str(6),
+            '-evalue', str(evalue),
+            '-max_target_seqs', str(BLAST_MAX_TARGET_SEQS),
+            '-dbsize', str(dbsize)]
+
+
+def _hash_blast_pair(query_digest, subject_digest, options, nseqs):
+    """Return a hexadecimal digest over the cache version, blastp version, blast options, the number of database
+    sequences and query & subject contents, so hits are found again whenever any of these change."""
+    return hashlib.sha1('\n'.join([str(BLAST_CACHE_VERSION), _get_blastp_version(), '\t'.join(options), str(nseqs),
+                                   query_digest, subject_digest]) + '\n').hexdigest()
+
+
+def _split_by_taxon(fasta_file, target_dir):
+    """Split fasta_file into a file per taxon in target_dir, based on the taxon prefix of taxon|id sequence headers.
+    Return an ordered dictionary of taxon to file in the order taxa first occur in fasta_file, along with the total
+    numbers of sequences and residues, which are the blast database statistics."""
+    write_handles = collections.OrderedDict()
+    nseqs = 0
+    residues = 0
+    try:
+        with open(fasta_file) as read_handle:
+            write_handle = None
+            for line in read_handle:
+                if line.startswith('>'):
+                    taxon = line[1:].split('|')[0].strip()
+                    if taxon not in write_handles:
+                        write_handles[taxon] = open(os.path.join(target_dir, taxon + '.fasta'), mode='w')
+                    write_handle = write_handles[taxon]
+                    nseqs += 1
+                else:
+                    residues += len(line.strip())
+                write_handle.write(line)
+    finally:
+        for write_handle in write_handles.itervalues():
+            write_handle.close()
+    subject_files = collections.OrderedDict((taxon, write_handle.name)
+                                            for taxon, write_handle in write_handles.iteritems())
+    return subject_files, nseqs, residues
+
+
+def _create_statistics_alias(alias_dir, name, db_path, nseqs, dbsize):
+    """Create a blast alias database in alias_dir for the database at db_path, which reports nseqs sequences and dbsize
+    residues as the statistics used to compute evalues, and return its path for use as -db."""
+    alias_path = os.path.join(alias_dir, name)
+    with open(alias_path + '.pal', mode='w') as write_handle:
+        write_handle.write('TITLE {0} with statistics of all good proteins\n'.format(name))
+        write_handle.write('DBLIST {0}\n'.format(db_path))
+        write_handle.write('STATS_NSEQ {0}\n'.format(nseqs))
+        write_handle.write('STATS_TOTLEN {0}\n'.format(dbsize))
+    return alias_path
+
+
+def _get_cached_hits(cache_dir, key):
+    """Return the cached hits file for key, or None when not yet cached."""
+    hits_file = os.path.join(cache_dir, key[:2], key + '.tsv')
+    # Hits files are renamed into place once complete, so their presence implies they are complete
+    return hits_file if os.path.isfile(hits_file) else None
+
+
+def _blast_missing_pair(cache_dir, db_aliases, dbsize, evalue, threads, processes, pair):
+    """Blast query fasta file against the alias database of subject taxon in pair, and store the hits in the cache."""
+    fasta_file, taxon, key = pair
+    prefix_dir = create_directory(key[:2], inside_dir=cache_dir)
+    cached_file = os.path.join(prefix_dir, key + '.tsv')
+
+    # Write hits to a staging file next to the cache entry, which is renamed into place once blast completes
+    staging_file = tempfile.mkstemp(suffix='.tsv', prefix='.' + key, dir=prefix_dir)[1]
+    try:
+        command = [BLASTP,
+                   '-db', db_aliases[taxon],
+                   '-query', os.path.abspath(fasta_file)] + _blast_pair_options(evalue, dbsize) + [
+                   '-num_threads', str(threads),
+                   '-out', staging_file]
+        log.info('Executing: %s', ' '.join(command))
+        processes.check_call(command, cwd=os.path.dirname(db_aliases[taxon]))
+        os.chmod(staging_file, 0644)
+        os.rename(staging_file, cached_file)
+    finally:
+        if os.path.isfile(staging_file):
+            os.remove(staging_file)
+    return cached_file
+
+
+def _read_query_hits(hits_file):
+    """Yield the query id and list of tabular hit lines per query in hits_file, in the order blast wrote them."""
+    with open(hits_file) as read_handle:
+        for query_id, lines in groupby(read_handle, key=lambda line: line.split('\t', 1)[0]):
+            yield query_id, list(lines)
+
+
+def _merge_query_hits(fasta_file, hits_per_taxon, write_handle, max_target_seqs=BLAST_MAX_TARGET_SEQS):
+    """Write the hits of each query sequence in fasta_file to write_handle, combining the hits found against each of
+    the subject taxa, as yielded by _read_query_hits per taxon in the order of the database. Subjects are ordered by
+    their lowest evalue and highest bit score, and limited to max_target_seqs subjects per query, as blast would against
+    all taxa at once."""
+    # Blast writes the hits of query sequences in the order of fasta_file, so the hits of all taxa can be merged in turn
+    iterators = [iter(hits) for hits in hits_per_taxon]
+    current = [next(iterator, None) for iterator in iterators]
+    with open(fasta_file) as read_handle:
+        for line in read_handle:
+            if not line.startswith('>'):
+                continue
+            query_id = line[1:].split()[0]
+            subjects = []
+            for index, iterator in enumerate(iterators):
+                if current[index] is not None and current[index][0] == query_id:
+                    # All hits of a subject are written together, with its best hit first
+                    for subject_id, lines in groupby(current[index][1], key=lambda hit: hit.split('\t', 2)[1]):
+                        lines = list(lines)
+                        values = [line.split('\t') for line in lines]
+                        score = (min(float(value[10]) for value in values), -max(float(value[11]) for value in values))
+                        subjects.append((score, len(subjects), lines))
+                    current[index] = next(iterator, None)
+            for _, _, lines in sorted(subjects)[:max_target_seqs]:
+                write_handle.writelines(lines)
+    assert all(hits is None for hits in current), 'Hits found for query sequences missing from ' + fasta_file
@@ -5,6 +5,7 @@ from Bio import AlignIO
 from Bio.Align import MultipleSeqAlignment
 from Bio.Data import CodonTable
 from collections import deque
+from multiprocessing.pool import ThreadPool
 import logging
 import os.path
 import shutil
@@ -12,8 +13,8 @@ from subprocess import check_call, STDOUT
 import sys
 import tempfile
 
-from shared import create_directory, extract_archive_of_files, create_archive_of_files, parse_options, \
-    CODON_TABLE_ID
+from core_slots import reserve_cores
+from shared import create_directory, ArchiveReader, create_archive_of_files, parse_options, CODON_TABLE_ID
 from versions import CODEML
 
 
@@ -22,14 +23,19 @@ __copyright__ = "Copyright 2011, Netherlands Bioinformatics Centre"
 __license__ = "MIT"
 
 
-def run_codeml_for_sicos(codeml_dir, genome_ids_a, genome_ids_b, sico_files):
-    """Run codeml for representatives of clades A and B in each of the SICO files, to calculate dN/dS."""
+def run_codeml_for_sicos(codeml_dir, genome_ids_a, genome_ids_b, sico_files, open_file=open, workers=None):
+    """Run codeml for representatives of clades A and B in each of the SICO files, to calculate dN/dS.
+
+    SICO files are read through open_file, which can be replaced to read them directly from an archive. Codeml runs
+    concurrently on up to workers of the cores left free by other runs on this host, defaulting to a fair share of the
+    cores split with other runs."""
     logging.info('Running codeml for %s aligned and trimmed SICOs', len(sico_files))
 
-    codeml_files = []
-    for sico_file in sico_files:
+    def _codeml_task(sico_file):
+        """Return the sub directory & clade A and B alignments to run codeml for sico_file."""
         # Separate alignments for clade A & clade B genomes
-        ali = AlignIO.read(sico_file, 'fasta')
+        with open_file(sico_file) as read_handle:
+            ali = AlignIO.read(read_handle, 'fasta')
         alignment_a = MultipleSeqAlignment(seqr for seqr in ali if seqr.id.split('|')[0] in genome_ids_a)
         alignment_b = MultipleSeqAlignment(seqr for seqr in ali if seqr.id.split('|')[0] in genome_ids_b)
 
@@ -38,10 +44,17 @@ def run_codeml_for_sicos(codeml_dir, genome_ids_a, genome_ids_b, sico_files):
         # Split off everything starting from the first dot
         base_name = filename[:filename.find('.')]
         sub_dir = create_directory(base_name, inside_dir=codeml_dir)
-
-        # Submit for asynchronous calculation
-        codeml_file = run_codeml(sub_dir, alignment_a, alignment_b)
-        codeml_files.append(codeml_file)
+        return sub_dir, alignment_a, alignment_b
+
+    # Submit for asynchronous calculation, collecting codeml files in the order of sico_files
+    with reserve_cores(workers) as cores:
+        pool = ThreadPool(processes=cores)
+        try:
+            codeml_files = list(pool.imap(lambda task: run_codeml(*task), (_codeml_task(sico) for sico in sico_files)))
+        finally:
+            # Stop remaining tasks when a task failed; all tasks have already completed otherwise
+            pool.terminate()
+            pool.join()
 
     return codeml_files
 
@@ -215,9 +228,11 @@ Usage: run_codeml.py
 --sico-zip=FILE      archive of aligned & trimmed single copy orthologous (SICO) genes
 --codeml-zip=FILE     destination file path for archive of codeml output per SICO gene
 --dnds-stats=FILE     destination file path for file with dN, dS & dN/dS values per SICO gene
+--workers=N           optional number of concurrent codeml processes [default: fair share of cores between runs]
 """
-    options = ['genomes-a', 'genomes-b', 'sico-zip', 'codeml-zip', 'dnds-stats']
-    genome_a_ids_file, genome_b_ids_file, sico_zip, codeml_zip, dnds_file = parse_options(usage, options, args)
+    options = ['genomes-a', 'genomes-b', 'sico-zip', 'codeml-zip', 'dnds-stats', 'workers=?']
+    genome_a_ids_file, genome_b_ids_file, sico_zip, codeml_zip, dnds_file, workers = \
+        parse_options(usage, options, args)
 
     # Parse file to extract GenBank Project IDs
     with open(genome_a_ids_file) as read_handle:
@@ -228,11 +243,10 @@ Usage: run_codeml.py
     # Create run_dir to hold files relating to this run
     run_dir = tempfile.mkdtemp(prefix='run_codeml_')
 
-    # Extract files from zip archive
-    sico_files = extract_archive_of_files(sico_zip, create_directory('sicos', inside_dir=run_dir))
-
-    # Actually run codeml
-    codeml_files = run_codeml_for_sicos(run_dir, genome_ids_a, genome_ids_b, sico_files)
+    # Actually run codeml, reading SICO files straight from the zip archive
+    with ArchiveReader(sico_zip) as archive:
+        codeml_files = run_codeml_for_sicos(run_dir, genome_ids_a, genome_ids_b, archive.names, archive.open,
+                                            workers=int(workers) if workers else None)
 
     # Write dnds values to single output file
     _write_dnds_per_ortholog(dnds_file, codeml_files)
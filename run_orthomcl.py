@@ -1,20 +1,24 @@
 #!/usr/bin/env python
 """Module to run orthoMCL. Steps in this module reflect the steps in the UserGuide.txt bundled with OrthoMCL."""
 
-from Bio import SeqIO
 import argparse
-import multiprocessing
 import os
 import shutil
-from subprocess import Popen, PIPE, CalledProcessError, check_call, STDOUT
+from subprocess import check_call, STDOUT
 import tempfile
 
 import logging as log
-from orthomcl_database import create_database, get_configuration_file, delete_database, _get_root_credentials
-from reciprocal_blast_local import reciprocal_blast
+from checkpoints import Checkpoints, create_run, digest_files, digest_step, locked_run, remove_stale_runs, \
+    resume_run
+from core_slots import reserve_cores
+from kmer_prefilter import find_candidate_pairs
+from orthomcl_blast_parser import orthomcl_blast_parser
+from orthomcl_fasta import orthomcl_adjust_filter_fasta
+from orthomcl_groups import write_groups
+from orthomcl_pairs import orthomcl_pairs
+from reciprocal_blast_local import cached_reciprocal_blast, iter_reciprocal_blast
 from shared import create_directory, extract_archive_of_files
-from versions import MCL, ORTHOMCL_INSTALL_SCHEMA, ORTHOMCL_ADJUST_FASTA, ORTHOMCL_FILTER_FASTA, \
-    ORTHOMCL_BLAST_PARSER, ORTHOMCL_LOAD_BLAST, ORTHOMCL_PAIRS, ORTHOMCL_DUMP_PAIRS_FILES
+from versions import MCL, ORTHOMCL_LOAD_BLAST, ORTHOMCL_PAIRS, ORTHOMCL_DUMP_PAIRS_FILES
 
 
 __author__ = "Tim te Beek"
@@ -22,210 +26,172 @@ __copyright__ = "Copyright 2011, Netherlands Bioinformatics Centre"
 __license__ = "MIT"
 
 
-def _steps_6_7_8(run_dir, args, proteome_files):
+def _steps_6_7_8(run_dir, args, proteome_files, checkpoints):
     # Steps leading up to and performing the reciprocal blast, as well as minor post processing
-    adjusted_fasta_dir, fasta_files = _step5_orthomcl_adjust_fasta(run_dir, proteome_files)
-    good, poor = _step6_orthomcl_filter_fasta(run_dir, adjusted_fasta_dir, min_length=args.poorlength)
-    # Move poor proteins file to expected output path
-    shutil.move(poor, args.poorfasta)
-    allvsall = _step7_blast_all_vs_all(good, fasta_files)
-    similar_sequences = _step8_orthomcl_blast_parser(run_dir, allvsall, adjusted_fasta_dir)
-    # Clean up all vs all blast results file early, since it gets large quickly
-    os.remove(allvsall)
-    return similar_sequences
-
+    filtered = digest_step('filter', digest_files(proteome_files), 3, args.poorlength)
+    adjusted_fasta_dir, fasta_files, good, poor = checkpoints.run(
+        'filter', filtered, _steps_5_6_adjust_filter_fasta, run_dir, proteome_files, id_field=3,
+        min_length=args.poorlength, workers=args.workers)
+    # Copy poor proteins file to expected output path, keeping the original for resumed runs
+    shutil.copy(poor, args.poorfasta)
+
+    blast = digest_step('blast', filtered, args.blast_cache, args.prefilter)
+    parse = digest_step('parse', blast)
+    similar_sequences = checkpoints.get('parse', parse)
+    if similar_sequences is None:
+        # Parse blast results as they come in, unless a previous attempt already completed the blast step
+        hits_dir = create_directory('blast_hits', inside_dir=run_dir)
+        hits_files = checkpoints.get('blast', blast)
+        if hits_files is None:
+            hits_files = checkpoints.record_iterable('blast', blast, _step7_blast_all_vs_all(
+                hits_dir, good, fasta_files, args.workers, args.threads, args.blast_cache, args.prefilter))
+        similar_sequences = checkpoints.run('parse', parse, _step8_orthomcl_blast_parser, run_dir, hits_files,
+                                            adjusted_fasta_dir)
+        # Clean up blast results files early, since they get large quickly
+        shutil.rmtree(hits_dir)
+    return similar_sequences, parse
+
+
+def _steps_9_10_11_12(run_dir, args, similar_sequences, checkpoints, parse):
+    if args.backend == 'sqlite':
+        # Find pairs in an embedded database, without the need for a MySQL server or the OrthoMCL Perl scripts
+        dump = digest_step('pairs', parse, args.backend, args.evalue)
+        mcl_input = checkpoints.run('pairs', dump, orthomcl_pairs, run_dir, similar_sequences, args.evalue)[0]
+    else:
+        dump = digest_step('dump', parse, args.backend, args.evalue)
+        mcl_input = _steps_9_10_11_mysql(run_dir, args, similar_sequences, checkpoints, parse, dump)
 
-def _steps_9_10_11_12(run_dir, args, similar_sequences):
-    # Create new database and install database schema in it, so individual runs do not interfere with each other
-    dbname = create_database()
-    try:
-        # Steps that occur in database, and thus do little to produce output files
+    # MCL related steps: run MCL on mcl_input resulting in the groups.txt file
+    groups = checkpoints.run('mcl', digest_step('mcl', dump), _step12_mcl, run_dir, mcl_input, workers=args.workers)
+
+    # Post process the groups file to re-replace underscores with dots in taxon_code / accession, writing the result
+    # and its optional index outside run_dir ahead of removing run_dir
+    write_groups(groups, args.groupstsv, args.groups_index)
+
+
+def _steps_9_10_11_mysql(run_dir, args, similar_sequences, checkpoints, parse, dump):
+    # Import here, as MySQLdb is only required when using the MySQL backend
+    from orthomcl_database import lease_database, get_configuration_file, release_database, renew_lease
+
+    load = digest_step('load', parse, args.backend, args.evalue)
+    pairs = digest_step('pairs', load)
+    outputs = checkpoints.get('dump', dump)
+    if outputs is not None:
+        return outputs[0]
+
+    # Database steps either continue in the database of a previous attempt, or lease an empty database with the schema
+    # installed from the pool, so individual runs do not interfere with each other
+    run_id = os.path.basename(run_dir)
+    loaded = checkpoints.get('load', load)
+    if loaded is not None and not renew_lease(loaded[0], run_id):
+        log.warn('Lease on database %s expired, loading similar sequences into a new database', loaded[0])
+        loaded = None
+    if loaded is None:
+        _release_run_database(checkpoints)
+        dbname = lease_database(run_id)
+        checkpoints.record('database', None, dbname)
         config_file = get_configuration_file(run_dir, dbname, args.evalue)
-        _step4_orthomcl_install_schema(run_dir, config_file)
 
         # Workaround for Perl not being able to use load data local infile
         _step9_mysql_load_blast(similar_sequences, dbname)
         # _step9_orthomcl_load_blast(similar_sequences, config_file)
+        checkpoints.record('load', load, [dbname, config_file])
+    else:
+        dbname, config_file = loaded
+        if checkpoints.get('pairs', pairs) is None:
+            # Remove any tables left behind by a failed orthomclPairs attempt
+            _step10_orthomcl_pairs(run_dir, config_file, cleanup='all')
 
-        _step10_orthomcl_pairs(run_dir, config_file)
+    # Steps that occur in database, and thus do little to produce output files
+    checkpoints.run('pairs', pairs, _step10_orthomcl_pairs, run_dir, config_file)
+    mcl_input = checkpoints.run('dump', dump, _step11_orthomcl_dump_pairs, run_dir, config_file)[0]
 
-        mcl_input = _step11_orthomcl_dump_pairs(run_dir, config_file)[0]
-    finally:
-        # Trash database now that we're done with it
-        delete_database(dbname)
+    # Return database to the pool now that we're done with it; failed attempts keep theirs to resume in
+    release_database(dbname)
+    checkpoints.record('database', None, None)
+    return mcl_input
 
-    # MCL related steps: run MCL on mcl_input resulting in the groups.txt file
-    groups = _step12_mcl(run_dir, mcl_input)
-
-    # Post process the groups file to re-replace underscores with dots in taxon_code / accession
-    with open(groups) as reader:
-        lines = [line for line in reader]
-    with open(groups, 'w') as writer:
-        for line in lines:
-            writer.write('\t'.join('{}|{}'.format(seqid.split('|')[0].replace('_', '.'), seqid.split('|')[1])
-                                   for seqid in line.split('\t')))
 
-    # Move groups file outside run_dir ahead of removing run_dir
-    shutil.move(groups, args.groupstsv)
+def _release_run_database(checkpoints):
+    """Release the MySQL database recorded for a run, if any, as left behind by a failed or stale run."""
+    dbname = checkpoints.recorded('database')
+    if dbname:
+        from orthomcl_database import release_database
+        release_database(dbname, os.path.basename(checkpoints.run_dir))
+        checkpoints.record('database', None, None)
 
 
 def run_orthomcl(args, proteome_files):
-    """Run all the steps in the orthomcl pipeline, starting with a set of proteomes and ending up with groups.txt."""
-
-    # Delete orthomcl directory to prevent lingering files from previous runs to influence new runs
-    run_dir = tempfile.mkdtemp(prefix='orthomcl_run_')
-    try:
+    """Run all the steps in the orthomcl pipeline, starting with a set of proteomes and ending up with groups.txt.
+
+    Steps record their outputs as checkpoints in a persistent run directory, so a failed run can be resumed from the
+    last completed step by passing its run ID as args.resume. Completed runs are removed, as are failed runs that were
+    not resumed within checkpoints.RUN_MAX_AGE."""
+    remove_stale_runs(on_remove=_release_run_database)
+    run_dir = resume_run(args.resume) if args.resume else create_run()
+    log.info('Running OrthoMCL as run ID %s, which can be resumed with --resume %s',
+             os.path.basename(run_dir), os.path.basename(run_dir))
+    with locked_run(run_dir):
+        checkpoints = Checkpoints(run_dir)
         # Split between before and after BLAST run, for easier/faster debugging using cached all-vs-all BLAST results
-        similar_sequences = _steps_6_7_8(run_dir, args, proteome_files)
-        _steps_9_10_11_12(run_dir, args, similar_sequences)
-    finally:
-        # Remove run_dir to free disk space
-        # XXX shutil.rmtree fails on the server, and I fail to understand why. Ensure this does not grow too big
-        shutil.rmtree(run_dir, ignore_errors=True)
+        similar_sequences, parse = _steps_6_7_8(run_dir, args, proteome_files, checkpoints)
+        _steps_9_10_11_12(run_dir, args, similar_sequences, checkpoints, parse)
 
+    # Remove run_dir to free disk space, now that there is nothing left to resume
+    # XXX shutil.rmtree fails on the server, and I fail to understand why. Ensure this does not grow too big
+    shutil.rmtree(run_dir, ignore_errors=True)
 
-def _step4_orthomcl_install_schema(run_dir, config_file):
-    """Create OrthoMCL schema in an Oracle or Mysql database.
 
-    usage: orthomclInstallSchema config_file sql_log_file
-
-    where:
-      config_file : orthomcl configuration file
-      sql_log_file : optional log of sql executed
-
-    EXAMPLE: orthomclSoftware/bin/orthomclInstallSchema my_orthomcl_dir/orthomcl.config my_orthomcl_dir/install_schema.log
-
-    NOTE: the database login in the config file must have update/insert/truncate privileges on the tables specified in the config file.
-    """
-    sql_log_file = tempfile.mkstemp('.log', 'orthomclInstallSchema_run_', dir=run_dir)[1]
-    command = [ORTHOMCL_INSTALL_SCHEMA, config_file, sql_log_file]
-    log.info('Executing: %s', ' '.join(command))
-    check_call(command)
-    return sql_log_file
-
-
-def _step5_orthomcl_adjust_fasta(run_dir, proteome_files, id_field=3):
-    """Create an OrthoMCL compliant .fasta file, by adjusting definition lines.
-
-    Usage:
-      orthomclAdjustFasta taxon_code fasta_file id_field
-
-    where:
-      taxon_code:  a three or four letter unique abbreviation for the taxon
-      fasta_file:  the input fasta file per proteome
-      id_field:    a number indicating what field in the definition line contains
-                   the protein ID.  Fields are separated by either ' ' or '|'. Any
-                   spaces immediately following the '>' are ignored.  The first
-                   field is 1. For example, in the following definition line, the
-                   ID (AP_000668.1) is in field 4:  >gi|89106888|ref|AP_000668.1|
+def _steps_5_6_adjust_filter_fasta(run_dir, proteome_files, id_field=3, min_length=10, max_percent_stop=20,
+                                   workers=None):
+    """Create OrthoMCL compliant .fasta files by adjusting definition lines, and create goodProteins.fasta containing
+    all good proteins and poorProteins.fasta containing all rejects, in a single pass over each proteome.
 
     Input file requirements:
       (1) .fasta format
-      (2) a unique id is provided for each sequence, and is in the field specified
-          by id_field
-
-    Output file format:
-      (1) .fasta format
-      (2) definition line is of the form:
-             >taxoncode|unique_protein_id
-
-    The output file is named taxoncode.fasta
-
-    Note: if your input files do not meet the requirements, you can do some simple perl or awk processing of them to
-    create the required input files to this program, or the required output files.  This program is provided as a
-    convenience, but OrthoMCL users are expected to have the scripting skills to provide compliant .fasta files.
-
-    EXAMPLE: orthomclSoftware/bin/orthomclAdjustFasta hsa Homo_sapiens.NCBI36.53.pep.all.fa 1
-    """
-    # Create directory to hold compliant fasta
-    adjusted_fasta_dir = create_directory('compliant_fasta', inside_dir=run_dir)
-    adjusted_fasta_files = []
-    for proteome_file in proteome_files:
-        taxon_code = None
-        # Use first part of header of first entry as taxon code
-        for record in SeqIO.parse(proteome_file, 'fasta'):
-            taxon_code = record.id.split('|')[0].replace('.', '_')
-            break
-
-        # If we failed to extract a taxon_code, proteome file must have been empty
-        assert taxon_code, 'Proteome file appears empty: ' + proteome_file
-
-        # Call orhtomclAdjustFasta
-        command = [ORTHOMCL_ADJUST_FASTA, taxon_code, proteome_file, str(id_field)]
-        log.info('Executing: %s', ' '.join(command))
-        check_call(command)
-        # Move resulting fasta file to compliantFasta directory
-        adjusted_fasta_file = taxon_code + '.fasta'
-        fasta_file_destination = os.path.join(adjusted_fasta_dir, adjusted_fasta_file)
-        shutil.move(adjusted_fasta_file, fasta_file_destination)
-        adjusted_fasta_files.append(fasta_file_destination)
-    # Return path to directory containing compliantFasta
-    return adjusted_fasta_dir, adjusted_fasta_files
-
-
-def _step6_orthomcl_filter_fasta(run_dir, input_dir, min_length=10, max_percent_stop=20):
-    """Create goodProteins.fasta containing all good proteins and rejectProteins.fasta containing all rejects. Input is
-    a directory containing a set of compliant input .fasta files (as produced by orthomclAdjustFasta).
-
-    Usage:
-      orthomclFilterFasta input_dir min_length max_percent_stops
-
-    where:
-      input_dir:           a directory containing a set of .fasta files
-      min_length:          minimum allowed length of proteins.  (suggested: 10)
-      max_percent_stop:    maximum percent stop codons.  (suggested 20)
-
-    The input requirements are:
-      1) a compliantFasta/ directory which contains all and only the proteome .fasta files, one file per proteome.
-      2) each .fasta file must have a name in the form 'xxxx.fasta' where xxxx is a three or four letter unique taxon
-         code.  For example: hsa.fasta or eco.fasta
-      3) each protein in those files must have a definition line in the following format:
-         >xxxx|yyyyyy
-         where xxxx is the three or four letter taxon code and yyyyyy is a sequence identifier unique within that taxon.
+      (2) a unique id is provided for each sequence, and is in the field specified by id_field. Fields are separated by
+          either ' ' or '|'. Any spaces immediately following the '>' are ignored.  The first field is 1.
 
     Output:
-        my_orthomcl_dir/goodProteins.fasta
-        my_orthomcl_dir/poorProteins.fasta
+        compliant_fasta/taxoncode.fasta, with definition lines of the form >taxoncode|unique_protein_id
+        filtered_fasta/good_proteins.fasta
+        filtered_fasta/poor_proteins.fasta
         report of suspicious proteomes (> 10% poor proteins)
 
-    EXAMPLE: orthomclSoftware/bin/orthomclFilterFasta my_orthomcl_dir/compliantFasta 10 20
+    Proteins are poor when shorter than min_length, or when more than max_percent_stop percent of their residues are
+    stop codons. This replaces orthomclAdjustFasta & orthomclFilterFasta, which wrote to the current working directory.
     """
-    # Run orthomclFilterFasta
+    adjusted_fasta_dir = create_directory('compliant_fasta', inside_dir=run_dir)
     out_dir = create_directory('filtered_fasta', inside_dir=run_dir)
-    report = os.path.join(out_dir, 'filter_report.log')
-    with open(report, mode='w') as report_file:
-        command = [ORTHOMCL_FILTER_FASTA, input_dir, str(min_length), str(max_percent_stop)]
-        log.info('Executing: %s', ' '.join(command))
-        check_call(command, stdout=report_file, stderr=STDOUT)
-
-    # Move output files to out directory
     good = os.path.join(out_dir, 'good_proteins.fasta')
     poor = os.path.join(out_dir, 'poor_proteins.fasta')
-    shutil.move('goodProteins.fasta', good)
-    shutil.move('poorProteins.fasta', poor)
+    report = os.path.join(out_dir, 'filter_report.log')
+    with reserve_cores(workers) as cores:
+        adjusted_fasta_files, poor_proteins, suspicious = orthomcl_adjust_filter_fasta(
+            proteome_files, adjusted_fasta_dir, good, poor, report, id_field=id_field, min_length=min_length,
+            max_percent_stop=max_percent_stop, workers=cores)
 
     # Ensure neither of the proteomes is suspicious according to min_length & max_percent_stop
-    with open(report) as report_file:
-        if 'Proteomes with > 10% poor proteins:' in report_file.read():  # OrthoMCL does NOT add actual min_length value
-            msg = 'OrthomclFilterFasta found suspicious proteomes based on values for length'
-            log.error(msg)
-            assert False, msg
+    if suspicious:
+        msg = 'Found suspicious proteomes based on values for length: ' + ', '.join(name for name, _ in suspicious)
+        log.error(msg)
+        assert False, msg
 
     # Warn the user about the poor proteins found here, if they were found at all
-    poor_records = list(SeqIO.parse(poor, 'fasta'))
-    if poor_records:
-        log.warn('%i poor sequence records identified by orthomclFilterFasta:', len(poor_records))
-        for seqr in poor_records:
-            log.warn('>%s: %s', seqr.id, seqr.seq)
+    if poor_proteins:
+        log.warn('%i poor sequence records identified:', len(poor_proteins))
+        for seq_id, sequence in poor_proteins:
+            log.warn('>%s: %s', seq_id, sequence)
 
     # Assert good exists and has some content
     assert os.path.isfile(good) and 0 < os.path.getsize(good), good + ' should exist and have some content'
 
-    # Only good and poor proteins
-    return good, poor
+    # Return path to directory containing compliant fasta, the compliant fasta files and good and poor proteins
+    return adjusted_fasta_dir, adjusted_fasta_files, good, poor
 
 
-def _step7_blast_all_vs_all(good_proteins_file, fasta_files):
+def _step7_blast_all_vs_all(hits_dir, good_proteins_file, fasta_files, workers=None, threads=1, cache=False,
+                            prefilter=False):
     """Input:
         goodProteins.fasta
     Output:
@@ -245,13 +211,30 @@ def _step7_blast_all_vs_all(good_proteins_file, fasta_files):
 
     Time estimate: highly dependent on your data and hardware
     """
-    # Run blast ourselves locally.
-    return reciprocal_blast(good_proteins_file, fasta_files)
-
-
-def _step8_orthomcl_blast_parser(run_dir, blast_file, fasta_files_dir):
+    # Reserve cores for the blast processes from those left free by concurrent runs, with at least one blast process;
+    # without workers this is a fair share of the cores, split with the other runs on this host
+    with reserve_cores(workers and workers * threads, minimum=threads) as cores:
+        workers = max(1, cores // threads)
+        if cache:
+            # Only blast pairs of query and subject proteomes not blasted before
+            hits_files = cached_reciprocal_blast(good_proteins_file, fasta_files, hits_dir, workers=workers,
+                                                 threads=threads)
+        else:
+            # Optionally only blast pairs of sequences sharing spaced seeds
+            candidates = find_candidate_pairs(fasta_files) if prefilter else None
+            hits_files = iter_reciprocal_blast(good_proteins_file, fasta_files, hits_dir, workers=workers,
+                                               threads=threads, candidates=candidates)
+
+        # Run blast ourselves locally, in shards across workers, yielding hits files as they finish for step 8 to read
+        for hits_file in hits_files:
+            yield hits_file
+
+
+def _step8_orthomcl_blast_parser(run_dir, blast_files, fasta_files_dir):
     """orthomclBlastParser blast_file fasta_files_dir
 
+    Reimplemented in orthomcl_blast_parser, which accepts any number of blast_files instead of a single blast_file.
+
     where:
       blast_file:       BLAST output in m8 format.
       fasta_files_dir:  a directory of compliant fasta files as produced by
@@ -270,18 +253,9 @@ def _step8_orthomcl_blast_parser(run_dir, blast_file, fasta_files_dir):
 
     EXAMPLE: orthomclSoftware/bin/orthomclBlastParser my_blast_results my_orthomcl_dir/compliantFasta >> my_orthomcl_dir/similar_sequences.txt
     """
-    # Run orthomclBlastParser
-    command = [ORTHOMCL_BLAST_PARSER, blast_file, fasta_files_dir]
-    log.info('Executing: %s', ' '.join(command))
+    # Parse blast results in process, streaming the per proteome blast_files in turn rather than concatenating them
     similar_sequences = os.path.join(run_dir, 'similar_sequences.tsv')
-    with open(similar_sequences, mode='w') as stdout_file:
-        # check_call(command, stdout = stdout_file, stderr = open('/dev/null', mode = 'w'))
-        process = Popen(command, stdout=stdout_file, stderr=PIPE)
-        retcode = process.wait()
-        if retcode:
-            stderr = process.communicate()[1]
-            log.error(stderr)
-            raise CalledProcessError(retcode, command)
+    orthomcl_blast_parser(blast_files, fasta_files_dir, similar_sequences)
 
     msg = 'Similar seqeunces files should now have some content'
     assert os.path.isfile(similar_sequences) and 0 < os.path.getsize(similar_sequences), msg
@@ -308,24 +282,13 @@ def _step9_orthomcl_load_blast(similar_seqs_file, config_file):
 
 
 def _step9_mysql_load_blast(similar_seqs_file, database):
-    """Directly load results using MySQL, as Perl MySQL connection does not allow for load data local infile."""
-    credentials = _get_root_credentials()
-
-    # Run orthomclLoadBlast
-    command = ['mysql',
-               '-h', credentials.host,
-               '-u', 'orthomcl',
-               '--port=' + str(credentials.port),
-               '--password=pass',
-               '--local-infile=1',
-               '-e', 'LOAD DATA LOCAL INFILE "{0}" REPLACE INTO TABLE SimilarSequences FIELDS TERMINATED BY \'\\t\';'.format(similar_seqs_file),
-               database]
-    log.info('Executing: %s', ' '.join(command))
-    check_call(command)
-    return
+    """Directly load results through the MySQL driver in batches, as Perl MySQL connection does not allow for load data
+    local infile, and the mysql client need not be installed."""
+    from orthomcl_database import load_similar_sequences
+    return load_similar_sequences(database, similar_seqs_file)
 
 
-def _step10_orthomcl_pairs(run_dir, config_file):
+def _step10_orthomcl_pairs(run_dir, config_file, cleanup='no'):
     """Find pairs for OrthoMCL.
 
     usage: orthomclPairs config_file log_file cleanup=[yes|no|only|all] <startAfter=TAG>
@@ -355,7 +318,7 @@ def _step10_orthomcl_pairs(run_dir, config_file):
     """
     # Run orthomclPairs
     pairs_log = os.path.join(run_dir, 'orthomclPairs.log')
-    command = [ORTHOMCL_PAIRS, config_file, pairs_log, 'cleanup=no']
+    command = [ORTHOMCL_PAIRS, config_file, pairs_log, 'cleanup=' + cleanup]
     log.info('Executing: %s', ' '.join(command))
     check_call(command)
 
@@ -417,7 +380,7 @@ def _step11_orthomcl_dump_pairs(run_dir, config_file):
     return mclinput, orthologs, inparalogs, coorthologs
 
 
-def _step12_mcl(run_dir, mcl_input_file):
+def _step12_mcl(run_dir, mcl_input_file, workers=None):
     """Markov Cluster Algorithm: http://www.micans.org/mcl/
 
     Input:
@@ -431,9 +394,8 @@ def _step12_mcl(run_dir, mcl_input_file):
     mcl_dir = create_directory('mcl', inside_dir=run_dir)
     mcl_output_file = os.path.join(mcl_dir, 'mclOutput.tsv')
     mcl_log = os.path.join(mcl_dir, 'mcl.log')
-    with open(mcl_log, mode='w') as open_file:
-        threads = str(multiprocessing.cpu_count())
-        command = [MCL, mcl_input_file, '--abc', '-I', '1.5', '-o', mcl_output_file, '-te', threads]
+    with open(mcl_log, mode='w') as open_file, reserve_cores(workers) as cores:
+        command = [MCL, mcl_input_file, '--abc', '-I', '1.5', '-o', mcl_output_file, '-te', str(cores)]
         log.info('Executing: %s', ' '.join(command))
         check_call(command, stdout=open_file, stderr=STDOUT)
     return mcl_output_file
@@ -470,6 +432,23 @@ def _parse_args(argv=None):
                         help='Filter out proteins shorter than argument length')
     parser.add_argument('-e', '--evalue', type=int, default=-5,
                         help='Filter out BLAST hits with greater expect-value exponent')
+    parser.add_argument('-b', '--backend', choices=('mysql', 'sqlite'), default='mysql',
+                        help='Database used to find ortholog, in-paralog and co-ortholog pairs')
+    parser.add_argument('-w', '--workers', type=int,
+                        help='Number of concurrent BLAST processes, and of cores used by other steps, within the cores '
+                        'left free by other runs on this host [default: a fair share of the cores of this host]')
+    parser.add_argument('-t', '--threads', type=int, default=1,
+                        help='Number of threads used by each BLAST process')
+    parser.add_argument('--resume', metavar='RUN_ID',
+                        help='Resume a failed run from its last completed step, reusing the outputs of earlier steps')
+    blast_group = parser.add_mutually_exclusive_group()
+    blast_group.add_argument('--blast-cache', action='store_true',
+                             help='Reuse BLAST hits between proteomes from earlier runs with the same numbers of good '
+                             'proteins and residues, from a cache shared between runs')
+    blast_group.add_argument('--prefilter', action='store_true',
+                             help='Only BLAST pairs of proteins that share spaced seeds, at some loss of sensitivity')
+    parser.add_argument('--groups-index', metavar='FILE',
+                        help='Destination for a binary index of the orthologous groups, to read them back in faster')
     parser.add_argument('poorfasta', help='Destination for filtered out poor proteins FASTA file')
     parser.add_argument('groupstsv', help='Destination for orthologous groups tsv file')
     return parser.parse_args(argv)
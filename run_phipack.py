@@ -3,7 +3,10 @@
 
 from __future__ import division
 from Bio import SeqIO
-from shared import create_directory, extract_archive_of_files, parse_options, get_most_recent_gene_name, \
+from core_slots import reserve_cores
+from itertools import izip
+from multiprocessing.pool import ThreadPool
+from shared import create_directory, ArchiveReader, parse_options, get_most_recent_gene_name, \
     find_cogs_in_sequence_records
 from select_taxa import select_genomes_by_ids
 from versions import PHIPACK
@@ -20,16 +23,19 @@ __copyright__ = "Copyright 2011, Netherlands Bioinformatics Centre"
 __license__ = "MIT"
 
 
-def _phipack_for_all_orthologs(run_dir, aligned_files, stats_file):
+def _phipack_for_all_orthologs(run_dir, aligned_files, stats_file, open_file=open, workers=None):
     """Filter aligned fasta files where there is evidence of recombination when inspecting PhiPack values.
-    Return two collections of aligned files, the first without recombination, the second with recombination."""
+    Return two collections of aligned files, the first without recombination, the second with recombination.
+    Aligned files are read through open_file, which can be replaced to read them directly from an archive. PhiPack runs
+    concurrently on up to workers of the cores left free by other runs on this host, defaulting to a fair share of the
+    cores split with other runs."""
 
     log.info('Running PhiPack for %i orthologs to find recombination', len(aligned_files))
 
     # Create separate directory for phipack related values
     phipack_dir = create_directory('phipack', inside_dir=run_dir)
 
-    with open(stats_file, mode='w') as write_handle:
+    with open(stats_file, mode='w') as write_handle, reserve_cores(workers) as cores:
         write_handle.write('\t'.join(['Ortholog',
                                       'Informative sites',
                                       'Phi',
@@ -39,41 +45,58 @@ def _phipack_for_all_orthologs(run_dir, aligned_files, stats_file):
                                       'Product']) + '\n')
 
         # Retrieve unique genomes from first ortholog file
-        genome_ids = set(fasta_record.id.split('|')[0] for fasta_record in SeqIO.parse(aligned_files[0], 'fasta'))
+        with open_file(aligned_files[0]) as read_handle:
+            genome_ids = set(fasta_record.id.split('|')[0] for fasta_record in SeqIO.parse(read_handle, 'fasta'))
         genome_dicts = select_genomes_by_ids(genome_ids).values()
 
-        # Assign ortholog files to the correct collection based on whether they show recombination
-        for ortholog_file in aligned_files:
-            orth_name = os.path.split(ortholog_file)[1].split('.')[0]
-
-            # Parse tree file to ensure all genome_ids_a & genome_ids_b group together in the tree
-            phipack_values = run_phipack(phipack_dir, ortholog_file)
-
-            # Write PhiPack values to line
-            write_handle.write('{0}\t{1[PhiPack sites]}\t{1[Phi]}\t{1[Max Chi^2]}\t{1[NSS]}'.format(orth_name,
-                                                                                                    phipack_values))
-
-            # Parse sequence records again, but now to retrieve cogs and products
-            seq_records = list(SeqIO.parse(ortholog_file, 'fasta'))
-            # COGs
-            cogs = find_cogs_in_sequence_records(seq_records)
-            write_handle.write('\t' + ','.join(cogs))
-            # Product
-            product = get_most_recent_gene_name(genome_dicts, seq_records)
-            write_handle.write('\t' + product)
-
-            # End line
-            write_handle.write('\n')
+        # Run PhiPack concurrently, while writing values for each ortholog in the order of aligned_files
+        pool = ThreadPool(processes=cores)
+        try:
+            all_phipack_values = pool.imap(lambda ortholog_file: run_phipack(phipack_dir, ortholog_file, open_file),
+                                           aligned_files)
+            pool.close()
+
+            # Assign ortholog files to the correct collection based on whether they show recombination
+            for ortholog_file, phipack_values in izip(aligned_files, all_phipack_values):
+                orth_name = os.path.split(ortholog_file)[1].split('.')[0]
+
+                # Write PhiPack values to line
+                write_handle.write('{0}\t{1[PhiPack sites]}\t{1[Phi]}\t{1[Max Chi^2]}\t{1[NSS]}'.format(orth_name,
+                                                                                                        phipack_values))
+
+                # Parse sequence records again, but now to retrieve cogs and products
+                with open_file(ortholog_file) as read_handle:
+                    seq_records = list(SeqIO.parse(read_handle, 'fasta'))
+                # COGs
+                cogs = find_cogs_in_sequence_records(seq_records)
+                write_handle.write('\t' + ','.join(cogs))
+                # Product
+                product = get_most_recent_gene_name(genome_dicts, seq_records)
+                write_handle.write('\t' + product)
+
+                # End line
+                write_handle.write('\n')
+        finally:
+            # Stop remaining PhiPack runs when a run failed, or writing its values did
+            pool.terminate()
+            pool.join()
 
     # Nothing to return, the stats_file is the product
 
 
-def run_phipack(phipack_dir, dna_file):
+def run_phipack(phipack_dir, dna_file, open_file=open):
     """Run PhiPack and return the number of informative sites, PHI, Max Chi^2 and NSS."""
     # Create directory for PhiPack to run in, so files get created there
     orth_name = os.path.split(dna_file)[1].split('.')[0]
     rundir = create_directory(orth_name, inside_dir=phipack_dir)
 
+    # PhiPack can only read actual files, so copy any alignment read through open_file into the run directory first
+    if open_file is not open:
+        copied_file = os.path.join(rundir, os.path.split(dna_file)[1])
+        with open_file(dna_file) as read_handle, open(copied_file, mode='wb') as write_handle:
+            shutil.copyfileobj(read_handle, write_handle)
+        dna_file = copied_file
+
     # Build up list of commands
     command = PHIPACK, '-f', dna_file, '-o'  # Output NSS & Max Chi^2
     try:
@@ -106,19 +129,18 @@ def main(args):
 Usage: run_phipack.py
 --orthologs-zip=FILE     archive of orthologous genes in FASTA format
 --stats-file=FILE        destination file path for values found through PhiPack for each ortholog
+--workers=N              optional number of concurrent PhiPack processes [default: fair share of cores between runs]
 """
-    options = ('orthologs-zip', 'stats-file')
-    orthologs_zip, stats_file = parse_options(usage, options, args)
+    options = ('orthologs-zip', 'stats-file', 'workers=?')
+    orthologs_zip, stats_file, workers = parse_options(usage, options, args)
 
     # Run filtering in a temporary folder, to prevent interference from simultaneous runs
     run_dir = tempfile.mkdtemp(prefix='run_phipack_')
 
-    # Extract files from zip archive
-    extraction_dir = create_directory('extracted_orthologs', inside_dir=run_dir)
-    ortholog_files = extract_archive_of_files(orthologs_zip, extraction_dir)
-
-    # Find recombination in all ortholog_files
-    _phipack_for_all_orthologs(run_dir, ortholog_files, stats_file)
+    # Find recombination in all ortholog files, reading them straight from the zip archive
+    with ArchiveReader(orthologs_zip) as archive:
+        _phipack_for_all_orthologs(run_dir, archive.names, stats_file, archive.open,
+                                   workers=int(workers) if workers else None)
 
     # Remove unused files to free disk space
     shutil.rmtree(run_dir)
@@ -4,13 +4,20 @@ Functionality shared between different modules.
 '''
 
 import Bio
+from Bio import SeqIO
+import ctypes.util
 import getopt
+import json
 import logging
+import mmap
 import os
 from pkg_resources import resource_filename  # @UnresolvedImport  # pylint: disable=E0611
 import shutil
+from StringIO import StringIO
+import struct
 import sys
-from zipfile import ZipFile, ZIP_DEFLATED, is_zipfile
+import time
+from zipfile import ZipFile, ZipInfo, ZIP_DEFLATED, ZIP_STORED, is_zipfile
 
 
 __author__ = "Tim te Beek"
@@ -63,26 +70,240 @@ def create_directory(dirname, inside_dir=BASE_OUTPUT_PATH):
 def concatenate(target_path, source_files):
     """Concatenate arbitrary number of files into target_path by reading and writing in binary mode.
 
+    Files are copied within the kernel through sendfile where available, and through large buffered copies otherwise.
     WARNING: The binary mode implies new line characters will NOT be added in between files!"""
     with open(target_path, mode='wb') as write_handle:
         for source_file in source_files:
-            shutil.copyfileobj(open(source_file, mode='rb'), write_handle)
+            with open(source_file, mode='rb') as read_handle:
+                _copy_file_contents(read_handle, write_handle)
     assert os.path.isfile(target_path) and 0 < os.path.getsize(target_path), target_path + ' should exist with content'
 
 
-def create_archive_of_files(archive_file, file_iterable):
+def _get_sendfile():
+    """Return a function sendfile(out_fd, in_fd, count) copying count bytes from the current position of in_fd to
+    out_fd within the kernel, returning the number of bytes copied, or None if sendfile is not available."""
+    if not hasattr(_get_sendfile, 'sendfile'):
+        _get_sendfile.sendfile = None
+        if hasattr(os, 'sendfile'):
+            _get_sendfile.sendfile = lambda out_fd, in_fd, count: os.sendfile(out_fd, in_fd, None, count)
+        elif sys.platform.startswith('linux'):
+            try:
+                libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+                libc_sendfile = libc.sendfile
+            except (OSError, AttributeError):
+                libc_sendfile = None
+            if libc_sendfile is not None:
+                libc_sendfile.argtypes = (ctypes.c_int, ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t)
+                libc_sendfile.restype = ctypes.c_ssize_t
+
+                def sendfile(out_fd, in_fd, count):
+                    """Call sendfile without offset, so the file positions of both descriptors are updated."""
+                    copied = libc_sendfile(out_fd, in_fd, None, count)
+                    if copied < 0:
+                        errno = ctypes.get_errno()
+                        raise OSError(errno, os.strerror(errno))
+                    return copied
+                _get_sendfile.sendfile = sendfile
+    return _get_sendfile.sendfile
+
+
+def _copy_file_contents(read_handle, write_handle, buffer_size=4 << 20):
+    """Copy all remaining contents of read_handle to write_handle, within the kernel whenever possible."""
+    sendfile = _get_sendfile()
+    if sendfile is not None:
+        # Python buffers must be flushed before the kernel writes to the same file at the underlying descriptor
+        write_handle.flush()
+        remaining = os.fstat(read_handle.fileno()).st_size - read_handle.tell()
+        try:
+            while 0 < remaining:
+                copied = sendfile(write_handle.fileno(), read_handle.fileno(), min(remaining, 1 << 30))
+                if copied == 0:
+                    break
+                remaining -= copied
+            # Continue from the file positions updated by sendfile, which the Python file objects are not aware of
+            read_handle.seek(os.lseek(read_handle.fileno(), 0, os.SEEK_CUR))
+            write_handle.seek(os.lseek(write_handle.fileno(), 0, os.SEEK_CUR))
+            if remaining <= 0:
+                return
+        except OSError as err:
+            logging.debug('Falling back to buffered copy after sendfile failed: %s', err)
+            read_handle.seek(os.lseek(read_handle.fileno(), 0, os.SEEK_CUR))
+            write_handle.seek(os.lseek(write_handle.fileno(), 0, os.SEEK_CUR))
+    shutil.copyfileobj(read_handle, write_handle, buffer_size)
+
+
+class _ChainedFiles(object):
+    """Read only file like object over the concatenated contents of source_files, opening each file only when it is
+    reached, so consumers can read multiple files as one without concatenating them on disk first."""
+
+    def __init__(self, source_files):
+        self._source_files = iter(source_files)
+        self._read_handle = None
+        self._next_file()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        """Return the next line, raising StopIteration after the last line of the last file."""
+        line = self.readline()
+        if not line:
+            raise StopIteration
+        return line
+
+    def _next_file(self):
+        """Close the current file and open the next file, returning False when no files remain."""
+        if self._read_handle is not None:
+            self._read_handle.close()
+            self._read_handle = None
+        for source_file in self._source_files:
+            self._read_handle = open(source_file, mode='rb')
+            return True
+        return False
+
+    def readline(self):
+        """Return the next line, which might be continued from one file into the next if a file lacks a newline."""
+        line = ''
+        while self._read_handle is not None:
+            line += self._read_handle.readline()
+            if line.endswith('\n') or not self._next_file():
+                break
+        return line
+
+    def read(self, size=-1):
+        """Read up to size bytes, or all remaining bytes if size is negative."""
+        chunks = []
+        while self._read_handle is not None and size != 0:
+            chunk = self._read_handle.read(size)
+            chunks.append(chunk)
+            if 0 < size:
+                size -= len(chunk)
+            # Any remaining size means the current file is exhausted, so continue with the next file
+            if size != 0 and not self._next_file():
+                break
+        return ''.join(chunks)
+
+    def close(self):
+        """Close the current file and skip any remaining files."""
+        if self._read_handle is not None:
+            self._read_handle.close()
+            self._read_handle = None
+        self._source_files = iter(())
+
+
+def chain_files(source_files):
+    """Return a file like object reading source_files as if they were concatenated, without writing any new file."""
+    return _ChainedFiles(source_files)
+
+
+class FastaWriter(object):
+    """Write fasta records to an open file handle, wrapping sequence lines at line_length characters.
+
+    Formatted records are collected in a single buffer that is reused across records, and written out once it grows
+    beyond buffer_size characters, or when the writer is flushed. Use as context manager to flush on exit.
+    The number of records written so far is available as records."""
+
+    def __init__(self, write_handle, line_length=60, buffer_size=1 << 20):
+        self.write_handle = write_handle
+        self.line_length = line_length
+        self.buffer_size = buffer_size
+        self.records = 0
+        self._buffer = []
+        self._buffered = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.flush()
+
+    def write(self, header, sequence):
+        """Buffer a single fasta record with header line (without leading '>') and sequence string."""
+        line_length = self.line_length
+        lines = '\n'.join([sequence[offset:offset + line_length] for offset in xrange(0, len(sequence), line_length)])
+        self._buffer.append('>' + header + '\n' + lines + '\n' if lines else '>' + header + '\n')
+        self._buffered += len(sequence)
+        self.records += 1
+        if self.buffer_size < self._buffered:
+            self.flush()
+
+    def write_record(self, seqrecord):
+        """Buffer a single Bio.SeqRecord, composing the header line from identifier and description like SeqIO does."""
+        identifier = seqrecord.id.replace('\n', ' ')
+        description = seqrecord.description.replace('\n', ' ')
+        if description and description.split(None, 1)[0] == identifier:
+            header = description
+        elif description:
+            header = identifier + ' ' + description
+        else:
+            header = identifier
+        self.write(header, str(seqrecord.seq))
+
+    def flush(self):
+        """Write out and clear the buffered records."""
+        if self._buffer:
+            self.write_handle.write(''.join(self._buffer))
+            del self._buffer[:]
+            self._buffered = 0
+
+
+# Compression profiles for archives, mapped to the compression type used for their members. Use stored for
+# intermediate archives that are read only once, as storing members uncompressed saves time writing and reading them
+ARCHIVE_PROFILES = {'stored': ZIP_STORED,
+                    'deflate': ZIP_DEFLATED}
+
+
+def create_archive_of_files(archive_file, file_iterable, profile='deflate'):
     """Write files in file_iterable to archive_file, using only filename for target path within archive_file."""
-    zipfile_handle = ZipFile(archive_file, mode='w', compression=ZIP_DEFLATED)
-    if len(file_iterable):
-        for some_file in file_iterable:
-            zipfile_handle.write(some_file, os.path.split(some_file)[1])
-    else:
-        logging.warn('No files in file_iterable: %s will be empty!', archive_file)
-        zipfile_handle.writestr('empty', '')
-    zipfile_handle.close()
+    with ArchiveWriter(archive_file, profile) as archive:
+        archive.write_files(file_iterable)
     assert is_zipfile(archive_file), 'File should now have been a valid zipfile: ' + archive_file
 
 
+class ArchiveWriter(object):
+    """Write members to a zip archive, compressing them according to one of the ARCHIVE_PROFILES.
+
+    Members can be added from files on disk through write_files, or straight from memory through write_member, such
+    that stages need not write temporary files just to archive them. Use as context manager to close on exit."""
+
+    def __init__(self, archive_file, profile='deflate'):
+        assert profile in ARCHIVE_PROFILES, 'Archive profile should be one of: ' + ', '.join(sorted(ARCHIVE_PROFILES))
+        self.archive_file = archive_file
+        self.compress_type = ARCHIVE_PROFILES[profile]
+        self._zipfile = ZipFile(archive_file, mode='w', compression=self.compress_type, allowZip64=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write_files(self, file_iterable):
+        """Add files from disk, using only filename for target path within archive."""
+        for some_file in file_iterable:
+            self._zipfile.write(some_file, os.path.split(some_file)[1])
+
+    def write_member(self, name, data):
+        """Add a member with contents data straight from memory."""
+        zinfo = ZipInfo(filename=name, date_time=time.localtime(time.time())[:6])
+        zinfo.external_attr = 0o644 << 16
+        zinfo.compress_type = self.compress_type
+        self._zipfile.writestr(zinfo, data)
+
+    def close(self):
+        """Close the archive, adding a placeholder member when no members were written."""
+        if not self._zipfile.filelist:
+            logging.warn('No files written to archive: %s will be empty!', self.archive_file)
+            self._zipfile.writestr('empty', '')
+        self._zipfile.close()
+
+
 def extract_archive_of_files(archive_file, target_dir):
     """Extract all files from archive to target directory, and return list of files extracted."""
     assert 0 < os.path.getsize(archive_file), 'Zipfile was zero bytes!'
@@ -96,6 +317,183 @@ def extract_archive_of_files(archive_file, target_dir):
     return extracted_files
 
 
+class ArchiveReader(object):
+    """Provide read access to the members of a zip archive in place, without extracting them to disk first.
+
+    Member names are available as names; open returns a file like object for a member, which can be passed to parsers
+    such as SeqIO and AlignIO as replacement for a filename. Use as context manager to close the archive on exit."""
+
+    def __init__(self, archive_file):
+        assert 0 < os.path.getsize(archive_file), 'Zipfile was zero bytes!'
+        self._zipfile = ZipFile(archive_file, mode='r')
+        self.names = [zipinfo.filename for zipinfo in self._zipfile.infolist() if not zipinfo.filename.endswith('/')]
+        assert self.names, 'At least some files should have been read from ' + archive_file
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def open(self, name, mode='r'):  # pylint: disable=W0613
+        """Return a file like object to read member name, ignoring mode so this method can be used in place of open."""
+        return self._zipfile.open(name, mode='r')
+
+    def extract(self, name, target_dir):
+        """Extract a single member to target directory for tools that require an actual file, and return its path."""
+        return self._zipfile.extract(name, path=target_dir)
+
+    def close(self):
+        """Close the underlying zipfile."""
+        self._zipfile.close()
+
+
+# Packed alignment sets start and end with this magic, followed at the end by the offset of their json index
+ALIGNMENT_SET_MAGIC = 'ODOSEAS1'
+_ALIGNMENT_SET_FOOTER = struct.Struct('<Q8s')
+
+
+class AlignmentSetWriter(object):
+    """Write orthologs to a single packed alignment set file, as an alternative to a zip archive of fasta files.
+
+    Per ortholog, the sequences are stored as one contiguous byte matrix, with their headers and the matrix offset kept
+    in an index at the end of the file. Use as context manager to write the index on exit, which is skipped when the
+    context exits with an exception, so readers reject the incomplete file."""
+
+    def __init__(self, alignment_set_file):
+        self.alignment_set_file = alignment_set_file
+        self._index = []
+        self._write_handle = open(alignment_set_file, mode='wb')
+        self._write_handle.write(ALIGNMENT_SET_MAGIC)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self._write_handle.close()
+
+    def write(self, name, records):
+        """Add ortholog name with records given as (header, sequence) tuples, where sequences are usually aligned."""
+        headers = []
+        lengths = []
+        offset = self._write_handle.tell()
+        for header, sequence in records:
+            headers.append(header)
+            lengths.append(len(sequence))
+            self._write_handle.write(sequence)
+        self._index.append({'name': name, 'offset': offset, 'headers': headers, 'lengths': lengths})
+
+    def close(self):
+        """Write the index and footer, and close the file."""
+        index_offset = self._write_handle.tell()
+        json.dump(self._index, self._write_handle, separators=(',', ':'))
+        self._write_handle.write(_ALIGNMENT_SET_FOOTER.pack(index_offset, ALIGNMENT_SET_MAGIC))
+        self._write_handle.close()
+
+
+class AlignmentSetReader(object):
+    """Random access to the orthologs in a packed alignment set file, which is memory mapped rather than parsed.
+
+    Offers names and open like ArchiveReader, such that stages reading fasta through open_file can use either."""
+
+    def __init__(self, alignment_set_file):
+        with open(alignment_set_file, mode='rb') as read_handle:
+            self._mmap = mmap.mmap(read_handle.fileno(), 0, access=mmap.ACCESS_READ)
+        magic = self._mmap[:len(ALIGNMENT_SET_MAGIC)]
+        assert magic == ALIGNMENT_SET_MAGIC, 'Not an alignment set: ' + alignment_set_file
+        assert len(ALIGNMENT_SET_MAGIC) + _ALIGNMENT_SET_FOOTER.size <= len(self._mmap), \
+            'Alignment set was not closed properly: ' + alignment_set_file
+        index_offset, magic = _ALIGNMENT_SET_FOOTER.unpack(self._mmap[-_ALIGNMENT_SET_FOOTER.size:])
+        assert magic == ALIGNMENT_SET_MAGIC, 'Alignment set was not closed properly: ' + alignment_set_file
+        index = json.loads(self._mmap[index_offset:-_ALIGNMENT_SET_FOOTER.size])
+        self.names = [str(entry['name']) for entry in index]
+        self._index = dict(zip(self.names, index))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def headers(self, name):
+        """Return the fasta headers for ortholog name."""
+        return [str(header) for header in self._index[name]['headers']]
+
+    def records(self, name):
+        """Return tuples of header and sequence for ortholog name."""
+        entry = self._index[name]
+        records = []
+        offset = entry['offset']
+        for header, length in zip(entry['headers'], entry['lengths']):
+            records.append((str(header), self._mmap[offset:offset + length]))
+            offset += length
+        return records
+
+    def matrix(self, name):
+        """Return the aligned sequences of ortholog name as a read only numpy array of bytes, with a row per sequence.
+
+        The array is backed by the memory mapped file, so no data is read until elements are accessed, and the array
+        should no longer be used once the reader is closed."""
+        import numpy
+        entry = self._index[name]
+        lengths = entry['lengths']
+        assert len(set(lengths)) <= 1, 'Sequences should be aligned to be returned as matrix: ' + name
+        columns = lengths[0] if lengths else 0
+        matrix = numpy.frombuffer(self._mmap, dtype=numpy.uint8, count=len(lengths) * columns, offset=entry['offset'])
+        return matrix.reshape(len(lengths), columns)
+
+    def open(self, name, mode='r'):  # pylint: disable=W0613
+        """Return a file like object with the records of ortholog name in fasta format, for use in place of open."""
+        write_handle = _MemberFile()
+        with FastaWriter(write_handle) as fasta_writer:
+            for header, sequence in self.records(name):
+                fasta_writer.write(header, sequence)
+        write_handle.seek(0)
+        return write_handle
+
+    def close(self):
+        """Close the memory mapped file."""
+        self._mmap.close()
+
+
+class _MemberFile(StringIO):
+    """In memory file that can also be used as context manager, like the members returned by ArchiveReader.open."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def convert_archive_to_alignment_set(archive_file, alignment_set_file):
+    """Pack all fasta files within zip archive_file into a single alignment set, with an ortholog per member."""
+    with ArchiveReader(archive_file) as archive, AlignmentSetWriter(alignment_set_file) as alignment_set:
+        for name in archive.names:
+            with archive.open(name) as read_handle:
+                records = [(seqr.description, str(seqr.seq)) for seqr in SeqIO.parse(read_handle, 'fasta')]
+            alignment_set.write(name, records)
+    return alignment_set_file
+
+
+def convert_alignment_set_to_archive(alignment_set_file, archive_file, profile='deflate'):
+    """Unpack alignment set into a zip archive with a fasta file per ortholog, for tools such as Galaxy."""
+    with AlignmentSetReader(alignment_set_file) as alignment_set, ArchiveWriter(archive_file, profile) as archive:
+        for name in alignment_set.names:
+            with alignment_set.open(name) as read_handle:
+                archive.write_member(name, read_handle.read())
+    return archive_file
+
+
 def parse_options(usage, options, args):
     """Parse command line arguments in args. Options require argument by default; flags are indicated with '?' postfix.
 
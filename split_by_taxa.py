@@ -3,22 +3,24 @@
 
 from Bio import AlignIO
 from Bio.Align import MultipleSeqAlignment
-from shared import parse_options, extract_archive_of_files, create_directory, create_archive_of_files
+from shared import parse_options, ArchiveReader, ArchiveWriter
 import logging as log
 import os.path
 import re
-import shutil
+from StringIO import StringIO
 import sys
-import tempfile
 
 __author__ = "Tim te Beek"
 __copyright__ = "Copyright 2011, Netherlands Bioinformatics Centre"
 __license__ = "MIT"
 
 
-def split_alignment_by_taxa(run_dir, ortholog_files, (genome_ids_a, prefix_a), (genome_ids_b, prefix_b)):
-    """Separate multiple sequence alignments with sequences from two taxa out into separate files per taxon."""
-    # Collections to hold split files
+def split_alignment_by_taxa(archive_a, archive_b, ortholog_files, (genome_ids_a, prefix_a), (genome_ids_b, prefix_b),
+                            open_file=open):
+    """Separate multiple sequence alignments with sequences from two taxa out into separate members per taxon archive.
+
+    Ortholog files are read through open_file, which can be replaced to read them directly from an archive."""
+    # Collections to hold split member names
     taxon_a_files = []
     taxon_b_files = []
 
@@ -28,23 +30,27 @@ def split_alignment_by_taxa(run_dir, ortholog_files, (genome_ids_a, prefix_a), (
         base_name, extension = os.path.splitext(os.path.split(ortholog_file)[1])
 
         # Separate alignment according to which taxon the genome_ids belong to
-        alignment = AlignIO.read(ortholog_file, 'fasta')
+        with open_file(ortholog_file) as read_handle:
+            alignment = AlignIO.read(read_handle, 'fasta')
         alignment_a = MultipleSeqAlignment(seqr for seqr in alignment if seqr.id.split('|')[0] in genome_ids_a)
         alignment_b = MultipleSeqAlignment(seqr for seqr in alignment if seqr.id.split('|')[0] in genome_ids_b)
 
-        # Build up target output files
-        taxon_a_file = os.path.join(run_dir, '{0}.{1}{2}'. format(base_name, prefix_a, extension))
-        taxon_b_file = os.path.join(run_dir, '{0}.{1}{2}'. format(base_name, prefix_b, extension))
+        # Build up target output member names
+        taxon_a_file = '{0}.{1}{2}'. format(base_name, prefix_a, extension)
+        taxon_b_file = '{0}.{1}{2}'. format(base_name, prefix_b, extension)
 
-        # Actually write out sub alignments
-        AlignIO.write(alignment_a, taxon_a_file, 'fasta')
-        AlignIO.write(alignment_b, taxon_b_file, 'fasta')
+        # Actually write out sub alignments straight into the archives, without temporary files
+        for taxon_alignment, archive, member in ((alignment_a, archive_a, taxon_a_file),
+                                                 (alignment_b, archive_b, taxon_b_file)):
+            buffer_handle = StringIO()
+            AlignIO.write(taxon_alignment, buffer_handle, 'fasta')
+            archive.write_member(member, buffer_handle.getvalue())
 
         # Append the written files to the correct collections of files
         taxon_a_files.append(taxon_a_file)
         taxon_b_files.append(taxon_b_file)
 
-    # Return collection of files
+    # Return collection of member names
     return taxon_a_files, taxon_b_files
 
 
@@ -81,23 +87,13 @@ Usage: split_by_taxa.py
         genome_ids_b = [line[0] for line in lines]
         common_prefix_b = _common_prefix([line[1] for line in lines], 'taxon_b')
 
-    # Create run_dir to hold files related to this run
-    run_dir = tempfile.mkdtemp(prefix='split_by_taxa_')
-
-    # Extract files from zip archive
-    ortholog_files = extract_archive_of_files(orthologs_zip, create_directory('alignments', inside_dir=run_dir))
-
-    # Actually split alignments per taxon
-    taxon_a_files, taxon_b_files = split_alignment_by_taxa(run_dir, ortholog_files,
-                                                           (genome_ids_a, common_prefix_a),
-                                                           (genome_ids_b, common_prefix_b))
-
-    # Write the produced files to command line argument filenames
-    create_archive_of_files(taxon_a_zip, taxon_a_files)
-    create_archive_of_files(taxon_b_zip, taxon_b_files)
-
-    # Remove unused files to free disk space
-    shutil.rmtree(run_dir)
+    # Actually split alignments per taxon, reading them from and writing them to the zip archives directly
+    with ArchiveReader(orthologs_zip) as archive, \
+            ArchiveWriter(taxon_a_zip) as archive_a, ArchiveWriter(taxon_b_zip) as archive_b:
+        split_alignment_by_taxa(archive_a, archive_b, archive.names,
+                                (genome_ids_a, common_prefix_a),
+                                (genome_ids_b, common_prefix_b),
+                                archive.open)
 
     # Exit after a comforting log message
     log.info("Produced: \n%s\n%s", taxon_a_zip, taxon_b_zip)
@@ -0,0 +1,72 @@
+import fcntl
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+
+import checkpoints
+
+
+class Test(unittest.TestCase):
+
+    def setUp(self):
+        self.longMessage = True
+        logging.root.setLevel(logging.DEBUG)
+        self.runs_dir = tempfile.mkdtemp(prefix='checkpoints_')
+
+    def tearDown(self):
+        shutil.rmtree(self.runs_dir)
+
+    def test_checkpoints(self):
+        '''
+        Record step outputs, and verify they are only reused for the same digest while their files still exist.
+        '''
+        run_dir = checkpoints.create_run(runs_dir=self.runs_dir)
+        output = os.path.join(run_dir, 'output.txt')
+        calls = []
+
+        def _step(value):
+            calls.append(value)
+            with open(output, mode='w') as write_handle:
+                write_handle.write(value)
+            return [output, value]
+
+        digest = checkpoints.digest_step('step', 'input')
+        self.assertEqual([output, 'a'], checkpoints.Checkpoints(run_dir).run('step', digest, _step, 'a'))
+
+        # Resumed runs reuse outputs
+        resumed = checkpoints.Checkpoints(checkpoints.resume_run(os.path.basename(run_dir), runs_dir=self.runs_dir))
+        self.assertEqual([output, 'a'], resumed.run('step', digest, _step, 'b'))
+        self.assertEqual(['a'], calls)
+
+        # But not for a different digest, nor once outputs are removed
+        self.assertIsNone(resumed.get('step', checkpoints.digest_step('step', 'other input')))
+        os.remove(output)
+        self.assertEqual([output, 'c'], resumed.run('step', digest, _step, 'c'))
+        self.assertEqual(['a', 'c'], calls)
+
+        # Iterables are recorded once exhausted
+        self.assertEqual([1, 2], list(resumed.record_iterable('items', digest, iter([1, 2]))))
+        self.assertEqual([1, 2], checkpoints.Checkpoints(run_dir).get('items', digest))
+
+    def test_remove_stale_runs(self):
+        '''
+        Remove runs not modified recently, but never a run that is in progress.
+        '''
+        stale = checkpoints.create_run(runs_dir=self.runs_dir)
+        in_progress = checkpoints.create_run(runs_dir=self.runs_dir)
+        recent = checkpoints.create_run(runs_dir=self.runs_dir)
+        for run_dir in (stale, in_progress):
+            os.utime(run_dir, (0, 0))
+
+        # Exercise
+        removed = []
+        with open(os.path.join(in_progress, '.lock'), mode='a') as lock_handle:
+            fcntl.flock(lock_handle, fcntl.LOCK_EX)
+            checkpoints.remove_stale_runs(runs_dir=self.runs_dir, on_remove=lambda cps: removed.append(cps.run_dir))
+
+        # Verify
+        self.assertEqual([stale], removed)
+        self.assertEqual(sorted([in_progress, recent]),
+                         sorted(os.path.join(self.runs_dir, name) for name in os.listdir(self.runs_dir)))
@@ -0,0 +1,69 @@
+import logging
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+import core_slots
+
+
+class Test(unittest.TestCase):
+
+    def setUp(self):
+        self.longMessage = True
+        logging.root.setLevel(logging.DEBUG)
+        self.slots_dir = tempfile.mkdtemp(prefix='core_slots_')
+        self.poll_interval = core_slots.POLL_INTERVAL
+        core_slots.POLL_INTERVAL = 0.05
+
+    def tearDown(self):
+        core_slots.POLL_INTERVAL = self.poll_interval
+        shutil.rmtree(self.slots_dir)
+
+    def test_reserve_cores(self):
+        '''
+        Hand out budgets limited to the cores left free by other stages, and return cores once stages complete.
+        '''
+        with core_slots.reserve_cores(3, slots_dir=self.slots_dir, cores=4) as first:
+            self.assertEqual(3, first)
+            with core_slots.reserve_cores(slots_dir=self.slots_dir, cores=4) as second:
+                self.assertEqual(1, second)
+        with core_slots.reserve_cores(slots_dir=self.slots_dir, cores=4) as third:
+            self.assertEqual(4, third)
+
+    def test_fair_share(self):
+        '''
+        Split cores evenly between stages by default, while stages asking for cores explicitly get all free cores.
+        '''
+        with core_slots.reserve_cores(1, slots_dir=self.slots_dir, cores=4) as first:
+            self.assertEqual(1, first)
+            with core_slots.reserve_cores(slots_dir=self.slots_dir, cores=4) as second:
+                self.assertEqual(2, second)
+            with core_slots.reserve_cores(4, slots_dir=self.slots_dir, cores=4) as third:
+                self.assertEqual(3, third)
+
+        # Minimum number of cores takes precedence over the fair share
+        with core_slots.reserve_cores(1, slots_dir=self.slots_dir, cores=4):
+            with core_slots.reserve_cores(minimum=3, slots_dir=self.slots_dir, cores=4) as fourth:
+                self.assertEqual(3, fourth)
+
+    def test_queue_when_full(self):
+        '''
+        Queue a stage while the host is full, until another stage releases enough cores.
+        '''
+        events = []
+
+        def _queued_stage():
+            with core_slots.reserve_cores(minimum=2, slots_dir=self.slots_dir, cores=4) as cores:
+                events.append(('queued', cores))
+
+        with core_slots.reserve_cores(slots_dir=self.slots_dir, cores=4) as cores:
+            thread = threading.Thread(target=_queued_stage)
+            thread.start()
+            time.sleep(0.3)
+            events.append(('released', cores))
+        thread.join(5)
+
+        # Verify
+        self.assertEqual([('released', 4), ('queued', 4)], events)
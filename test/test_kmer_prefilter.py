@@ -0,0 +1,103 @@
+from Bio import SeqIO
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+
+import kmer_prefilter
+from reciprocal_blast_local import reciprocal_blast
+from shared import resource_filename
+from versions import BLASTP
+
+
+class Test(unittest.TestCase):
+
+    def setUp(self):
+        self.longMessage = True
+        logging.root.setLevel(logging.DEBUG)
+        self.run_dir = tempfile.mkdtemp(prefix='kmer_prefilter_')
+
+        # Write OrthoMCL compliant taxon.fasta files for the test proteomes
+        self.fasta_dir = os.path.join(self.run_dir, 'compliant_fasta')
+        os.mkdir(self.fasta_dir)
+        self.fasta_files = []
+        for taxon in ['13305', '17745']:
+            proteome = resource_filename(__name__, 'data/run_orthomcl/' + taxon + '.1.faa')
+            fasta_file = os.path.join(self.fasta_dir, taxon + '_1.fasta')
+            with open(fasta_file, mode='w') as write_handle:
+                for record in SeqIO.parse(proteome, 'fasta'):
+                    write_handle.write('>{0}_1|{1}\n{2}\n'.format(taxon, record.id.split('|')[2], record.seq))
+            self.fasta_files.append(fasta_file)
+
+    def tearDown(self):
+        shutil.rmtree(self.run_dir)
+
+    def test_find_candidate_pairs(self):
+        candidates = kmer_prefilter.find_candidate_pairs(self.fasta_files)
+
+        # Each sequence is a candidate for itself, and candidates are symmetric
+        for seq_id, subjects in candidates.iteritems():
+            self.assertIn(seq_id, subjects)
+            for subject in subjects:
+                self.assertIn(seq_id, candidates[subject])
+
+        # Orthologous IS1 InsB proteins are found, while most of the search space is pruned
+        self.assertIn('17745_1|YP_001451427.1', candidates['13305_1|YP_668281.1'])
+        pairs = sum(len(subjects) for subjects in candidates.itervalues())
+        self.assertLess(pairs, 0.2 * len(candidates) ** 2)
+
+    def test_evalue_drift(self):
+        '''
+        Compare the best evalues of pairs found by both a full and a prefiltered BLAST.
+        '''
+        def _write_hits(name, hits):
+            hits_file = os.path.join(self.run_dir, name)
+            with open(hits_file, mode='w') as write_handle:
+                for query, subject, evalue in hits:
+                    write_handle.write('{0}\t{1}\t90.00\t40\t4\t0\t1\t40\t1\t40\t{2}\t100\n'.format(
+                        query, subject, evalue))
+            return hits_file
+        full = _write_hits('full.tsv', [('A|a1', 'B|b1', '1e-20'), ('A|a1', 'B|b1', '1e-5'), ('A|a2', 'B|b2', '1e-10'),
+                                        ('A|a3', 'B|b3', '0.0'), ('A|a4', 'B|b4', '1e-3')])
+        prefiltered = _write_hits('prefiltered.tsv', [('A|a1', 'B|b1', '1e-21'), ('A|a2', 'B|b2', '4e-11'),
+                                                      ('A|a3', 'B|b3', '0.0')])
+
+        # Exercise
+        median, maximum, compared = kmer_prefilter.evalue_drift([full], [prefiltered])
+
+        # Verify
+        self.assertEqual(2, compared)
+        self.assertAlmostEqual(0.25, median)
+        self.assertAlmostEqual(0.4, maximum)
+
+    @unittest.skipUnless(os.path.isfile(BLASTP), 'We need BLAST')
+    def test_recall_report(self):
+        '''
+        Report the recall of the prefilter against a full all-vs-all BLAST of the test proteomes.
+        '''
+        good_proteins = os.path.join(self.run_dir, 'good_proteins.fasta')
+        with open(good_proteins, mode='w') as write_handle:
+            for fasta_file in self.fasta_files:
+                with open(fasta_file) as read_handle:
+                    shutil.copyfileobj(read_handle, write_handle)
+        hits_dir = os.path.join(self.run_dir, 'hits')
+        os.mkdir(hits_dir)
+        hits_files = reciprocal_blast(good_proteins, self.fasta_files, hits_dir=hits_dir)
+        report = os.path.join(self.run_dir, 'report.tsv')
+
+        # Exercise
+        kmer_prefilter.main(['--fasta-dir', self.fasta_dir, '--hits', ','.join(hits_files), '--report', report,
+                             '--good-proteins', good_proteins])
+
+        # Verify
+        with open(report) as read_handle:
+            logging.info('Prefilter recall report:\n%s', read_handle.read())
+            read_handle.seek(0)
+            rows = [line.split('\t') for line in read_handle][1:]
+        self.assertLessEqual(0.9, float(rows[0][4]), 'Recall with a single shared seed should be at least 90%')
+
+        # Evalues of blasting only candidate pairs are measured against those of the full BLAST
+        for row in rows:
+            self.assertLess(0, float(row[6]))
+            self.assertLessEqual(float(row[6]), float(row[7]))
@@ -6,6 +6,7 @@ Created on Jun 8, 2014
 import datetime
 import logging
 import os
+import shutil
 import sys
 import tempfile
 import unittest
@@ -56,6 +57,10 @@ class Test(unittest.TestCase):
     def setUp(self):
         self.longMessage = True
         logging.root.setLevel(logging.DEBUG)
+        self.cache_dir = tempfile.mkdtemp(prefix='load_prokaryotes_')
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
 
     def test_parse_genomes_table(self):
         # Parse all genomes
@@ -103,3 +108,100 @@ class Test(unittest.TestCase):
             self.assertIn('439255.1 - Proteobacteria > Gammaproteobacteria > Salmonella > Salmonella bongori N268-08', contents)
         finally:
             os.remove(target)
+
+    def test_genome_changes(self):
+        '''
+        Index two versions of a small genomes table, and verify the genomes added, modified and removed are recorded.
+        '''
+        table_dir = tempfile.mkdtemp()
+        try:
+            header = '#Organism/Name\tGroup\tAssembly Accession\tFTP Path\n'
+            old_table = os.path.join(table_dir, 'old.txt')
+            with open(old_table, mode='w') as write_handle:
+                write_handle.write(header)
+                write_handle.write('Escherichia coli\tProteobacteria\tGCA_000017745.1\tEscherichia_coli\n')
+                write_handle.write('Salmonella bongori\tProteobacteria\tGCA_000439255.1\tSalmonella_bongori\n')
+                write_handle.write('Bacillus subtilis\tFirmicutes\tGCA_000009045.1\tBacillus_subtilis\n')
+            new_table = os.path.join(table_dir, 'new.txt')
+            with open(new_table, mode='w') as write_handle:
+                write_handle.write(header)
+                write_handle.write('Escherichia coli\tProteobacteria\tGCA_000017745.1\tEscherichia_coli\n')
+                write_handle.write('Salmonella bongori\tProteobacteria\tGCA_000439255.1\tSalmonella/bongori\n')
+                write_handle.write('Listeria monocytogenes\tFirmicutes\tGCA_000196035.1\tListeria_monocytogenes\n')
+
+            # Accessions are trimmed, and only lines that changed get a different digest
+            old_index = load_prokaryotes._index_genomes_table(old_table)
+            new_index = load_prokaryotes._index_genomes_table(new_table)
+            self.assertEqual(['17745.1', '439255.1', '9045.1'], sorted(old_index))
+            self.assertEqual(old_index['17745.1'], new_index['17745.1'])
+            self.assertNotEqual(old_index['439255.1'], new_index['439255.1'])
+
+            # Changes are appended to the changes file, and the last change per accession is returned
+            changes_file = os.path.join(table_dir, 'changes.txt')
+            before = datetime.datetime.now() - datetime.timedelta(seconds=1)
+            load_prokaryotes._log_genome_changes(old_index, new_index, changes_file)
+            expected = {'196035.1': 'added', '439255.1': 'modified', '9045.1': 'removed'}
+            self.assertEqual(expected, load_prokaryotes.get_genome_changes(changes_file=changes_file))
+            self.assertEqual(expected, load_prokaryotes.get_genome_changes(before, changes_file))
+            self.assertEqual({}, load_prokaryotes.get_genome_changes(datetime.datetime.now() + datetime.timedelta(1),
+                                                                     changes_file))
+            load_prokaryotes._log_genome_changes(new_index, old_index, changes_file)
+            self.assertEqual({'196035.1': 'removed', '439255.1': 'modified', '9045.1': 'added'},
+                             load_prokaryotes.get_genome_changes(changes_file=changes_file))
+        finally:
+            shutil.rmtree(table_dir)
+
+    def test_genome_catalogue(self):
+        '''
+        Build the catalogue from a small genomes table, and verify it is sorted, cached and filtered by prefix and group.
+        '''
+        columns = ['Organism/Name', 'TaxID', 'BioProject Accession', 'BioProject ID', 'Group', 'SubGroup', 'Size (Mb)',
+                   'GC%', 'Chromosomes/RefSeq', 'Chromosomes/INSDC', 'Plasmids/RefSeq', 'Plasmids/INSDC', 'WGS',
+                   'Scaffolds', 'Genes', 'Proteins', 'Release Date', 'Modify Date', 'Status', 'Center',
+                   'BioSample Accession', 'Assembly Accession', 'Reference', 'FTP Path', 'Pubmed ID']
+        genomes = [('Salmonella bongori N268-08', 'Proteobacteria', 'Gammaproteobacteria', '4.5', 'GCA_000439255.1'),
+                   ('Bacillus subtilis 168', 'Firmicutes', 'Bacilli', '4.2', 'GCA_000009045.1'),
+                   ('Escherichia coli E24377A', 'Proteobacteria', 'Gammaproteobacteria', '5.2', 'GCA_000017745.1'),
+                   ('Mycoplasma genitalium G37', 'Tenericutes', 'Mollicutes', '0.6', 'GCA_000027325.1')]
+        lines = ['#' + '\t'.join(columns)]
+        for name, group, subgroup, size, accession in genomes:
+            genome = dict.fromkeys(columns, '-')
+            genome.update({'Organism/Name': name, 'Group': group, 'SubGroup': subgroup, 'Size (Mb)': size,
+                           'Chromosomes/RefSeq': 'NC_000001.1', 'Genes': '500', 'Proteins': '480',
+                           'Release Date': '2009/01/27', 'Modify Date': '2011/02/10', 'Status': 'Complete Genome',
+                           'Assembly Accession': accession, 'FTP Path': name.split()[0]})
+            lines.append('\t'.join(genome[column] for column in columns))
+
+        original_table = load_prokaryotes._parse_genomes_table.complete_genome_table
+        original_build = load_prokaryotes._build_catalogue
+        try:
+            load_prokaryotes._parse_genomes_table.complete_genome_table = '\n'.join(lines) + '\n'
+            load_prokaryotes.get_genome_catalogue.cache = {}
+
+            # Genomes are sorted by group, subgroup and name, with small genomes labelled
+            catalogue = load_prokaryotes.get_genome_catalogue(cache_dir=self.cache_dir)
+            self.assertTrue(os.path.isfile(os.path.join(self.cache_dir, 'prokaryotes.txt.catalogue')))
+            self.assertEqual(['9045.1', '17745.1', '439255.1', '27325.1'], [entry[1] for entry in catalogue])
+            self.assertEqual('9045.1 - Firmicutes > Bacilli > Bacillus > Bacillus subtilis 168', catalogue[0][0])
+            self.assertTrue(catalogue[3][0].endswith(' - ~~Only 0.6 Mb!~~'))
+
+            # Galaxy clade selection and later page views are served from the stored catalogue, without building it
+            load_prokaryotes._build_catalogue = None
+            load_prokaryotes.get_genome_catalogue.cache = {}
+            self.assertEqual(catalogue, list(load_prokaryotes.get_complete_genomes(cache_dir=self.cache_dir)))
+
+            def _accessions(prefix=None, group=None):
+                return [entry[1] for entry in load_prokaryotes.get_genome_catalogue(prefix, group, self.cache_dir)]
+
+            # Prefixes match the start of organism names or accessions, case insensitively
+            self.assertEqual(['17745.1'], _accessions('escherichia'))
+            self.assertEqual(['17745.1'], _accessions('177'))
+
+            # Groups match either the Group or SubGroup of genomes
+            self.assertEqual(['17745.1', '439255.1'], _accessions(group='Proteobacteria'))
+            self.assertEqual(['27325.1'], _accessions(group='Mollicutes'))
+            self.assertEqual([], _accessions('Salmonella', 'Firmicutes'))
+        finally:
+            load_prokaryotes._parse_genomes_table.complete_genome_table = original_table
+            load_prokaryotes._build_catalogue = original_build
+            load_prokaryotes.get_genome_catalogue.cache = {}
@@ -0,0 +1,59 @@
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+
+import orthomcl_blast_parser
+
+
+class Test(unittest.TestCase):
+
+    def setUp(self):
+        self.longMessage = True
+        logging.root.setLevel(logging.DEBUG)
+        self.run_dir = tempfile.mkdtemp(prefix='orthomcl_blast_parser_')
+
+    def tearDown(self):
+        shutil.rmtree(self.run_dir)
+
+    def _write(self, filename, lines):
+        path = os.path.join(self.run_dir, filename)
+        with open(path, mode='w') as write_handle:
+            write_handle.write('\n'.join(lines) + '\n')
+        return path
+
+    def test_orthomcl_blast_parser(self):
+        # Setup
+        fasta_dir = os.path.join(self.run_dir, 'compliant_fasta')
+        os.mkdir(fasta_dir)
+        self._write('compliant_fasta/A.fasta', ['>A|a1', 'M' * 60, 'M' * 40, '>A|a2', 'M' * 50])
+        self._write('compliant_fasta/B.fasta', ['>B|b1', 'M' * 80])
+        # Hits spread over two files, with two overlapping HSPs for the first pair
+        hits_a = self._write('A-vs-all.tsv', ['A|a1\tB|b1\t90.00\t40\t4\t0\t1\t40\t1\t40\t2e-50\t100',
+                                              'A|a1\tB|b1\t80.00\t20\t4\t0\t30\t49\t30\t49\t1e-10\t50'])
+        hits_b = self._write('B-vs-all.tsv', ['B|b1\tA|a2\t100.00\t50\t0\t0\t1\t50\t50\t1\t0.0\t200'])
+        similar_sequences = os.path.join(self.run_dir, 'similar_sequences.tsv')
+
+        # Exercise
+        pairs = orthomcl_blast_parser.orthomcl_blast_parser([hits_a, hits_b], fasta_dir, similar_sequences)
+
+        # Verify
+        self.assertEqual(2, pairs)
+        with open(similar_sequences) as read_handle:
+            lines = [line.rstrip('\n').split('\t') for line in read_handle]
+        # Percent match covers positions 1 to 49 of the shorter subject of length 80
+        self.assertEqual(['A|a1', 'B|b1', 'A', 'B', '2', '-50', '86.7', '61.3'], lines[0])
+        # Reversed span on the shorter subject covers it entirely
+        self.assertEqual(['B|b1', 'A|a2', 'B', 'A', '0', '0', '100', '100'], lines[1])
+
+    def test_format_evalue(self):
+        self.assertEqual(('2', '-50'), orthomcl_blast_parser._format_evalue('2e-50'))
+        self.assertEqual(('1', '-100'), orthomcl_blast_parser._format_evalue('e-100'))
+        self.assertEqual(('3.50', '0'), orthomcl_blast_parser._format_evalue('3.5'))
+        self.assertEqual(('1.23', '-05'), orthomcl_blast_parser._format_evalue('1.234e-05'))
+        self.assertEqual(('0', '0'), orthomcl_blast_parser._format_evalue('0.0'))
+
+    def test_non_overlapping_match_length(self):
+        self.assertEqual(0, orthomcl_blast_parser._non_overlapping_match_length([]))
+        self.assertEqual(30, orthomcl_blast_parser._non_overlapping_match_length([(20, 1), (5, 10), (41, 50)]))
@@ -1,16 +1,77 @@
+from distutils.spawn import find_executable
 import MySQLdb
+import os
 import shutil
+import socket
+import subprocess
 import tempfile
+import time
 import unittest
 
 import orthomcl_database
+from versions import ORTHOMCL_INSTALL_SCHEMA
 
 
+def _start_mysqld(data_dir):
+    '''
+    Start a throwaway MySQL server on a free port within data_dir, and return the server process and its port.
+    '''
+    # Initialize a data directory with a root account without password; MariaDB does so through mysql_install_db, whose
+    # root account otherwise only authenticates through the unix socket, while MySQL initializes through mysqld itself
+    mariadb = 'MariaDB' in subprocess.check_output(['mysqld', '--no-defaults', '--version'])
+    with open(os.path.join(data_dir, 'install.log'), mode='w') as log_handle:
+        if mariadb:
+            subprocess.check_call([find_executable('mysql_install_db') or 'mariadb-install-db', '--no-defaults',
+                                   '--datadir=' + os.path.join(data_dir, 'data'),
+                                   '--auth-root-authentication-method=normal'], stdout=log_handle, stderr=log_handle)
+        else:
+            subprocess.check_call(['mysqld', '--no-defaults', '--initialize-insecure',
+                                   '--datadir=' + os.path.join(data_dir, 'data')], stdout=log_handle, stderr=log_handle)
+
+    # Pick a free port, and start the server listening on that port
+    probe = socket.socket()
+    probe.bind(('127.0.0.1', 0))
+    port = probe.getsockname()[1]
+    probe.close()
+    process = subprocess.Popen(['mysqld', '--no-defaults', '--datadir=' + os.path.join(data_dir, 'data'),
+                                '--port={0}'.format(port), '--bind-address=127.0.0.1',
+                                '--socket=' + os.path.join(data_dir, 'mysqld.sock'),
+                                '--pid-file=' + os.path.join(data_dir, 'mysqld.pid')],
+                               stdout=open(os.devnull, mode='w'), stderr=subprocess.STDOUT)
+
+    # Wait for the server to accept connections
+    for _ in range(60):
+        try:
+            MySQLdb.connect(host='127.0.0.1', port=port, user='root', passwd='').close()
+            return process, port
+        except MySQLdb.OperationalError:
+            time.sleep(.5)
+    process.terminate()
+    raise AssertionError('Stand-in MySQL server did not start within 30 seconds')
+
+
+@unittest.skipUnless(find_executable('mysqld'), 'We need a local MySQL server to stand in')
 class Test(unittest.TestCase):
 
+    @classmethod
+    def setUpClass(cls):
+        # Run against a stand-in server, by replacing the credentials parsed from credentials/orthomcl.cfg
+        cls.server_dir = tempfile.mkdtemp(prefix='orthomcl_database_mysqld_')
+        cls.server, port = _start_mysqld(cls.server_dir)
+        cls.credentials = orthomcl_database.Credentials('127.0.0.1', port, 'root', '')
+        orthomcl_database._get_root_credentials.credentials = cls.credentials
+
+    @classmethod
+    def tearDownClass(cls):
+        del orthomcl_database._get_root_credentials.credentials
+        orthomcl_database._get_admin_connection.connection = None
+        orthomcl_database._create_pool_table.created = False
+        cls.server.terminate()
+        cls.server.wait()
+        shutil.rmtree(cls.server_dir)
+
     def setUp(self):
         self.run_dir = tempfile.mkdtemp()
-        self.credentials = orthomcl_database._get_root_credentials()
 
     def tearDown(self):
         shutil.rmtree(self.run_dir)
@@ -31,6 +92,7 @@ class Test(unittest.TestCase):
         '''
         Create a database, connect to it and perform a simple select query, verify the outcome and delete the database.
         '''
+        dbname = None
         try:
             # Create database
             dbname = orthomcl_database.create_database()
@@ -47,3 +109,98 @@ class Test(unittest.TestCase):
             if dbname:
                 # Delete database
                 orthomcl_database.delete_database(dbname)
+
+    @unittest.skipUnless(os.path.isfile(ORTHOMCL_INSTALL_SCHEMA), 'We need OrthoMCL')
+    def test_lease_release_database(self):
+        '''
+        Lease databases from the pool, and verify released databases are truncated and reused by later runs.
+        '''
+        first = orthomcl_database.lease_database('run_first')
+        second = orthomcl_database.lease_database('run_second')
+        self.assertNotEqual(first, second)
+
+        # Leave behind similar sequences and a temporary orthomclPairs table
+        db_connection = MySQLdb.connect(host=self.credentials.host, port=self.credentials.port,
+                                        user='orthomcl', passwd='pass', db=first)
+        cursor = db_connection.cursor()
+        cursor.execute('INSERT INTO SimilarSequences VALUES (\'A|a1\', \'B|b1\', \'A\', \'B\', 2, -50, 90, 100)')
+        cursor.execute('CREATE TABLE BestHit (QUERY_ID VARCHAR(60))')
+        db_connection.commit()
+        orthomcl_database.release_database(first)
+
+        # The released database is leased again, without any rows or temporary tables
+        self.assertEqual(first, orthomcl_database.lease_database('run_third'))
+        cursor.execute('SELECT COUNT(*) FROM SimilarSequences')
+        self.assertEqual(0, cursor.fetchone()[0])
+        cursor.execute('SHOW TABLES LIKE \'BestHit\'')
+        self.assertIsNone(cursor.fetchone())
+        db_connection.close()
+
+        orthomcl_database.release_database(first)
+        orthomcl_database.release_database(second)
+
+    def test_reap_expired_leases(self):
+        '''
+        Reclaim databases whose lease expired, and drop databases abandoned while being created.
+        '''
+        orthomcl_database._create_pool_table()
+        table = orthomcl_database._POOL_DATABASE + '.leases'
+        leases = []
+        for ready, run_id, age in [(True, 'run_expired', orthomcl_database.LEASE_MAX_AGE + 60),
+                                   (True, 'run_current', 60),
+                                   (False, 'run_abandoned', orthomcl_database.LEASE_CREATE_TIMEOUT + 60)]:
+            cursor = orthomcl_database._get_admin_connection().cursor()
+            cursor.execute('INSERT INTO {0} (ready, run_id, leased_at) VALUES (%s, %s, NOW() - INTERVAL %s SECOND)'
+                           .format(table), (ready, run_id, age))
+            leases.append(cursor.lastrowid)
+            cursor.close()
+            orthomcl_database._create_database(orthomcl_database._pooled_database_name(leases[-1]))
+        expired, current, abandoned = [orthomcl_database._pooled_database_name(lease_id) for lease_id in leases]
+        try:
+            # Exercise
+            orthomcl_database._reap_expired_leases()
+
+            # Verify
+            rows = orthomcl_database._execute('SELECT id, run_id FROM {0} WHERE id IN ({1})'.format(
+                table, ', '.join(str(lease_id) for lease_id in leases)))[1]
+            self.assertEqual(((leases[0], None), (leases[1], 'run_current')), rows)
+            self.assertFalse(orthomcl_database._execute('SHOW DATABASES LIKE %s', (abandoned,))[1])
+
+            # Runs can only renew and release their lease while it did not expire
+            self.assertFalse(orthomcl_database.renew_lease(expired, 'run_expired'))
+            self.assertTrue(orthomcl_database.renew_lease(current, 'run_current'))
+            orthomcl_database.release_database(current, 'run_other')
+            self.assertTrue(orthomcl_database._execute('SELECT id FROM {0} WHERE id = %s AND run_id = %s'.format(table),
+                                                       (leases[1], 'run_current'))[1])
+        finally:
+            orthomcl_database._execute('DELETE FROM {0} WHERE id IN ({1})'.format(
+                table, ', '.join(str(lease_id) for lease_id in leases)))
+            for dbname in (expired, current, abandoned):
+                orthomcl_database.delete_database(dbname)
+
+    @unittest.skipUnless(os.path.isfile(ORTHOMCL_INSTALL_SCHEMA), 'We need OrthoMCL')
+    def test_load_similar_sequences(self):
+        '''
+        Load similar sequences in multiple batches into a database with the OrthoMCL schema, and verify all rows end up
+        in the SimilarSequences table with its indexes added again.
+        '''
+        similar_seqs_file = os.path.join(self.run_dir, 'similar_sequences.tsv')
+        with open(similar_seqs_file, mode='w') as write_handle:
+            for index in range(25):
+                write_handle.write('A|a{0}\tB|b{0}\tA\tB\t2\t-50\t90\t100\n'.format(index))
+        dbname = orthomcl_database.lease_database('run_load')
+        try:
+            indexes = orthomcl_database._get_secondary_indexes(dbname, 'SimilarSequences')
+            self.assertTrue(indexes, 'orthomclInstallSchema should index SimilarSequences')
+
+            # Exercise
+            rows = orthomcl_database.load_similar_sequences(dbname, similar_seqs_file, batch_size=10)
+
+            # Verify
+            self.assertEqual(25, rows)
+            loaded = orthomcl_database._execute('SELECT QUERY_ID, EVALUE_EXP, PERCENT_MATCH FROM {0}.SimilarSequences '
+                                                'WHERE SUBJECT_ID = \'B|b24\''.format(dbname))[1]
+            self.assertEqual((('A|a24', -50, 100.),), loaded)
+            self.assertEqual(indexes, orthomcl_database._get_secondary_indexes(dbname, 'SimilarSequences'))
+        finally:
+            orthomcl_database.release_database(dbname)
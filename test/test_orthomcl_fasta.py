@@ -0,0 +1,60 @@
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+
+import orthomcl_fasta
+
+
+class Test(unittest.TestCase):
+
+    def setUp(self):
+        self.longMessage = True
+        logging.root.setLevel(logging.DEBUG)
+        self.run_dir = tempfile.mkdtemp(prefix='orthomcl_fasta_')
+
+    def tearDown(self):
+        shutil.rmtree(self.run_dir)
+
+    def _write(self, filename, lines):
+        path = os.path.join(self.run_dir, filename)
+        with open(path, mode='w') as write_handle:
+            write_handle.write('\n'.join(lines) + '\n')
+        return path
+
+    def _read(self, path):
+        with open(path) as read_handle:
+            return read_handle.read().splitlines()
+
+    def test_orthomcl_adjust_filter_fasta(self):
+        # Setup
+        proteome_a = self._write('a.faa', ['>1.1|NC_1| a1 |product', 'M' * 20, 'M' * 20,
+                                           '>1.1|NC_1|a2|short', 'M' * 5,
+                                           '>1.1|NC_1|a3|stops', 'M' * 6 + '*' * 4])
+        proteome_b = self._write('b.faa', ['>2.1|NC_2|b1|product', 'M' * 40])
+        compliant_dir = os.path.join(self.run_dir, 'compliant_fasta')
+        os.mkdir(compliant_dir)
+        good, poor, report = [os.path.join(self.run_dir, name) for name in ('good.fasta', 'poor.fasta', 'report.log')]
+
+        # Exercise
+        fasta_files, poor_proteins, suspicious = orthomcl_fasta.orthomcl_adjust_filter_fasta(
+            [proteome_a, proteome_b], compliant_dir, good, poor, report, min_length=10, max_percent_stop=20, workers=2)
+
+        # Verify
+        # Headers are adjusted, while sequence lines are kept as is
+        self.assertEqual([os.path.join(compliant_dir, '1_1.fasta'), os.path.join(compliant_dir, '2_1.fasta')],
+                         fasta_files)
+        self.assertEqual(['>1_1|a1', 'M' * 20, 'M' * 20, '>1_1|a2', 'M' * 5, '>1_1|a3', 'M' * 6 + '*' * 4],
+                         self._read(fasta_files[0]))
+
+        # Short proteins and proteins with too many stops are poor
+        self.assertEqual(['>1_1|a1', 'M' * 20, 'M' * 20, '>2_1|b1', 'M' * 40], self._read(good))
+        self.assertEqual(['>1_1|a2', 'M' * 5, '>1_1|a3', 'M' * 6 + '*' * 4], self._read(poor))
+        self.assertEqual([('1_1|a2', 'M' * 5), ('1_1|a3', 'M' * 6 + '*' * 4)], poor_proteins)
+
+        # Only the first proteome is suspicious, and no partial files are left behind
+        self.assertEqual([('1_1.fasta', 2 / 3.)], suspicious)
+        self.assertEqual(['', 'Proteomes with > 10% poor proteins:', '  1_1.fasta\t66%'], self._read(report))
+        self.assertEqual(sorted(['a.faa', 'b.faa', 'compliant_fasta', 'good.fasta', 'poor.fasta', 'report.log']),
+                         sorted(os.listdir(self.run_dir)))
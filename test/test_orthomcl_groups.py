@@ -0,0 +1,71 @@
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+
+import orthomcl_groups
+
+
+class Test(unittest.TestCase):
+
+    def setUp(self):
+        self.longMessage = True
+        logging.root.setLevel(logging.DEBUG)
+        self.run_dir = tempfile.mkdtemp(prefix='orthomcl_groups_')
+
+    def tearDown(self):
+        shutil.rmtree(self.run_dir)
+
+    def test_write_read_groups(self):
+        # Setup
+        mcl_output = os.path.join(self.run_dir, 'mcl_output.txt')
+        with open(mcl_output, mode='w') as write_handle:
+            write_handle.write('13305_1|YP_667991.1\t17745_1|YP_001451418.1\t17745_1|YP_001451593.1\n')
+            write_handle.write('13305_1|YP_671068.1\t17745_1|YP_001451503.1\n')
+        groups_file = os.path.join(self.run_dir, 'groups.tsv')
+        index_file = os.path.join(self.run_dir, 'groups.idx')
+
+        # Exercise
+        self.assertEqual(2, orthomcl_groups.write_groups(mcl_output, groups_file, index_file))
+
+        # Verify
+        with open(groups_file) as read_handle:
+            self.assertEqual(['13305.1|YP_667991.1\t17745.1|YP_001451418.1\t17745.1|YP_001451593.1\n',
+                              '13305.1|YP_671068.1\t17745.1|YP_001451503.1\n'], read_handle.readlines())
+        expected = [[('13305.1', 'YP_667991.1'), ('17745.1', 'YP_001451418.1'), ('17745.1', 'YP_001451593.1')],
+                    [('13305.1', 'YP_671068.1'), ('17745.1', 'YP_001451503.1')]]
+        self.assertEqual(expected, orthomcl_groups._read_groups_index(groups_file, index_file))
+        self.assertEqual(expected, orthomcl_groups.read_groups(groups_file, index_file))
+        self.assertEqual(expected, orthomcl_groups.read_groups(groups_file))
+
+        # Groups are parsed from the text file once it no longer matches its index, even when the size is unchanged
+        with open(groups_file, mode='r+') as write_handle:
+            write_handle.write('13305.1|YP_667992.1')
+        self.assertIsNone(orthomcl_groups._read_groups_index(groups_file, index_file))
+        self.assertEqual([[('13305.1', 'YP_667992.1')] + expected[0][1:], expected[1]],
+                         orthomcl_groups.read_groups(groups_file, index_file))
+
+        # Without an index file only the groups file is written
+        self.assertEqual(2, orthomcl_groups.write_groups(mcl_output, os.path.join(self.run_dir, 'other.tsv')))
+        self.assertEqual(['groups.idx', 'groups.tsv', 'mcl_output.txt', 'other.tsv'], sorted(os.listdir(self.run_dir)))
+
+    def test_write_groups_failure(self):
+        '''
+        Remove staging files when the groups can not be written.
+        '''
+        groups_file = os.path.join(self.run_dir, 'groups.tsv')
+        index_file = os.path.join(self.run_dir, 'groups.idx')
+
+        # Reading fails on a missing mcl output file
+        self.assertRaises(IOError, orthomcl_groups.write_groups, os.path.join(self.run_dir, 'missing.txt'),
+                          groups_file, index_file)
+        self.assertEqual([], os.listdir(self.run_dir))
+
+        # Renaming fails onto a directory
+        mcl_output = os.path.join(self.run_dir, 'mcl_output.txt')
+        with open(mcl_output, mode='w') as write_handle:
+            write_handle.write('13305_1|YP_667991.1\t17745_1|YP_001451418.1\n')
+        os.mkdir(index_file)
+        self.assertRaises(OSError, orthomcl_groups.write_groups, mcl_output, groups_file, index_file)
+        self.assertEqual(['groups.idx', 'mcl_output.txt'], sorted(os.listdir(self.run_dir)))
@@ -0,0 +1,53 @@
+import logging
+import shutil
+import tempfile
+import unittest
+
+import orthomcl_pairs
+
+
+class Test(unittest.TestCase):
+
+    def setUp(self):
+        self.longMessage = True
+        logging.root.setLevel(logging.DEBUG)
+        self.run_dir = tempfile.mkdtemp(prefix='orthomcl_pairs_')
+
+    def tearDown(self):
+        shutil.rmtree(self.run_dir)
+
+    def test_orthomcl_pairs(self):
+        # Setup: two orthologs between taxa A & B, one in-paralog within A and one co-ortholog through that in-paralog
+        hits = [('A|a1', 'B|b1', 1, -50), ('B|b1', 'A|a1', 1, -50),
+                ('A|a2', 'B|b2', 2, -30), ('B|b2', 'A|a2', 2, -30),
+                ('A|a1', 'A|a2', 1, -60), ('A|a2', 'A|a1', 1, -60),
+                ('A|a2', 'B|b1', 1, -20), ('B|b1', 'A|a2', 1, -20),
+                # Self hits and hits with a poor evalue are ignored
+                ('A|a1', 'A|a1', 1, -100), ('B|b1', 'B|b2', 1, -3), ('B|b2', 'B|b1', 1, -3)]
+        similar_sequences = tempfile.mkstemp(suffix='.tsv', dir=self.run_dir)[1]
+        with open(similar_sequences, mode='w') as write_handle:
+            for query, subject, mant, exp in hits:
+                write_handle.write('\t'.join(str(value) for value in
+                                             (query, subject, query[0], subject[0], mant, exp, 90, 100)) + '\n')
+
+        # Exercise
+        mclinput, orthologs, inparalogs, coorthologs = orthomcl_pairs.orthomcl_pairs(self.run_dir, similar_sequences,
+                                                                                     -5)
+
+        # Verify
+        def _read_pairs(pairs_file):
+            with open(pairs_file) as read_handle:
+                return sorted(tuple(line.split()) for line in read_handle)
+
+        # Ortholog scores are normalized by the average score of 50 and 29.699 between taxa A & B
+        self.assertEqual([('A|a1', 'B|b1', '1.255'), ('A|a2', 'B|b2', '0.745')], _read_pairs(orthologs))
+        self.assertEqual([('A|a1', 'A|a2', '1')], _read_pairs(inparalogs))
+        # Co-ortholog score of 20 is normalized by the average score of orthologs and co-orthologs between A & B
+        self.assertEqual([('A|a2', 'B|b1', '0.602')], _read_pairs(coorthologs))
+        self.assertEqual(sorted(_read_pairs(orthologs) + _read_pairs(inparalogs) + _read_pairs(coorthologs)),
+                         _read_pairs(mclinput))
+
+    def test_format_score(self):
+        self.assertEqual('1', orthomcl_pairs._format_score(0.9999))
+        self.assertEqual('0.5', orthomcl_pairs._format_score(0.5))
+        self.assertEqual('1.235', orthomcl_pairs._format_score(1.2345))
@@ -0,0 +1,202 @@
+from Bio import SeqIO
+import fcntl
+import logging
+from multiprocessing.pool import ThreadPool
+import os
+import shutil
+from subprocess import CalledProcessError
+import tempfile
+import threading
+import time
+import unittest
+
+import reciprocal_blast_local
+from shared import resource_filename
+from StringIO import StringIO
+from versions import BLASTP
+
+
+class Test(unittest.TestCase):
+
+    def setUp(self):
+        self.longMessage = True
+        logging.root.setLevel(logging.DEBUG)
+        self.run_dir = tempfile.mkdtemp(prefix='reciprocal_blast_local_')
+
+    def tearDown(self):
+        shutil.rmtree(self.run_dir)
+
+    def test_split_into_shards(self):
+        '''
+        Split two proteomes into shards, and verify each sequence ends up in exactly one shard of about equal size.
+        '''
+        # Setup
+        fasta_files = [resource_filename(__name__, 'data/run_orthomcl/' + acc + '.1.faa') for acc in ['13305', '17745']]
+
+        # Exercise
+        shard_files = reciprocal_blast_local._split_into_shards(fasta_files, self.run_dir, 4)
+
+        # Verify
+        expected = sorted((rec.id, str(rec.seq)) for fasta in fasta_files for rec in SeqIO.parse(fasta, 'fasta'))
+        actual = sorted((rec.id, str(rec.seq)) for shard in shard_files for rec in SeqIO.parse(shard, 'fasta'))
+        self.assertEqual(expected, actual)
+
+        # Shards are scheduled largest first, and differ in size by no more than the largest record
+        sizes = [sum(len(rec.format('fasta')) for rec in SeqIO.parse(shard, 'fasta')) for shard in shard_files]
+        self.assertEqual(4, len(sizes))
+        self.assertEqual(sorted(sizes, reverse=True), sizes)
+        largest_record = max(len(rec.format('fasta')) for fasta in fasta_files for rec in SeqIO.parse(fasta, 'fasta'))
+        self.assertLessEqual(sizes[0] - sizes[-1], largest_record)
+
+    def test_split_by_taxon(self):
+        '''
+        Split good proteins per taxon in the order taxa occur, and count the sequences and residues of all taxa.
+        '''
+        good_proteins = os.path.join(self.run_dir, 'good_proteins.fasta')
+        with open(good_proteins, mode='w') as write_handle:
+            write_handle.write('>B|b1\nMKV\nLA\n>A|a1\nMK\n>B|b2\nM\n')
+
+        # Exercise
+        subject_files, nseqs, dbsize = reciprocal_blast_local._split_by_taxon(good_proteins, self.run_dir)
+
+        # Verify
+        self.assertEqual(['B', 'A'], subject_files.keys())
+        self.assertEqual((3, 8), (nseqs, dbsize))
+        with open(subject_files['B']) as read_handle:
+            self.assertEqual('>B|b1\nMKV\nLA\n>B|b2\nM\n', read_handle.read())
+
+    @unittest.skipUnless(os.path.isfile(BLASTP), 'We need BLAST')
+    def test_cached_reciprocal_blast(self):
+        '''
+        Blast the test proteomes one subject taxon at a time through the cache, and verify the hits are identical to
+        those of a full run, both when blasting missing pairs and when reusing cached hits.
+        '''
+        fasta_files = []
+        good_proteins = os.path.join(self.run_dir, 'good_proteins.fasta')
+        with open(good_proteins, mode='w') as good_handle:
+            for taxon in ['13305', '17745']:
+                fasta_file = os.path.join(self.run_dir, taxon + '_1.fasta')
+                with open(fasta_file, mode='w') as write_handle:
+                    proteome = resource_filename(__name__, 'data/run_orthomcl/' + taxon + '.1.faa')
+                    for record in SeqIO.parse(proteome, 'fasta'):
+                        record_lines = '>{0}_1|{1}\n{2}\n'.format(taxon, record.id.split('|')[2], record.seq)
+                        write_handle.write(record_lines)
+                        good_handle.write(record_lines)
+                fasta_files.append(fasta_file)
+
+        def _hits_per_query(hits_files):
+            hits = {}
+            for hits_file in hits_files:
+                for query_id, lines in reciprocal_blast_local._read_query_hits(hits_file):
+                    self.assertNotIn(query_id, hits, 'All hits of a query should be written together')
+                    hits[query_id] = lines
+            return hits
+
+        full_dir = os.path.join(self.run_dir, 'full')
+        os.mkdir(full_dir)
+        expected = _hits_per_query(reciprocal_blast_local.iter_reciprocal_blast(good_proteins, fasta_files, full_dir))
+        self.assertTrue(expected)
+
+        # Exercise & verify
+        cache_dir = os.path.join(self.run_dir, 'cache')
+        os.mkdir(cache_dir)
+        for attempt in ['missing', 'cached']:
+            hits_dir = os.path.join(self.run_dir, attempt)
+            os.mkdir(hits_dir)
+            hits_files = reciprocal_blast_local.cached_reciprocal_blast(good_proteins, fasta_files, hits_dir,
+                                                                        cache_dir=cache_dir)
+            self.assertEqual(expected, _hits_per_query(hits_files), attempt)
+
+    def test_merge_query_hits(self):
+        '''
+        Merge the hits of query sequences against two subject taxa, and limit the subjects per query across both taxa.
+        '''
+        fasta_file = os.path.join(self.run_dir, 'query.fasta')
+        with open(fasta_file, mode='w') as write_handle:
+            write_handle.write('>A|a1\nMKV\n>A|a2\nMKV\n>A|a3\nMKV\n')
+
+        def _hit(query, subject, evalue, bitscore):
+            return '{0}\t{1}\t90.00\t40\t4\t0\t1\t40\t1\t40\t{2}\t{3}\n'.format(query, subject, evalue, bitscore)
+        taxon_b = [('A|a1', [_hit('A|a1', 'B|b1', '1e-10', 50), _hit('A|a1', 'B|b1', '0.5', 20),
+                             _hit('A|a1', 'B|b2', '1e-30', 90)]),
+                   ('A|a3', [_hit('A|a3', 'B|b3', '0.001', 30)])]
+        taxon_c = [('A|a1', [_hit('A|a1', 'C|c1', '1e-20', 70), _hit('A|a1', 'C|c2', '1e-20', 75)]),
+                   ('A|a2', [_hit('A|a2', 'C|c1', '0.01', 25)])]
+
+        # Exercise
+        write_handle = StringIO()
+        reciprocal_blast_local._merge_query_hits(fasta_file, [taxon_b, taxon_c], write_handle, max_target_seqs=3)
+
+        # Verify
+        # Subjects are ordered by evalue and bit score, keeping all hits of the subjects within the limit together
+        hits = [tuple(line.split('\t')[:2]) + (line.split('\t')[10],) for line in write_handle.getvalue().splitlines()]
+        self.assertEqual([('A|a1', 'B|b2', '1e-30'), ('A|a1', 'C|c2', '1e-20'), ('A|a1', 'C|c1', '1e-20'),
+                          ('A|a2', 'C|c1', '0.01'), ('A|a3', 'B|b3', '0.001')], hits)
+
+    def test_evict_blast_databases(self):
+        '''
+        Evict least recently used blast databases from the registry, but never those locked by a run still using them.
+        '''
+        for index, name in enumerate(['in-use', 'oldest', 'newest']):
+            entry_dir = os.path.join(self.run_dir, name)
+            os.makedirs(os.path.join(entry_dir, 'blast'))
+            with open(os.path.join(entry_dir, 'blast', 'db.pin'), mode='w') as write_handle:
+                write_handle.write('x' * 100)
+            os.utime(entry_dir, (index, index))
+
+        for name in ['oldest', 'failed']:
+            open(os.path.join(self.run_dir, name + '.lock'), mode='a').close()
+
+        # Exercise
+        with open(os.path.join(self.run_dir, 'in-use.lock'), mode='a') as lock_handle:
+            fcntl.flock(lock_handle, fcntl.LOCK_SH)
+            reciprocal_blast_local._evict_blast_databases(self.run_dir, max_size=200)
+
+        # Verify
+        # Lock files are removed along with evicted databases, and when left behind by databases that failed to build
+        self.assertEqual(['in-use', 'in-use.lock', 'newest'], sorted(os.listdir(self.run_dir)))
+
+    def test_lock_registry_entry(self):
+        '''
+        Lock a registry entry anew when its lock file is removed by eviction while waiting for the lock.
+        '''
+        entry_dir = os.path.join(self.run_dir, 'entry')
+        lock_handle = reciprocal_blast_local._lock_registry_entry(entry_dir, fcntl.LOCK_EX)
+        locked = []
+        thread = threading.Thread(target=lambda: locked.append(
+            reciprocal_blast_local._lock_registry_entry(entry_dir, fcntl.LOCK_SH)))
+        thread.start()
+        time.sleep(.2)
+
+        # Exercise
+        os.remove(entry_dir + '.lock')
+        lock_handle.close()
+        thread.join(5)
+
+        # Verify
+        self.assertTrue(reciprocal_blast_local._holds_registry_lock(locked[0], entry_dir))
+        self.assertRaises(IOError, fcntl.flock, open(entry_dir + '.lock', mode='a'), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        locked[0].close()
+
+    def test_kill_blast_processes(self):
+        '''
+        Kill processes started from a pool of threads, and verify no further processes are started afterwards.
+        '''
+        processes = reciprocal_blast_local._BlastProcesses()
+        pool = ThreadPool(processes=2)
+        try:
+            results = [pool.apply_async(processes.check_call, (['sleep', '60'], self.run_dir)) for _ in range(2)]
+            while len(processes._processes) < 2:
+                time.sleep(.05)
+
+            # Exercise
+            started = time.time()
+            processes.kill()
+
+            # Verify
+            for result in results:
+                self.assertRaises(CalledProcessError, result.get, 10)
+            self.assertLess(time.time() - started, 10)
+            self.assertRaises(CalledProcessError, processes.check_call, ['true'], self.run_dir)
+        finally:
+            pool.terminate()
@@ -7,7 +7,7 @@ import unittest
 
 import run_orthomcl
 from shared import resource_filename
-from versions import ORTHOMCL_DIR
+from versions import BLASTP, MCL, ORTHOMCL_INSTALL_SCHEMA
 
 
 class Test(unittest.TestCase):
@@ -24,16 +24,34 @@ class Test(unittest.TestCase):
         self.assertEqual(30, args.poorlength)
         self.assertEqual(target_poor, args.poorfasta)
 
-    @unittest.skipUnless(os.path.isdir(ORTHOMCL_DIR), 'We need OrthoMCL')
+    def test_parse_args_backend(self):
+        args = run_orthomcl._parse_args(['proteins.zip', 'target-poor.fasta', 'target-groups.tsv'])
+        self.assertEqual('mysql', args.backend)
+        args = run_orthomcl._parse_args(['proteins.zip', '-b', 'sqlite', 'target-poor.fasta', 'target-groups.tsv'])
+        self.assertEqual('sqlite', args.backend)
+
+    @unittest.skipUnless(os.path.isfile(BLASTP) and os.path.isfile(MCL), 'We need BLAST and MCL')
+    @unittest.skipUnless(os.path.isfile(ORTHOMCL_INSTALL_SCHEMA), 'We need OrthoMCL')
     def test_run_orthomcl(self):
         '''
         Run run_orthomcl.run_orthomcl on two genomes and verify the poor proteins and identified groups
         '''
+        self._verify_run_orthomcl()
+
+    @unittest.skipUnless(os.path.isfile(BLASTP) and os.path.isfile(MCL), 'We need BLAST and MCL')
+    def test_run_orthomcl_sqlite(self):
+        '''
+        Run run_orthomcl.run_orthomcl with the embedded pairs backend, and verify it identifies the same groups as
+        OrthoMCL does, without the need for OrthoMCL or a MySQL server
+        '''
+        self._verify_run_orthomcl('--backend', 'sqlite')
+
+    def _verify_run_orthomcl(self, *options):
         # Setup
         proteome_files = [resource_filename(__name__, 'data/run_orthomcl/' + acc + '.1.faa') for acc in ['13305', '17745']]
         target_poor_proteins_file = tempfile.mkstemp(suffix='.txt', prefix='poor_proteins_')[1]
         target_groups_file = tempfile.mkstemp(suffix='.txt', prefix='groups_')[1]
-        args = run_orthomcl._parse_args(['', target_poor_proteins_file, target_groups_file])
+        args = run_orthomcl._parse_args(list(options) + ['', target_poor_proteins_file, target_groups_file])
 
         try:
             # Exercise
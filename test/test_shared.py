@@ -1,3 +1,4 @@
+from Bio import SeqIO
 import os
 import shutil
 import tempfile
@@ -33,3 +34,132 @@ class Test(unittest.TestCase):
         finally:
             os.remove(fakefile)
             shutil.rmtree(target_dir)
+
+    def test_fasta_writer_matches_seqio(self):
+        '''
+        Assert records written through FastaWriter are formatted identical to those written by Bio.SeqIO.
+        '''
+        from Bio import SeqIO
+        from Bio.Seq import Seq
+        from Bio.SeqRecord import SeqRecord
+        from StringIO import StringIO
+        records = [SeqRecord(Seq('ACGT' * 40), id='a|b|c', description=''),
+                   SeqRecord(Seq('M' * 60), id='second', description='second with description'),
+                   SeqRecord(Seq('GATTACA'), id='third', description='unrelated description'),
+                   SeqRecord(Seq(''), id='empty', description='')]
+        expected = StringIO()
+        SeqIO.write(records, expected, 'fasta')
+        actual = StringIO()
+        with shared.FastaWriter(actual, buffer_size=100) as writer:
+            for record in records:
+                writer.write_record(record)
+        self.assertEqual(expected.getvalue(), actual.getvalue())
+
+    def test_archive_reader(self):
+        '''
+        Read the contents of the first and only file from a sample zipfile without extracting it.
+        '''
+        archive_file = shared.resource_filename(__name__, 'data/shared/sample.txt.zip')
+        with shared.ArchiveReader(archive_file) as archive:
+            self.assertEqual(1, len(archive.names))
+            with archive.open(archive.names[0]) as reader:
+                self.assertEqual("12345", reader.read())
+
+    def test_create_archive_of_files_profiles(self):
+        '''
+        Create archives using each of the compression profiles and assert the contents can be read back identically.
+        '''
+        target_dir = tempfile.mkdtemp()
+        try:
+            sample_files = [os.path.join(target_dir, 'sample.txt'), os.path.join(target_dir, 'other.txt')]
+            for sample_file in sample_files:
+                with open(sample_file, mode='w') as writer:
+                    writer.write('ACGT' * 1000)
+            for profile in shared.ARCHIVE_PROFILES:
+                archive_file = os.path.join(target_dir, profile + '.zip')
+                shared.create_archive_of_files(archive_file, sample_files, profile)
+                with shared.ArchiveWriter(archive_file + '.mem.zip', profile) as archive:
+                    archive.write_member('sample.txt', 'ACGT' * 1000)
+                    archive.write_member('other.txt', 'ACGT' * 1000)
+                for written in (archive_file, archive_file + '.mem.zip'):
+                    with shared.ArchiveReader(written) as archive:
+                        self.assertEqual(['sample.txt', 'other.txt'], archive.names, profile)
+                        for name in archive.names:
+                            with archive.open(name) as reader:
+                                self.assertEqual('ACGT' * 1000, reader.read(), profile)
+        finally:
+            shutil.rmtree(target_dir)
+
+    def test_alignment_set_conversion(self):
+        '''
+        Convert a zip archive of aligned fasta files into a packed alignment set and back, and access it in between.
+        '''
+        target_dir = tempfile.mkdtemp()
+        try:
+            fasta_file = os.path.join(target_dir, 'sico1.ffn')
+            with open(fasta_file, mode='w') as writer:
+                writer.write('>a|x|p1|None|product\n' + 'ACGT' * 20 + '\n>b|y|p2|None|product\n' + 'ACGA' * 20 + '\n')
+            archive_file = os.path.join(target_dir, 'sicos.zip')
+            shared.create_archive_of_files(archive_file, [fasta_file])
+
+            alignment_set_file = shared.convert_archive_to_alignment_set(archive_file, archive_file + '.alignments')
+            with shared.AlignmentSetReader(alignment_set_file) as alignment_set:
+                self.assertEqual(['sico1.ffn'], alignment_set.names)
+                self.assertEqual(['a|x|p1|None|product', 'b|y|p2|None|product'], alignment_set.headers('sico1.ffn'))
+                matrix = alignment_set.matrix('sico1.ffn')
+                self.assertEqual((2, 80), matrix.shape)
+                self.assertEqual([ord('T'), ord('A')], list(matrix[:, 3]))
+
+                # Members can be read without a with statement, in place of open
+                records = list(SeqIO.parse(alignment_set.open('sico1.ffn'), 'fasta'))
+                self.assertEqual('ACGA' * 20, str(records[1].seq))
+
+            roundtrip_file = shared.convert_alignment_set_to_archive(alignment_set_file, archive_file + '.zip')
+            with shared.ArchiveReader(roundtrip_file) as archive:
+                with archive.open('sico1.ffn') as reader:
+                    self.assertEqual(str(list(SeqIO.parse(fasta_file, 'fasta'))[1].seq),
+                                     str(list(SeqIO.parse(reader, 'fasta'))[1].seq))
+        finally:
+            shutil.rmtree(target_dir)
+
+    def test_aborted_alignment_set(self):
+        '''
+        Abort writing an alignment set with an exception, and verify readers reject the incomplete file.
+        '''
+        target_dir = tempfile.mkdtemp()
+        try:
+            for records in ([], [('a|x|p1|None|product', 'ACGT' * 20)]):
+                alignment_set_file = os.path.join(target_dir, 'aborted.alignments')
+                with self.assertRaises(ValueError):
+                    with shared.AlignmentSetWriter(alignment_set_file) as alignment_set:
+                        alignment_set.write('sico1.ffn', records)
+                        raise ValueError('Aborted')
+                self.assertRaises(AssertionError, shared.AlignmentSetReader, alignment_set_file)
+        finally:
+            shutil.rmtree(target_dir)
+
+    def test_concatenate_and_chain_files(self):
+        '''
+        Concatenate files both on disk and lazily through chain_files, and assert both match the joined contents.
+        '''
+        target_dir = tempfile.mkdtemp()
+        try:
+            source_files = []
+            for index, contents in enumerate(['first\nsecond\n', '', 'third without newline', '\nfourth\n']):
+                source_file = os.path.join(target_dir, 'source{0}.txt'.format(index))
+                with open(source_file, mode='w') as writer:
+                    writer.write(contents)
+                source_files.append(source_file)
+            expected = 'first\nsecond\nthird without newline\nfourth\n'
+
+            target_file = os.path.join(target_dir, 'target.txt')
+            shared.concatenate(target_file, source_files)
+            with open(target_file) as reader:
+                self.assertEqual(expected, reader.read())
+
+            with shared.chain_files(source_files) as reader:
+                self.assertEqual(expected.splitlines(True), list(reader))
+            with shared.chain_files(source_files) as reader:
+                self.assertEqual(expected, reader.read(5) + reader.read())
+        finally:
+            shutil.rmtree(target_dir)
@@ -39,4 +39,4 @@ class Test(unittest.TestCase):
 
         # Verify no header appears twice
         headers = [record.id for record in SeqIO.parse(aafiles[0], 'fasta')]
-        self.assertEqual(len(headers), len(set(headers)))
\ No newline at end of file
+        self.assertEqual(len(headers), len(set(headers)))
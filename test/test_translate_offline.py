@@ -0,0 +1,60 @@
+from Bio.Data.CodonTable import TranslationError
+from Bio.Seq import Seq
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+
+import translate
+
+
+class Test(unittest.TestCase):
+
+    def setUp(self):
+        self.longMessage = True
+        logging.root.setLevel(logging.DEBUG)
+
+    def test_batch_translate_cds(self):
+        '''
+        Translate coding sequences in batch and compare the outcome with BioPython translation of individual sequences.
+        '''
+        sequences = ['ATGGCTAAATAA',  # Regular coding sequence
+                     'GTGCTGTTTTGA',  # Alternative start codon translates to methionine
+                     'CCCGCTAAATAA',  # Invalid start codon
+                     'ATGGCTAAAGCT',  # Missing stop codon
+                     'ATGTAAGCTTAG',  # In frame stop codon
+                     'ATGCTNAAATAA']  # Ambiguous codon left for BioPython
+        translations = translate._batch_translate_cds(sequences, 11)
+        self.assertEqual(None, translations[-1])
+        for sequence, translation in zip(sequences[:-1], translations):
+            try:
+                expected = str(Seq(sequence).translate(table=11, cds=True))
+                self.assertEqual(expected, translation)
+            except TranslationError as err:
+                self.assertIsInstance(translation, TranslationError)
+                self.assertEqual(str(err).split()[:2], str(translation).split()[:2])
+
+    def test_translation_cache(self):
+        '''
+        Store translated files in the translation cache and assert they are only returned for the matching digest.
+        '''
+        cache_dir = tempfile.mkdtemp()
+        try:
+            dna_file = os.path.join(cache_dir, 'input.ffn')
+            aa_file = os.path.join(cache_dir, 'input.faa')
+            with open(dna_file, mode='w') as write_handle:
+                write_handle.write('>a\nATGTAA\n')
+            with open(aa_file, mode='w') as write_handle:
+                write_handle.write('>a\nM\n')
+            manifest = {'translator_version': translate.TRANSLATOR_VERSION,
+                        'files': {'ffn': {'records': 1, 'size': 10}, 'faa': {'records': 1, 'size': 5}}}
+            digest = 'ab' * 20
+            self.assertEqual(None, translate._get_cached_translation(digest, cache_dir))
+            translate._store_cached_translation(digest, dna_file, aa_file, manifest, cache_dir)
+            cached_dna, cached_aa = translate._get_cached_translation(digest, cache_dir)
+            self.assertEqual('>a\nATGTAA\n', open(cached_dna).read())
+            self.assertEqual('>a\nM\n', open(cached_aa).read())
+            self.assertEqual(None, translate._get_cached_translation('cd' * 20, cache_dir))
+        finally:
+            shutil.rmtree(cache_dir)
@@ -5,12 +5,17 @@ from Bio import SeqIO
 from Bio.Alphabet.IUPAC import ambiguous_dna
 from Bio.Data import CodonTable
 from Bio.Data.CodonTable import TranslationError
-from Bio.SeqRecord import SeqRecord
+from Bio.Seq import Seq
+import hashlib
+import itertools
+import json
+import marshal
 from multiprocessing import Pool
+import numpy
 from operator import itemgetter
 import os
-import re
 import shutil
+import string
 import sys
 import tempfile
 
@@ -18,7 +23,7 @@ from download_taxa_ncbi import download_genome_files
 import logging as log
 from select_taxa import select_genomes_by_ids
 from shared import create_directory, concatenate, create_archive_of_files, parse_options, \
-    extract_archive_of_files, CODON_TABLE_ID
+    extract_archive_of_files, FastaWriter, CODON_TABLE_ID
 
 
 __author__ = "Tim te Beek"
@@ -28,6 +33,10 @@ __license__ = "MIT"
 # Using the standard NCBI Bacterial, Archaeal and Plant Plastid Code translation table (11).
 BACTERIAL_CODON_TABLE = CodonTable.unambiguous_dna_by_id.get(CODON_TABLE_ID)
 
+# Version of the translation output format: increment whenever a change alters the produced .ffn or .faa files, so that
+# any previously cached translations are no longer used
+TRANSLATOR_VERSION = 1
+
 
 def _append_external_genomes(external_fasta_files, genomes_file):
     """Read out user provided labels and original filenames for uploaded genomes and append them to genome IDs file."""
@@ -45,53 +54,106 @@ def _append_external_genomes(external_fasta_files, genomes_file):
                 append_handle.write('{0}\t{1}\texternal genome\n'.format(label, origin))
 
 
+# Characters in product descriptions that would otherwise interfere with the fasta header format are replaced
+_PRODUCT_REPLACEMENTS = string.maketrans('<>|;', '____')
+
+
 def _map_protein_cog_and_gene(ptt_file):
-    """Build a dictionary cog_mapping PID to COG based on protein table file."""
+    """Build a dictionary cog_mapping PID to COG based on protein table file.
+
+    Mappings are cached in binary form by content hash of the protein table file, so identical files are parsed once."""
+    with open(ptt_file, mode='rb') as read_handle:
+        contents = read_handle.read()
+
+    # Marshal format differs between Python versions, so include the format version in the cached filename
+    ptt_cache_dir = create_directory('ptt', inside_dir=_get_translation_cache_dir())
+    mapping_file = os.path.join(ptt_cache_dir, '{0}.{1}.marshal'.format(hashlib.sha1(contents).hexdigest(),
+                                                                       marshal.version))
+    if os.path.isfile(mapping_file):
+        with open(mapping_file, mode='rb') as read_handle:
+            return marshal.loads(read_handle.read())
+
+    cog_mapping, product_mapping = _parse_protein_table(contents.splitlines())
+
+    # Write to a temporary file first and rename that into place, so concurrent readers never see a partial mapping
+    fd, mapping_tmp = tempfile.mkstemp(suffix='.marshal', dir=ptt_cache_dir)
+    with os.fdopen(fd, 'wb') as write_handle:
+        write_handle.write(marshal.dumps((cog_mapping, product_mapping)))
+    os.chmod(mapping_tmp, 0o644)
+    os.rename(mapping_tmp, mapping_file)
+    return cog_mapping, product_mapping
+
+
+def _parse_protein_table(lines):
+    """Parse lines of a protein table file into dictionaries mapping PID to COG and PID to product."""
     cog_mapping = {}
     product_mapping = {}
-    with open(ptt_file) as read_handle:
-        # Skip past either the first line, or first two lines, as NCBI can't seem to stick to any single one convention
-        while True:
-            # Line 1: Escherichia coli 536, complete genome - 1..4938920
-            # Line 2: 4619 proteins
-            line = read_handle.readline().strip()
-            if line.endswith(' proteins'):
-                break
-
-        # Line 3: Location    Strand    Length    PID    Gene    Synonym    Code    COG    Product
-        line = read_handle.readline().strip()
-        columns = line.split("\t")
-        assert columns == ['Location', 'Strand', 'Length', 'PID', 'Gene', 'Synonym', 'Code', 'COG', 'Product']
-
-        for line in read_handle:
-            values = line.strip().split('\t')
-            assert len(values) == 9
-            # Make format match format in genbank db_xref records
-            pid = values[3]
-            assert pid not in cog_mapping, 'Protein identifier was already assigned value: ' + cog_mapping[pid]
-            assert pid not in product_mapping, 'Protein identifier was already assigned value: ' + product_mapping[pid]
-            # Assign None if value of COG does not start with COG (such as when it's '-')
-            cog_mapping[pid] = values[7] if values[7].startswith('COG') else None
-            product_mapping[pid] = values[8].replace('<', '_').replace('>', '_').replace('|', '_').replace(';', '_')
+    line_iter = iter(lines)
+    # Skip past either the first line, or first two lines, as NCBI can't seem to stick to any single one convention
+    # Line 1: Escherichia coli 536, complete genome - 1..4938920
+    # Line 2: 4619 proteins
+    for line in line_iter:
+        if line.strip().endswith(' proteins'):
+            break
+
+    # Line 3: Location    Strand    Length    PID    Gene    Synonym    Code    COG    Product
+    columns = next(line_iter).strip().split('\t')
+    assert columns == ['Location', 'Strand', 'Length', 'PID', 'Gene', 'Synonym', 'Code', 'COG', 'Product']
+
+    for line in line_iter:
+        values = line.strip().split('\t')
+        assert len(values) == 9
+        # Make format match format in genbank db_xref records
+        pid = values[3]
+        assert pid not in cog_mapping, 'Protein identifier was already assigned value: ' + cog_mapping[pid]
+        # Assign None if value of COG does not start with COG (such as when it's '-')
+        cog_mapping[pid] = values[7] if values[7].startswith('COG') else None
+        product_mapping[pid] = values[8].translate(_PRODUCT_REPLACEMENTS)
     return cog_mapping, product_mapping
 
 
-def translate_genomes(genomes):
-    """Download genome files, extract genes and translate those to proteins, returning DNA and protein fasta files."""
+def translate_genomes(genomes, workers=None):
+    """Download genome files, extract genes and translate those to proteins, returning DNA and protein fasta files.
+
+    Each genome is downloaded and translated as a single task in a pool of workers, so translating one genome overlaps
+    with downloading the next. Results are gathered as they complete, but returned in order of organism name."""
     assert len(genomes), 'Some genomes should be selected'
 
-    # Use a pool to download files in the background while translating
-    pool = Pool()
-    futures = [pool.apply_async(download_genome_files, (genome,)) for genome in genomes]
-    dna_aa_pairs = [_translate_genome(gbk_ptt_pairs.get()) for gbk_ptt_pairs in futures if gbk_ptt_pairs.get() != None]
+    # Create the parent translations directory up front, so workers do not race each other to create it
+    create_directory('translations')
 
-    # Extract DNA & Protein files separately from dna_aa_pairs
-    dna_files = [pair[0] for pair in dna_aa_pairs]
-    aa_files = [pair[1] for pair in dna_aa_pairs]
+    # Collect organism name, project ID and resulting files for each genome as soon as any worker finishes
+    translated = []
+    pool = Pool(processes=workers)
+    try:
+        for result in pool.imap_unordered(_download_and_translate_genome, genomes):
+            if result is not None:
+                log.info('Translated genome %s: %s', result[1], result[0])
+                translated.append(result)
+    finally:
+        pool.close()
+        pool.join()
+
+    # Sort by organism name and project ID, so output order does not depend on which worker finished first
+    translated.sort(key=itemgetter(0, 1))
+
+    # Extract DNA & Protein files separately from translated genomes
+    dna_files = [tpl[2] for tpl in translated]
+    aa_files = [tpl[3] for tpl in translated]
 
     return dna_files, aa_files
 
 
+def _download_and_translate_genome(genome):
+    """Download files for a single genome and translate them, returning organism name, project ID and fasta files."""
+    gbk_ptt_tuples = download_genome_files(genome)
+    if gbk_ptt_tuples is None:
+        log.warn('No genome files could be retrieved for %s', genome['Assembly Accession'])
+        return None
+    dna_file, aa_file = _translate_genome(gbk_ptt_tuples)
+    return genome['Organism/Name'], genome['Assembly Accession'], dna_file, aa_file
+
+
 def _translate_genome(tuples_of_gbk_and_ptt_files):
     """Translate all files for genome and concatenate them into single DNA and Protein fasta files."""
     assert tuples_of_gbk_and_ptt_files is not None, 'No genbank files were provided'
@@ -120,13 +182,20 @@ def _extract_gene_and_protein(out_dir, project_id, genbank_file, ptt_file=None,
     dna_file_dest = os.path.join(out_dir, os.path.split(file_root)[1] + '.ffn')
     aa_file_dest = os.path.join(out_dir, os.path.split(file_root)[1] + '.faa')
 
-    # Check if destination output files already exist and have content, and if so return them
-    if (os.path.isfile(aa_file_dest) and 0 < os.path.getsize(aa_file_dest) and
-            os.path.isfile(dna_file_dest) and 0 < os.path.getsize(dna_file_dest)):
-        # But only if the output files are newer than the genbank file, otherwise translate the newer file & overwrite
-        if (os.path.getmtime(genbank_file) < os.path.getmtime(aa_file_dest) and
-                os.path.getmtime(genbank_file) < os.path.getmtime(dna_file_dest)):
-            return dna_file_dest, aa_file_dest
+    # Determine filetype by looking at extension, which should be either genbank or embl
+    if filetype == None:
+        filetype = os.path.splitext(genbank_file)[1][1:]
+        if filetype == 'gbk':
+            filetype = 'genbank'
+
+    # Reuse earlier translations of identical input files, which might have been produced on another node entirely
+    digest = _hash_translation_input(project_id, genbank_file, ptt_file, filetype)
+    cached = _get_cached_translation(digest)
+    if cached is not None:
+        log.info('Reusing cached translation %s of %s', digest, genbank_file)
+        shutil.copyfile(cached[0], dna_file_dest)
+        shutil.copyfile(cached[1], aa_file_dest)
+        return dna_file_dest, aa_file_dest
 
     # Use temporary files as write handles when translating, so we can not pollute cache with incomplete files
     dna_tmp = tempfile.mkstemp(suffix='.ffn', prefix='translate_')[1]
@@ -144,55 +213,31 @@ def _extract_gene_and_protein(out_dir, project_id, genbank_file, ptt_file=None,
 
     # Open genbank_file & convert it using BioPython
     log.info('Translating %s', genbank_file)
-    with open(aa_tmp, mode='w') as aa_wrtr:
-        with open(dna_tmp, mode='w') as dna_wrtr:
-            # Determine filetype by looking at extension, which should be either genbank or embl
-            if filetype == None:
-                filetype = os.path.splitext(genbank_file)[1][1:]
-                if filetype == 'gbk':
-                    filetype = 'genbank'
-
-            # Bio.GenBank.Record
-            gb_recrd = SeqIO.read(genbank_file, filetype)
-
-            # Some RefSeq records such as 61583 do not contain nucleic acids, but rather refer to other files.
-            # This means any extracted sequences will only consist of NN or XX, meaning we can't continue.
-            str_seq = str(gb_recrd.seq)
-            if re.match('^N+$', str_seq) or re.match('^X+$', str_seq):
-                log.error('No nucleic acid sequence found in file %s, meaning we can not determine shared for %s.',
-                          genbank_file, project_id)
-
-            # Determine whether the source of this genbank file is core genome or plasmid
-            # plasmid = False
-            # for gb_featr in gb_recrd.features:# Bio.SeqFeature
-            #    if gb_featr.type == 'source' and 'plasmid' in gb_featr.qualifiers:
-            #        plasmid = True
-            #        break
-
-            # Select only the coding sequences from all feature records
-            coding_features = [gb_featr for gb_featr in gb_recrd.features
-                               # Skip any non coding sequence features or pseudo (non-functional version) CDS
-                               if (gb_featr.type == 'CDS'
-                                   and not 'pseudo' in gb_featr.qualifiers
-                                   and not 'pseudogene' in gb_featr.qualifiers
-                                   )]
-
-            # Remove duplicates while retaining order
-            seen = set()
-            coding_features = [x for x in coding_features if x not in seen and not seen.add(x)]
+    with open(aa_tmp, mode='w') as aa_handle, FastaWriter(aa_handle, line_length=70) as aa_wrtr:
+        with open(dna_tmp, mode='w') as dna_handle, FastaWriter(dna_handle, line_length=70) as dna_wrtr:
+            # Translate coding sequences as they are read, so only a single record is held in memory at any one time
+            nr_of_coding_features = 0
+            for gb_recrd, cds_featrs in _iter_coding_features(genbank_file, filetype, project_id):
+                nr_of_coding_features += len(cds_featrs)
+                _translate_record_cds(cog_dict, product_dict, aa_wrtr, dna_wrtr, project_id, gb_recrd, cds_featrs)
 
             # If there are no coding features, report this back to the user with a clear message rather than empty file
-            if 0 == len(coding_features):
+            if 0 == nr_of_coding_features:
                 log.error('No coding sequences found in file %s. Require protein table files to prevent this.',
                           genbank_file)
 
-            # Translate all coding sequences
-            for cds_featr in coding_features:
-                _extract_and_translate_cds(cog_dict, product_dict, aa_wrtr, dna_wrtr, project_id, gb_recrd, cds_featr)
-
     assert os.path.isfile(dna_tmp) and 0 < os.path.getsize(dna_tmp), dna_tmp + ' should exist and have some content'
     assert os.path.isfile(aa_tmp) and 0 < os.path.getsize(aa_tmp), aa_tmp + ' should exist and have some content'
 
+    # Store completed files in the translation cache, along with a manifest describing their origin and contents
+    manifest = {'translator_version': TRANSLATOR_VERSION,
+                'project_id': project_id,
+                'genbank_file': os.path.basename(genbank_file),
+                'ptt_file': ptt_file and os.path.basename(ptt_file),
+                'files': {'ffn': {'records': dna_wrtr.records, 'size': os.path.getsize(dna_tmp)},
+                          'faa': {'records': aa_wrtr.records, 'size': os.path.getsize(aa_tmp)}}}
+    _store_cached_translation(digest, dna_tmp, aa_tmp, manifest)
+
     # Move completed files to cache location only just now, so incomplete files do not pollute cache when raising errors
     shutil.move(dna_tmp, dna_file_dest)
     shutil.move(aa_tmp, aa_file_dest)
@@ -200,34 +245,224 @@ def _extract_gene_and_protein(out_dir, project_id, genbank_file, ptt_file=None,
     return dna_file_dest, aa_file_dest
 
 
-def _extract_and_translate_cds(cog_mapping, product_mapping, aa_writer, dna_writer, project_id, gb_record, gb_feature):
-    """Extract DNA for Coding sequences, translate using GBK translation table and return dna & protein fasta files."""
-
-    # Protein identifier is a property of the genbank feature
-    protein_id = gb_feature.qualifiers['protein_id'][0]
-
-    # Original sequence retrieved through BioPython 1.53+'s internal method
-    extracted_seq = gb_feature.extract(gb_record.seq)  # Bio.Seq.Seq
-
-    if len(extracted_seq) % 3:
-        # Skip CDS feature if length of extracted_seq is not a multiple of three
-        log.warn('Length of extracted coding sequence %s not a multiple of 3: %i\n%s',
-                 protein_id, len(extracted_seq), extracted_seq)
+def _get_translation_cache_dir():
+    """Return the translation cache directory, which can be shared between nodes through the translation_cache
+    environment variable, and otherwise defaults to a directory within the local cache."""
+    if 'translation_cache' in os.environ:
+        return create_directory('', inside_dir=os.environ['translation_cache'])
+    return create_directory('translation-cache')
+
+
+def _hash_translation_input(project_id, genbank_file, ptt_file, filetype):
+    """Return a hexadecimal digest over the translator version and all inputs that determine the translation output."""
+    sha1 = hashlib.sha1()
+    # The project ID ends up in each fasta header, so it's part of the key along with the input file contents
+    sha1.update('{0}\t{1}\t{2}\t{3}\n'.format(TRANSLATOR_VERSION, project_id, filetype, ptt_file is not None))
+    for input_file in (genbank_file, ptt_file):
+        if input_file is None:
+            continue
+        with open(input_file, mode='rb') as read_handle:
+            for chunk in iter(lambda: read_handle.read(1 << 20), ''):
+                sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def _get_cached_translation(digest, cache_dir=None):
+    """Return tuple of cached DNA and protein fasta files for digest, or None when no complete entry is cached."""
+    entry_dir = os.path.join(cache_dir or _get_translation_cache_dir(), digest[:2], digest)
+    manifest_file = os.path.join(entry_dir, 'manifest.json')
+    if not os.path.isfile(manifest_file):
+        return None
+    with open(manifest_file) as read_handle:
+        manifest = json.load(read_handle)
+
+    # Only trust entries that were produced by the current translator and whose files are still intact
+    if manifest.get('translator_version') != TRANSLATOR_VERSION:
+        return None
+    cached_files = []
+    for extension in ('ffn', 'faa'):
+        cached_file = os.path.join(entry_dir, digest + '.' + extension)
+        if not os.path.isfile(cached_file) or os.path.getsize(cached_file) != manifest['files'][extension]['size']:
+            log.warn('Ignoring incomplete cached translation %s', entry_dir)
+            return None
+        cached_files.append(cached_file)
+    return tuple(cached_files)
+
+
+def _store_cached_translation(digest, dna_file, aa_file, manifest, cache_dir=None):
+    """Copy DNA and protein fasta files and their manifest into the translation cache under digest."""
+    cache_dir = cache_dir or _get_translation_cache_dir()
+    prefix_dir = create_directory(digest[:2], inside_dir=cache_dir)
+    entry_dir = os.path.join(prefix_dir, digest)
+    if os.path.isdir(entry_dir):
         return
 
-    # Some records do not contain nucleic acids, but rather refer to other files for their contigs: We can't handle that
-    str_seq = str(extracted_seq)
-    if re.match('^X+$', str_seq) or re.match('^N+$', str_seq):
-        # Skip CDS feature if length of extracted_seq is not a multiple of three
-        log.warn('Extracted sequence only consists of X or N: %s', protein_id)
-        return
-
-    # Translation table is a property of the genbank feature
-    transl_table = gb_feature.qualifiers['transl_table'][0]
-    codon_table = CodonTable.unambiguous_dna_by_id.get(int(transl_table))
+    # Assemble the entry in a staging directory next to its destination, and only then rename it into place: Other
+    # nodes sharing the cache directory thus see either a complete entry or no entry at all
+    staging_dir = tempfile.mkdtemp(prefix='.' + digest + '.', dir=prefix_dir)
+    try:
+        shutil.copyfile(dna_file, os.path.join(staging_dir, digest + '.ffn'))
+        shutil.copyfile(aa_file, os.path.join(staging_dir, digest + '.faa'))
+        with open(os.path.join(staging_dir, 'manifest.json'), mode='w') as write_handle:
+            json.dump(manifest, write_handle, indent=1, sort_keys=True)
+        os.chmod(staging_dir, 0o755)
+        os.rename(staging_dir, entry_dir)
+    except OSError as err:
+        # Another process stored the same translation first, which is fine as both are identical
+        if not os.path.isdir(entry_dir):
+            raise
+        log.debug('Translation %s was cached concurrently: %s', digest, err)
+    finally:
+        if os.path.isdir(staging_dir):
+            shutil.rmtree(staging_dir)
+
+
+def _iter_coding_features(genbank_file, filetype, project_id):
+    """Yield tuples of record and its coding sequence features from genbank_file, reading one record at a time.
+
+    Pseudo genes are skipped, and duplicate features are removed based on their location and protein identifier."""
+    # Bio.GenBank.Record
+    for gb_recrd in SeqIO.parse(genbank_file, filetype):
+        # Some RefSeq records such as 61583 do not contain nucleic acids, but rather refer to other files.
+        # This means any extracted sequences will only consist of NN or XX, meaning we can't continue.
+        str_seq = str(gb_recrd.seq)
+        if not str_seq.strip('N') or not str_seq.strip('X'):
+            log.error('No nucleic acid sequence found in record %s of %s, meaning we can not determine shared for %s.',
+                      gb_recrd.id, genbank_file, project_id)
+
+        # Locations are relative to the current record, so we only need to remember features seen within this record
+        seen = set()
+        coding_features = []
+        for gb_featr in gb_recrd.features:  # Bio.SeqFeature
+            # Skip any non coding sequence features or pseudo (non-functional version) CDS
+            if (gb_featr.type != 'CDS'
+                    or 'pseudo' in gb_featr.qualifiers
+                    or 'pseudogene' in gb_featr.qualifiers):
+                continue
 
+            # Remove duplicates while retaining order
+            key = (str(gb_featr.location), gb_featr.qualifiers.get('protein_id', [None])[0])
+            if key in seen:
+                continue
+            seen.add(key)
+            coding_features.append(gb_featr)
+
+        yield gb_recrd, coding_features
+
+
+# Map nucleotide characters to codes 0-3 in the order used to index codon lookups below; anything else is ambiguous (4)
+_NUCLEOTIDE_CODES = numpy.empty(256, dtype=numpy.intp)
+_NUCLEOTIDE_CODES.fill(4)
+for _code, _base in enumerate('TCAG'):
+    _NUCLEOTIDE_CODES[ord(_base)] = _code
+    _NUCLEOTIDE_CODES[ord(_base.lower())] = _code
+
+
+def _get_codon_lookup(table_id):
+    """Return amino acid, start codon and stop codon lookup arrays for an NCBI translation table, and its stop codons.
+
+    Arrays are indexed by codon number 0-63 in TCAG order, with an additional entry 64 for any ambiguous codon."""
+    lookup = _get_codon_lookup.cache.get(table_id)
+    if lookup is None:
+        codon_table = CodonTable.unambiguous_dna_by_id[table_id]
+        codons = [first + second + third for first in 'TCAG' for second in 'TCAG' for third in 'TCAG']
+        amino_acids = numpy.frombuffer(''.join(codon_table.forward_table.get(codon, '*') for codon in codons) + 'X',
+                                       dtype=numpy.uint8)
+        start_codons = numpy.array([codon in codon_table.start_codons for codon in codons] + [False])
+        stop_codons = numpy.array([codon in codon_table.stop_codons for codon in codons] + [False])
+        lookup = amino_acids, start_codons, stop_codons, frozenset(codon_table.stop_codons)
+        _get_codon_lookup.cache[table_id] = lookup
+    return lookup
+
+# Lookups are built once per translation table and then reused for all genomes translated by this process
+_get_codon_lookup.cache = {}
+
+
+def _batch_translate_cds(sequences, table_id):
+    """Translate coding sequences using translation table table_id, all at once over a single buffer of codons.
+
+    Return for each sequence either the protein sequence, a TranslationError matching those of Seq.translate(cds=True),
+    or None for sequences containing ambiguous codons, which should be translated individually by the caller."""
+    amino_acids, start_codons, stop_codons = _get_codon_lookup(table_id)[:3]
+
+    # Convert all sequences into one array of codon numbers, as each sequence length is already a multiple of three
+    codes = _NUCLEOTIDE_CODES[numpy.frombuffer(''.join(sequences), dtype=numpy.uint8)].reshape(-1, 3)
+    ambiguous = (codes == 4).any(axis=1)
+    codons = numpy.where(ambiguous, 64, codes[:, 0] * 16 + codes[:, 1] * 4 + codes[:, 2])
+
+    # Determine the index of the first and last codon of each sequence within the array of codons
+    lengths = numpy.array([len(sequence) // 3 for sequence in sequences], dtype=numpy.intp)
+    first = numpy.cumsum(lengths) - lengths
+    last = first + lengths - 1
+
+    # Validate start and stop codons, and count ambiguous codons & stop codons occurring before the final codon
+    is_stop = stop_codons[codons]
+    valid_start = start_codons[codons[first]]
+    valid_stop = is_stop[last]
+    nr_of_ambiguous = numpy.add.reduceat(ambiguous.astype(numpy.intp), first)
+    nr_of_inframe_stops = numpy.add.reduceat(is_stop.astype(numpy.intp), first) - valid_stop
+    translated = amino_acids[codons].tobytes()
+
+    results = []
+    for index, sequence in enumerate(sequences):
+        if nr_of_ambiguous[index]:
+            results.append(None)
+        elif not valid_start[index]:
+            results.append(TranslationError("First codon '{0}' is not a start codon".format(sequence[:3])))
+        elif not valid_stop[index]:
+            results.append(TranslationError("Final codon '{0}' is not a stop codon".format(sequence[-3:])))
+        elif nr_of_inframe_stops[index]:
+            results.append(TranslationError('Extra in frame stop codon found.'))
+        else:
+            # Alternative start codons are translated as methionine, and the final stop codon is dropped
+            results.append('M' + translated[first[index] + 1:last[index]])
+    return results
+
+
+def _translate_record_cds(cog_mapping, product_mapping, aa_writer, dna_writer, project_id, gb_record, gb_features):
+    """Extract DNA for coding sequences of a single record, translate them in batch and write dna & protein fasta."""
+    # Extract the coding sequences that can be translated, with their protein identifier and translation table
+    coding_sequences = []
+    for gb_feature in gb_features:
+        # Protein identifier is a property of the genbank feature
+        protein_id = gb_feature.qualifiers['protein_id'][0]
+
+        # Original sequence retrieved through BioPython 1.53+'s internal method
+        extracted_seq = str(gb_feature.extract(gb_record.seq))
+
+        if len(extracted_seq) % 3:
+            # Skip CDS feature if length of extracted_seq is not a multiple of three
+            log.warn('Length of extracted coding sequence %s not a multiple of 3: %i\n%s',
+                     protein_id, len(extracted_seq), extracted_seq)
+            continue
+
+        # Some records do not contain nucleic acids, but rather refer to other files for their contigs: We can't handle
+        if not extracted_seq.strip('X') or not extracted_seq.strip('N'):
+            log.warn('Extracted sequence only consists of X or N: %s', protein_id)
+            continue
+
+        # Translation table is a property of the genbank feature
+        table_id = int(gb_feature.qualifiers['transl_table'][0])
+        coding_sequences.append((gb_feature, protein_id, extracted_seq, table_id))
+
+    # Translate all coding sequences sharing a translation table at once; a record rarely uses more than one table
+    translations = [None] * len(coding_sequences)
+    for table_id in set(tpl[3] for tpl in coding_sequences):
+        indices = [index for index, tpl in enumerate(coding_sequences) if tpl[3] == table_id]
+        batch = _batch_translate_cds([coding_sequences[index][2] for index in indices], table_id)
+        for index, translation in zip(indices, batch):
+            translations[index] = translation
+
+    for (gb_feature, protein_id, extracted_seq, table_id), translation in zip(coding_sequences, translations):
+        _write_translated_cds(cog_mapping, product_mapping, aa_writer, dna_writer, project_id, gb_record,
+                              gb_feature, protein_id, extracted_seq, table_id, translation)
+
+
+def _write_translated_cds(cog_mapping, product_mapping, aa_writer, dna_writer, project_id, gb_record,
+                          gb_feature, protein_id, extracted_seq, table_id, translation):
+    """Validate batch translation of a single coding sequence, falling back to GenBank translation, and write fasta."""
     # Set flag only when this CDS ends in a stop codon, so we can strip it off later, but do not strip non-stop-codons
-    cds_has_stopcodon = str(extracted_seq[-3:]) in codon_table.stop_codons
+    cds_has_stopcodon = extracted_seq[-3:] in _get_codon_lookup(table_id)[3]
 
     # Translate entire sequence as coding sequence using above translation table
     # Additional CodonTables are optionally available from Bio.Data.CodonTable
@@ -236,8 +471,13 @@ def _extract_and_translate_cds(cog_mapping, product_mapping, aa_writer, dna_writ
         if 'transl_except' in gb_feature.qualifiers:
             # Fall back on GenBank translation whenever a transl_except record is found
             protein_seq = gb_feature.qualifiers['translation'][0]
+        elif translation is None:
+            # Ambiguous codons are left to BioPython, as their translation depends on the possible nucleotides
+            protein_seq = Seq(extracted_seq, ambiguous_dna).translate(table=table_id, cds=True)
+        elif isinstance(translation, TranslationError):
+            raise translation
         else:
-            protein_seq = extracted_seq.translate(table=transl_table, cds=True)
+            protein_seq = translation
     except TranslationError as err:
         # Try to recover from the following errors
         if ('First codon ' in str(err) and ' is not a start codon' in str(err)) or \
@@ -290,31 +530,31 @@ def _extract_and_translate_cds(cog_mapping, product_mapping, aa_writer, dna_writ
 
     # Write out fasta. Header format as requested: >project_id|genbank_ac|protein_id|cog|gene name
     header = '{0}|{1}|{2}|{3}|{4}'.format(project_id, gb_record.id, protein_id, cog, product)
-    _write_fasta(aa_writer, header, str(protein_seq))
-    _write_fasta(dna_writer, header, str(extracted_seq))
+    aa_writer.write(header, str(protein_seq))
+    dna_writer.write(header, extracted_seq)
 
 
-def _write_fasta(write_handle, headerline, sequence):
-    """Wrapper to write fasta header and sequence to file in correct format with new lines and limited line length."""
-    # Write fasta to output file
-    write_handle.write('>' + headerline + '\n')
-    # Print rows with a length of 70 characters
-    while 70 < len(sequence):
-        write_handle.write(sequence[:70] + '\n')
-        sequence = sequence[70:]
-    # Write any remainder
-    if sequence:
-        write_handle.write(sequence + '\n')
+def translate_external_genomes(nucl_fasta_files, workers=None):
+    """Translate nucleotide fasta files of external genomes concurrently, returning protein files in the same order."""
+    pool = Pool(processes=workers)
+    try:
+        return pool.map(translate_fasta_coding_regions, nucl_fasta_files, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
 
 
 def translate_fasta_coding_regions(nucl_fasta_file):
     """Translate an individual nucleotide fasta file containing coding regions to proteins using NCBI codon table 11."""
-    # Determine output file name
-    record_iter = SeqIO.parse(nucl_fasta_file, 'fasta')
-    genomeid = record_iter.next().id.split('|')[0]  # pylint: disable=E1101
+    record_iter = SeqIO.parse(nucl_fasta_file, 'fasta', alphabet=ambiguous_dna)
+    first_record = next(record_iter, None)
+    assert first_record is not None, 'No sequences found in ' + nucl_fasta_file
+
+    # Determine output file name from the genome ID in the first header, and then continue reading from that same record
+    genomeid = first_record.id.split('|')[0]
     prot_fasta_file = tempfile.mkstemp(suffix='.faa', prefix=genomeid + '.')[1]
-    with open(prot_fasta_file, mode='w') as write_handle:
-        for nucl_seqrecord in SeqIO.parse(nucl_fasta_file, 'fasta', alphabet=ambiguous_dna):
+    with open(prot_fasta_file, mode='w') as write_handle, FastaWriter(write_handle) as fasta_writer:
+        for nucl_seqrecord in itertools.chain([first_record], record_iter):
             # Translate nucl_seqrecord.seq
             try:
                 prot_sequence = nucl_seqrecord.seq.translate(table=BACTERIAL_CODON_TABLE)
@@ -323,9 +563,8 @@ def translate_fasta_coding_regions(nucl_fasta_file):
                 log.warn(trer)
                 continue
 
-            # Create protein sequence record and write it to file
-            prot_seqrecord = SeqRecord(prot_sequence, id=nucl_seqrecord.id, description='')
-            SeqIO.write(prot_seqrecord, write_handle, 'fasta')
+            # Write protein sequence to file
+            fasta_writer.write(nucl_seqrecord.id, str(prot_sequence))
     return prot_fasta_file
 
 
@@ -337,9 +576,13 @@ Usage: translate.py
 --external-zip=FILE    optional archive of user provided external genomes containing formatted nucleotide fasta files
 --dna-zip=FILE         destination file path for zip archive of extracted DNA files
 --protein-zip=FILE     destination file path for zip archive of translated protein files
+--workers=NUMBER       optional number of worker processes used to translate (external) genomes [default: all cores]
 """
-    options = ['genomes', 'external-zip=?', 'dna-zip', 'protein-zip']
-    genome_ids_file, external_zip, dna_zipfile, protein_zipfile = parse_options(usage, options, args)
+    options = ['genomes', 'external-zip=?', 'dna-zip', 'protein-zip', 'workers=?']
+    genome_ids_file, external_zip, dna_zipfile, protein_zipfile, workers = parse_options(usage, options, args)
+
+    # Convert number of workers to integer, so we can fail fast if argument value format was wrong
+    workers = int(workers) if workers else None
 
     dna_files = []
     protein_files = []
@@ -355,7 +598,7 @@ Usage: translate.py
             genomes = sorted(genomes, key=itemgetter('Organism/Name'))
 
             # Actually translate the genomes to produced a set of files for both  dna files & protein files
-            dna_files, protein_files = translate_genomes(genomes)
+            dna_files, protein_files = translate_genomes(genomes, workers)
 
     # Also translate the external genomes
     if external_zip:
@@ -366,8 +609,8 @@ Usage: translate.py
         # Append IDs of external fasta files to genome IDs file
         _append_external_genomes(external_dna_files, genome_ids_file)
 
-        # Translate individual files
-        external_protein_files = [translate_fasta_coding_regions(dna_file) for dna_file in external_dna_files]
+        # Translate individual files concurrently
+        external_protein_files = translate_external_genomes(external_dna_files, workers)
 
         # Add the files to the appropriate collections
         dna_files.extend(external_dna_files)
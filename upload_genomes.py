@@ -2,9 +2,7 @@
 """Module for the select taxa step."""
 
 from Bio import SeqIO
-from Bio.Seq import Seq
-from Bio.SeqRecord import SeqRecord
-from shared import parse_options, create_archive_of_files
+from shared import parse_options, create_archive_of_files, FastaWriter
 import logging as log
 import os
 import sys
@@ -22,7 +20,7 @@ def format_fasta_genome_headers(label, nucl_fasta_file):
     # Determine output file name
     filename = os.path.split(nucl_fasta_file)[1]
     formatted_fasta_file = tempfile.mkstemp(suffix='.ffn', prefix='{0}.{1}.formatted_'.format(label, filename))[1]
-    with open(formatted_fasta_file, mode='w') as write_handle:
+    with open(formatted_fasta_file, mode='w') as write_handle, FastaWriter(write_handle) as fasta_writer:
         for index, nucl_seqrecord in enumerate(SeqIO.parse(nucl_fasta_file, 'fasta'), 1):
             # Try to retain user specified protein identifiers, hoping they stuck to this guideline:
             # http://www.ncbi.nlm.nih.gov/books/NBK7183/?rendertype=table&id=ch_demo.T5
@@ -41,14 +39,10 @@ def format_fasta_genome_headers(label, nucl_fasta_file):
 
             # Remove gap codons from input nucleotide fasta file in complete codons only
             nucl_sequence_str = str(nucl_seqrecord.seq).replace('---', '').upper()
-            nucl_sequence = Seq(nucl_sequence_str)
 
             # Write out fasta. Header format as requested: >project_id|genbank_ac|protein_id|cog|source
             header = '{0}|{1}|{2}|{3}|{4}'.format(label, filename, protein_id, None, original_extra)
-
-            # Create protein sequence record and write it to file
-            formatted_seqrecord = SeqRecord(nucl_sequence, id=header, description='')
-            SeqIO.write(formatted_seqrecord, write_handle, 'fasta')
+            fasta_writer.write(header, nucl_sequence_str)
     return formatted_fasta_file
 
 